@@ -0,0 +1,141 @@
+"""
+Synthetic recipe and user corpora in the schema of the real data files.
+
+Recipes are assembled from the ingredients, step sentences and name words of
+`food_databases/recepies.csv`, users from its common ingredients and the
+allergen table, so term frequencies look like the real corpus at any scale.
+The same seed always gives the same corpus.
+
+`write_corpus` lays the files out the way `config.py` expects them relative
+to the working directory:
+
+    <directory>/food_databases/recepies.csv
+    <directory>/food_databases/diabetes-food-scoring.csv
+    <directory>/food_databases/allergic-products.csv
+    <directory>/app/users.csv
+"""
+import json
+import os
+import re
+import shutil
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from food_databases.cache import read_csv
+from food_databases.config import RES_DATA_PATH, DIABETES_DATA_PATH, ALLERGIC_DATA_PATH
+from config import USERS_DATASET_PATH
+
+USER_CONDITIONS = ['diabetes', 'hypertension', 'high blood pressure', 'none', 'pregnant', 'celiac']
+USER_DIETS = ['vegan', 'vegetarian', 'keto', 'low carb', 'mediterranean', 'none']
+
+
+class CorpusSource:
+    """Building blocks taken from the real recipes CSV."""
+
+    def __init__(self, path=RES_DATA_PATH):
+        df = read_csv(path)
+        self.ingredients = [dict(item) for ingredients in df['ingredients'] for item in ingredients]
+        self.name_words = [word for name in df['name'] for word in str(name).split()]
+        # Step sentences, from the repr'd lists of the CSV
+        self.steps = [
+            sentence.strip()
+            for steps in df['steps']
+            for sentence in re.split(r'(?<=\.)\s+', re.sub(r"\\n|['\"\[\]]", ' ', str(steps)))
+            if len(sentence) > 3
+        ]
+        counts = Counter(item['name'].split(',')[0] for item in self.ingredients if item.get('name'))
+        self.common_ingredients = [name for name, _ in counts.most_common(200)]
+        self.allergy_terms = sorted(set(pd.read_csv(ALLERGIC_DATA_PATH)['Allergy'].dropna()))
+
+
+def synthetic_recipes(n, seed=0, source=None):
+    """A DataFrame of `n` recipes with the columns of the recipes CSV."""
+    source = source or CorpusSource()
+    rng = np.random.default_rng(seed)
+    n_ingredients = rng.integers(4, 16, size=n)
+    n_steps = rng.integers(2, 6, size=n)
+    n_words = rng.integers(2, 5, size=n)
+    ingredient_picks = rng.integers(0, len(source.ingredients), size=int(n_ingredients.sum()))
+    step_picks = rng.integers(0, len(source.steps), size=int(n_steps.sum()))
+    word_picks = rng.integers(0, len(source.name_words), size=int(n_words.sum()))
+    ratings = np.round(rng.uniform(3, 5, size=n), 1)
+
+    rows = []
+    ing_at = step_at = word_at = 0
+    for i in range(n):
+        ingredients = [source.ingredients[j] for j in ingredient_picks[ing_at:ing_at + n_ingredients[i]]]
+        steps = [source.steps[j] for j in step_picks[step_at:step_at + n_steps[i]]]
+        words = [source.name_words[j] for j in word_picks[word_at:word_at + n_words[i]]]
+        ing_at += n_ingredients[i]
+        step_at += n_steps[i]
+        word_at += n_words[i]
+        rows.append({
+            # Names double as keys for update/delete, so keep them unique
+            'name': f"{' '.join(words)} {i}",
+            'review': 'Synthetic benchmark recipe.',
+            'rating': ratings[i],
+            'meta': None,
+            'ingredients': repr(ingredients),
+            'steps': repr(steps),
+            'cooks_note': None,
+            'editors_note': None,
+            'nutrition_facts': None,
+            'url': f'https://example.com/recipes/{i}',
+        })
+    return pd.DataFrame(rows)
+
+
+def synthetic_users(n, seed=0, source=None):
+    """A DataFrame of `n` users with the columns of the users CSV."""
+    source = source or CorpusSource()
+    rng = np.random.default_rng(seed + 1)
+
+    def pick(values, low, high):
+        return ', '.join(rng.choice(values, size=rng.integers(low, high + 1), replace=False))
+
+    rows = []
+    for i in range(n):
+        rows.append({
+            'name': f'user{i}',
+            'date_of_birth': f'01.01.{1950 + i % 60}',
+            'gender': rng.choice(['female', 'male']),
+            'condition': rng.choice(USER_CONDITIONS),
+            'food_allergies': pick(source.allergy_terms + source.common_ingredients[:50], 0, 2),
+            'specific_diet': rng.choice(USER_DIETS),
+            'chronic_illnesses': rng.choice(USER_CONDITIONS),
+            'symptoms': 'none',
+            'food_preferences': pick(source.common_ingredients, 1, 3),
+            'medication': 'none',
+        })
+    return pd.DataFrame(rows)
+
+
+def write_corpus(directory, n_recipes, n_users=1000, seed=0):
+    """
+    Write a synthetic corpus under `directory` (see the module docstring).
+    An existing corpus with the same parameters is reused.
+
+    Returns:
+    dict: The parameters of the corpus.
+    """
+    params = {'n_recipes': n_recipes, 'n_users': n_users, 'seed': seed}
+    marker = os.path.join(directory, 'corpus.json')
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == params:
+                return params
+
+    source = CorpusSource()
+    os.makedirs(os.path.join(directory, os.path.dirname(RES_DATA_PATH)), exist_ok=True)
+    os.makedirs(os.path.join(directory, os.path.dirname(USERS_DATASET_PATH)), exist_ok=True)
+    # Index column like the real file, which was saved with one
+    synthetic_recipes(n_recipes, seed, source).to_csv(os.path.join(directory, RES_DATA_PATH))
+    synthetic_users(n_users, seed, source).to_csv(os.path.join(directory, USERS_DATASET_PATH), index=False)
+    for path in (DIABETES_DATA_PATH, ALLERGIC_DATA_PATH):
+        shutil.copyfile(path, os.path.join(directory, path))
+
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return params
@@ -0,0 +1,136 @@
+"""
+Local stand-in for the Gemini model, so benchmarks measure this service and
+not the network or the model.
+
+`FakeGenerativeModel` has the two `genai.GenerativeModel` methods that
+`GeminiInference` calls, sleeps for a configurable latency, and answers with
+well-formed JSON in the shape each prompt asks for (meal plan, single recipe,
+or a batch of recipes keyed by the ids found in the prompt).
+
+It can also inject faults: a share of calls failing, a share of slow calls
+(tail latency), or a full outage, and it honours `request_options["timeout"]`
+like the real client, by raising TimeoutError.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+
+_RECIPE_ID = re.compile(r'\[recipe id: ([^\]]+)\]')
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeStream:
+    """Async iterator over response chunks, like a streamed Gemini response."""
+
+    def __init__(self, chunks, chunk_latency):
+        self._chunks = iter(chunks)
+        self._chunk_latency = chunk_latency
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+        if self._chunk_latency:
+            await asyncio.sleep(self._chunk_latency)
+        return FakeResponse(chunk)
+
+
+def fake_answer(prompt):
+    """A well-formed answer to one of the service's prompts."""
+    recipe = {
+        "recipe_name": "Benchmark Dish",
+        "ingredients": ["rice", "chicken breast", "broccoli"],
+        "instructions": "Cook the rice. Grill the chicken. Steam the broccoli.",
+    }
+    recipe_ids = _RECIPE_ID.findall(prompt)
+    if recipe_ids:
+        answer = [{"id": recipe_id, **recipe} for recipe_id in recipe_ids]
+    elif '"meal_plan"' in prompt:
+        meal = {"dish_name": "Benchmark Dish", "ingredients": recipe["ingredients"], "portion_size": "1 plate"}
+        answer = {"meal_plan": {"breakfast": meal, "lunch": meal, "dinner": meal}}
+    else:
+        answer = recipe
+    return f"<start>\n{json.dumps(answer, indent=2)}\n<end>"
+
+
+class FakeGenerativeModel:
+    """
+    Parameters:
+    latency (float): Seconds before the (first chunk of the) response.
+    chunk_latency (float): Seconds between streamed chunks.
+    chunk_size (int): Characters per streamed chunk.
+    error_rate (float): Share of calls that raise one of `errors`.
+    slow_rate (float): Share of calls that take `slow_latency` instead of `latency`.
+    slow_latency (float): Latency of the slow calls.
+    down (bool): Every call fails (an outage); can be flipped while running.
+    errors (tuple): Exception classes to inject.
+    seed (int): Seed of the fault injection.
+    """
+
+    def __init__(self, latency=0.5, chunk_latency=0.0, chunk_size=64, error_rate=0.0, slow_rate=0.0,
+                 slow_latency=5.0, down=False, errors=(ConnectionError,), seed=None):
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.chunk_size = chunk_size
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.down = down
+        self.errors = errors
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+
+    def _plan(self, request_options):
+        """(seconds to wait, exception to raise after waiting or None) for one call."""
+        self.calls += 1
+        latency = self.slow_latency if self._random.random() < self.slow_rate else self.latency
+        timeout = (request_options or {}).get("timeout")
+        if timeout is not None and latency > timeout:
+            return timeout, TimeoutError(f"Fake model call timed out after {timeout:.2f}s")
+        if self.down or self._random.random() < self.error_rate:
+            self.failures += 1
+            return latency, self._random.choice(self.errors)("Injected fake model failure")
+        return latency, None
+
+    def _answer(self, prompt_parts):
+        return fake_answer(" ".join(str(part) for part in prompt_parts))
+
+    def generate_content(self, prompt_parts, request_options=None):
+        latency, error = self._plan(request_options)
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        return FakeResponse(self._answer(prompt_parts))
+
+    async def generate_content_async(self, prompt_parts, stream=False, request_options=None):
+        latency, error = self._plan(request_options)
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        text = self._answer(prompt_parts)
+        if not stream:
+            return FakeResponse(text)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        return FakeStream(chunks, self.chunk_latency)
+
+
+def install(*models, **kwargs):
+    """
+    Replace the Gemini model of `GeminiInference` instances with a
+    `FakeGenerativeModel(**kwargs)`.
+    """
+    fake = FakeGenerativeModel(**kwargs)
+    for model in models:
+        model.model = fake
+    return fake
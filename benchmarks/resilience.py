@@ -0,0 +1,134 @@
+"""
+Exercise the Gemini resilience layer (llm/resilience.py) against the fake
+model with injected faults, and report success rates and latencies.
+
+    python -m benchmarks.resilience --requests 200 --output /tmp/resilience.json
+
+Every scenario runs the same requests through a fresh `Resilience` and a
+meal-plan model (whose `default_response` is the fallback), without the
+response cache, both through the async and the sync code path.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fake_llm import install as install_fake_llm  # noqa: E402
+from benchmarks.run import summarize  # noqa: E402
+from llm.resilience import Resilience, RetryPolicy, TokenBucket, CircuitBreaker  # noqa: E402
+
+# name -> (fake model faults, resilience options; rate_limit is (rate, burst))
+SCENARIOS = {
+    'healthy': ({}, {}),
+    'flaky': ({'error_rate': 0.2}, {}),
+    'flaky_no_retries': ({'error_rate': 0.2}, {'retry': RetryPolicy(attempts=1)}),
+    'tail_latency': ({'slow_rate': 0.05, 'slow_latency': 2.0}, {}),
+    'tail_latency_hedged': ({'slow_rate': 0.05, 'slow_latency': 2.0}, {'hedge': True}),
+    'outage': ({'down': True}, {}),
+    # More requests than the limiter admits before their deadline: the rest are rejected at once
+    'overload': ({}, {'rate_limit': (20, 5)}),
+}
+
+
+def make_model(faults, options, latency, timeout, seed):
+    from llm.gemini_for_generating_meal_plan import GeminiForMealPlanGeneration
+
+    options = dict(options)
+    resilience = Resilience(
+        timeout=timeout,
+        retry=options.pop('retry', RetryPolicy(attempts=3, base_delay=0.05, max_delay=0.5)),
+        # Well above the fake's throughput, so only 'overload' is limited
+        rate_limiter=TokenBucket(*options.pop('rate_limit', (1000, 100))),
+        breaker=CircuitBreaker(failure_threshold=5, reset_timeout=5.0),
+        hedge_delay=latency * 3,
+        **options,
+    )
+    model = GeminiForMealPlanGeneration(cache=None, resilience=resilience)
+    fake = install_fake_llm(model, latency=latency, seed=seed, **faults)
+    return model, fake
+
+
+def classify(model, result):
+    if isinstance(result, Exception):
+        return 'error'
+    return 'fallback' if result == model.default_response else 'ok'
+
+
+def run_scenario(faults, options, requests, concurrency, latency, timeout, seed):
+    report = {}
+
+    model, fake = make_model(faults, options, latency, timeout, seed)
+
+    async def one(i, semaphore):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await model.aget_response(f'benchmark prompt {i}')
+            except Exception as e:
+                result = e
+            return classify(model, result), time.perf_counter() - start
+
+    async def run_async():
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(one(i, semaphore) for i in range(requests)))
+
+    report['async'] = summarize_outcomes(asyncio.run(run_async()), fake)
+
+    model, fake = make_model(faults, options, latency, timeout, seed)
+
+    def one_sync(i):
+        start = time.perf_counter()
+        try:
+            result = model.get_response(f'benchmark prompt {i}')
+        except Exception as e:
+            result = e
+        return classify(model, result), time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        report['sync'] = summarize_outcomes(list(pool.map(one_sync, range(requests))), fake)
+    return report
+
+
+def summarize_outcomes(outcomes, fake):
+    kinds = [kind for kind, _ in outcomes]
+    return {
+        'ok': kinds.count('ok'),
+        'fallback': kinds.count('fallback'),
+        'error': kinds.count('error'),
+        'upstream_calls': fake.calls,
+        'upstream_failures': fake.failures,
+        'latency': summarize([seconds for _, seconds in outcomes]),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the LLM resilience layer against a faulty fake model.")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.05, help="Normal fake model latency in seconds.")
+    parser.add_argument('--timeout', type=float, default=1.0, help="Deadline per request in seconds.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--output', default=None, help="Write the report as JSON here.")
+    args = parser.parse_args()
+
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+    report = {}
+    for name in args.scenarios:
+        faults, options = SCENARIOS[name]
+        report[name] = run_scenario(faults, options, args.requests, args.concurrency, args.latency, args.timeout, args.seed)
+        for mode, stats in report[name].items():
+            print(f"{name:<22} {mode:<5} ok {stats['ok']:>4}  fallback {stats['fallback']:>4}  error {stats['error']:>4}  "
+                  f"calls {stats['upstream_calls']:>4}  p50 {stats['latency']['p50_ms']:8.1f} ms  p95 {stats['latency']['p95_ms']:8.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
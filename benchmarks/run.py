@@ -0,0 +1,252 @@
+"""
+Benchmark the recipe storage and the API on synthetic corpora.
+
+For every scale, a synthetic corpus (see benchmarks/corpus.py) is written to
+`<workdir>/<scale>/` and the benchmark runs from there, so `config.py`'s
+relative paths point at it. Gemini is replaced by `FakeGenerativeModel`, so
+endpoint timings include the configured fake latency but no network.
+
+    python -m benchmarks.run --scales 10000 100000 --output benchmarks/results/today.json
+    python -m benchmarks.run --scales 10000 --baseline benchmarks/results/before.json
+
+Timings are in milliseconds. With --baseline, every p50 that got slower than
+the baseline by more than --tolerance is reported and the exit code is 1.
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.corpus import write_corpus  # noqa: E402
+from benchmarks.fake_llm import install as install_fake_llm  # noqa: E402
+from food_databases.config import RES_CACHE_PATH, RES_INDEX_PATH, RES_JOURNAL_PATH  # noqa: E402
+from config import USERS_DB_PATH, GEMINI_CACHE_PATH, USERS_DATASET_PATH, MEAL_PLANS_DB_PATH  # noqa: E402
+
+DEFAULT_SCALES = [10_000, 100_000]
+
+
+def summarize(timings):
+    """Summary statistics of a list of durations in seconds, in milliseconds."""
+    ms = np.asarray(timings) * 1000
+    return {
+        'n': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def timed(fn, *args, **kwargs):
+    """(result, seconds) of one call."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def clean_state():
+    """Remove what earlier runs derived from the corpus (caches, journals, databases)."""
+    for pattern in (RES_CACHE_PATH, f'{RES_INDEX_PATH}*', f'{RES_JOURNAL_PATH}*', f'{USERS_DB_PATH}*', f'{GEMINI_CACHE_PATH}*', f'{MEAL_PLANS_DB_PATH}*'):
+        for path in glob.glob(pattern):
+            os.remove(path)
+
+
+def user_queries(n, seed):
+    """(positive, negative, conditions) filter arguments of `n` synthetic users."""
+    import pandas as pd
+    from food_databases.scoring import health_conditions
+    from food_databases.search import split_terms
+
+    users = pd.read_csv(USERS_DATASET_PATH).fillna('')
+    users = users.sample(n=min(n, len(users)), random_state=seed)
+    return [
+        (split_terms(user.food_preferences), split_terms(user.food_allergies), health_conditions(user.condition, user.chronic_illnesses))
+        for user in users.itertuples()
+    ]
+
+
+def bench_storage(repeat, seed):
+    from food_databases.management import RecipesStorage
+
+    results = {}
+    storage, seconds = timed(RecipesStorage)
+    results['init_cold'] = summarize([seconds])
+    # Second load hits the Arrow cache built by the first
+    storage, seconds = timed(RecipesStorage)
+    results['init_warm'] = summarize([seconds])
+    results['rows'] = len(storage.index)
+
+    queries = user_queries(repeat, seed)
+    for op, call in {
+        'filter': lambda pos, neg, cond: storage.filter(pos, neg, conditions=cond),
+        'top_k': lambda pos, neg, cond: storage.top_k(pos, neg, 33, conditions=cond),
+        'search': lambda pos, neg, cond: storage.search(' '.join(pos), 10),
+    }.items():
+        results[op] = summarize([timed(call, *query)[1] for query in queries])
+
+    names = [f'benchmark recipe {seed} {i}' for i in range(repeat)]
+    recipe = {'ingredients': ['chicken breast', 'onion, chopped', 'salt'], 'steps': ['Cook everything.']}
+    results['add'] = summarize([timed(storage.add, {'name': name, **recipe})[1] for name in names])
+    results['update'] = summarize([timed(storage.update, name, {'steps': ['Cook it slowly.']})[1] for name in names])
+    results['delete'] = summarize([timed(storage.delete, name)[1] for name in names])
+    # Hot reload: a full rebuild from disk while the old version keeps serving
+    results['reload'] = summarize([timed(storage.reload)[1]])
+    return results
+
+
+def bench_endpoints(repeat, seed, latency):
+    from fastapi.testclient import TestClient
+
+    # A fresh `main` builds its storages from the corpus in the working directory
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+    sys.modules.pop('main', None)
+    start = time.perf_counter()
+    import main
+    results = {'import_main': summarize([time.perf_counter() - start])}
+    install_fake_llm(main.meal_plan_generator, main.gemini_recipes, latency=latency)
+    client = TestClient(main.app)
+
+    rng = random.Random(seed)
+    users = [user['name'] for user in client.get('/users/').json()]
+    queries = user_queries(repeat, seed)
+    new_user = {'date_of_birth': '01.01.1990', 'food_preferences': 'rice', 'food_allergies': 'peanuts'}
+    new_recipe = {'ingredients': ['rice', 'water'], 'steps': ['Boil the rice.']}
+
+    requests = {
+        'GET /users/': lambda i: client.get('/users/', params={'limit': 50}),
+        'GET /users/{name}': lambda i: client.get(f'/users/{rng.choice(users)}'),
+        'POST /users/': lambda i: client.post('/users/', json={'name': f'bench{seed}-{i}', **new_user}),
+        'PUT /users/{name}': lambda i: client.put(f'/users/bench{seed}-{i}', json={'name': f'bench{seed}-{i}', **new_user, 'specific_diet': 'keto'}),
+        'DELETE /users/{name}': lambda i: client.delete(f'/users/bench{seed}-{i}'),
+        'POST /recipes/': lambda i: client.post('/recipes/', json={'name': f'bench{seed}-{i}', **new_recipe}),
+        'PUT /recipes/{name}': lambda i: client.put(f'/recipes/bench{seed}-{i}', json={'name': f'bench{seed}-{i}', **new_recipe, 'rating': 4.0}),
+        'DELETE /recipes/{name}': lambda i: client.delete(f'/recipes/bench{seed}-{i}'),
+        'POST /recipes/filter/': lambda i: client.post('/recipes/filter/', json={'positive_products': queries[i % len(queries)][0], 'negative_products': queries[i % len(queries)][1]}),
+        'GET /recipes/search': lambda i: client.get('/recipes/search', params={'q': ' '.join(queries[i % len(queries)][0])}),
+        'GET /llm/cache': lambda i: client.get('/llm/cache'),
+        # Different users every time, so the response cache doesn't hide the model
+        'GET /users/{name}/meal_plan': lambda i: client.get(f'/users/{users[i % len(users)]}/meal_plan'),
+        # The same users again: now served from the meal plan store
+        'GET /users/{name}/meal_plan (stored)': lambda i: client.get(f'/users/{users[i % len(users)]}/meal_plan'),
+        'GET /users/{name}/meal_plan/stream': lambda i: client.get(f'/users/{users[(i + repeat) % len(users)]}/meal_plan/stream'),
+        'GET /users/{name}/recipes': lambda i: client.get(f'/users/{users[(i + 2 * repeat) % len(users)]}/recipes'),
+        # The same users again: candidates from the candidate cache, answers from the response cache
+        'GET /users/{name}/recipes (cached)': lambda i: client.get(f'/users/{users[(i + 2 * repeat) % len(users)]}/recipes'),
+        'GET /users/{name}/recipes/stream': lambda i: client.get(f'/users/{users[(i + 3 * repeat) % len(users)]}/recipes/stream'),
+    }
+    tokens_before = prompt_tokens(main.meal_plan_generator, main.gemini_recipes)
+    for endpoint, request in requests.items():
+        timings = []
+        for i in range(repeat):
+            response, seconds = timed(request, i)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{endpoint} failed with {response.status_code}: {response.text[:200]}')
+            timings.append(seconds)
+        results[endpoint] = summarize(timings)
+    # Estimated prompt tokens sent over the run, and without trimming (not timings: see `run`)
+    tokens = prompt_tokens(main.meal_plan_generator, main.gemini_recipes)
+    return results, {key: value - tokens_before[key] for key, value in tokens.items()}
+
+
+def prompt_tokens(*models):
+    """'<task> <sent|full>' -> estimated prompt tokens counted so far (see `GeminiInference.record_prompt_tokens`)."""
+    from monitoring.metrics import LLM_PROMPT_TOKENS
+
+    return {
+        f'{type(model).__name__} {prompt}': LLM_PROMPT_TOKENS.value(model=model.model_name, task=type(model).__name__, prompt=prompt)
+        for model in models for prompt in ('sent', 'full')
+    }
+
+
+def run(scales, workdir, n_users, repeat, latency, seed):
+    report = {
+        'meta': {
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'commit': subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip() or None,
+            'n_users': n_users,
+            'repeat': repeat,
+            'llm_latency_s': latency,
+            'seed': seed,
+        },
+        'results': {},
+    }
+    cwd = os.getcwd()
+    for scale in scales:
+        directory = os.path.abspath(os.path.join(workdir, str(scale)))
+        print(f'[{scale}] writing corpus to {directory}', file=sys.stderr)
+        os.chdir(REPO_ROOT)
+        corpus, seconds = timed(write_corpus, directory, scale, n_users, seed)
+        try:
+            os.chdir(directory)
+            clean_state()
+            print(f'[{scale}] storage', file=sys.stderr)
+            storage = bench_storage(repeat, seed)
+            print(f'[{scale}] endpoints', file=sys.stderr)
+            endpoints, tokens = bench_endpoints(repeat, seed, latency)
+        finally:
+            os.chdir(cwd)
+        report['results'][str(scale)] = {'corpus': corpus, 'storage': storage, 'endpoints': endpoints, 'prompt_tokens': tokens}
+    return report
+
+
+def regressions(report, baseline, tolerance):
+    """(scale, group, op, baseline p50, p50) for every op slower than the baseline by more than `tolerance`."""
+    found = []
+    for scale, groups in report['results'].items():
+        for group in ('storage', 'endpoints'):
+            for op, stats in groups[group].items():
+                old = baseline.get('results', {}).get(scale, {}).get(group, {}).get(op)
+                if isinstance(stats, dict) and isinstance(old, dict) and stats['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+                    found.append((scale, group, op, old['p50_ms'], stats['p50_ms']))
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark RecipesStorage and the API on synthetic corpora.")
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES, help="Recipe counts, e.g. 10000 100000 1000000.")
+    parser.add_argument('--users', type=int, default=1000, help="Synthetic users per corpus.")
+    parser.add_argument('--repeat', type=int, default=20, help="Calls per timed operation.")
+    parser.add_argument('--latency', type=float, default=0.05, help="Fake LLM latency in seconds.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=os.path.join(REPO_ROOT, 'benchmarks', 'corpora'))
+    parser.add_argument('--output', default=None, help="JSON report path (default: benchmarks/results/<time>.json).")
+    parser.add_argument('--baseline', default=None, help="Earlier JSON report to compare against.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed p50 slowdown against the baseline (0.2 = 20%%).")
+    args = parser.parse_args()
+
+    report = run(args.scales, args.workdir, args.users, args.repeat, args.latency, args.seed)
+
+    output = args.output or os.path.join(REPO_ROOT, 'benchmarks', 'results', f"{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+
+    for scale, groups in report['results'].items():
+        for group in ('storage', 'endpoints'):
+            for op, stats in groups[group].items():
+                if isinstance(stats, dict):
+                    print(f"{scale:>8} {op:<36} p50 {stats['p50_ms']:9.2f} ms  p95 {stats['p95_ms']:9.2f} ms")
+        for key, value in groups.get('prompt_tokens', {}).items():
+            print(f"{scale:>8} prompt tokens {key:<37} {value:9d}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for scale, group, op, old, new in found:
+            print(f"REGRESSION {scale} {op}: p50 {old:.2f} ms -> {new:.2f} ms")
+        sys.exit(1 if found else 0)
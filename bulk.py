@@ -0,0 +1,205 @@
+"""
+NDJSON bulk import and export of recipes and users.
+
+Imports are parsed incrementally, validated line by line with the API models
+and stored a batch at a time (one journal flush, or one transaction, per
+batch); imported recipes are indexed once, at the end (see
+`food_databases.management.RecipeImport`). Exports are generated a chunk of
+rows at a time.
+
+    python -m bulk import recipes recipes.ndjson
+    python -m bulk export users users.ndjson      # "-" for stdin/stdout
+
+The recipe CLI writes the recipe journal itself: run it while the API is
+stopped, or use the /admin/recipes/import endpoint instead.
+"""
+import ast
+import json
+import math
+
+from config import BULK_BATCH_SIZE
+from models import Recipe, User
+
+
+class NdjsonImport:
+    """
+    Incremental NDJSON parser for bulk imports: feed it the input as it
+    arrives and it returns the batches of validated records it completed.
+
+    Invalid lines (bad JSON or failing `model` validation) are skipped and
+    counted; the first `max_errors` are kept for the report.
+    """
+
+    def __init__(self, model, batch_size=BULK_BATCH_SIZE, max_errors=100):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.max_errors = max_errors
+        self.lines = 0
+        self.valid = 0
+        self.invalid = 0
+        self.errors = []
+        self._buffer = b''
+        self._batch = []
+
+    def feed(self, data):
+        """Parse a chunk of the input (bytes); returns the batches it completed."""
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        return self._parse(lines)
+
+    def close(self):
+        """Parse what is left of the input; returns the last batches."""
+        # Input ending with a newline leaves nothing to parse
+        lines, self._buffer = [self._buffer] if self._buffer else [], b''
+        batches = self._parse(lines)
+        if self._batch:
+            batches.append(self._batch)
+            self._batch = []
+        return batches
+
+    def _parse(self, lines):
+        batches = []
+        for line in lines:
+            self.lines += 1
+            if not line.strip():
+                continue
+            try:
+                record = self.model(**json.loads(line)).dict()
+            except (ValueError, TypeError) as e:
+                # JSONDecodeError and ValidationError are ValueErrors; a line
+                # that isn't a JSON object is a TypeError
+                self.invalid += 1
+                if len(self.errors) < self.max_errors:
+                    self.errors.append({'line': self.lines, 'error': str(e)[:500]})
+                continue
+            self.valid += 1
+            self._batch.append(record)
+            if len(self._batch) >= self.batch_size:
+                batches.append(self._batch)
+                self._batch = []
+        return batches
+
+    def report(self):
+        return {'lines': self.lines, 'valid': self.valid, 'invalid': self.invalid, 'errors': self.errors}
+
+
+def run_import(chunks, model, apply, batch_size=BULK_BATCH_SIZE):
+    """
+    Import NDJSON from an iterable of byte chunks.
+
+    Parameters:
+    apply (callable): Stores a batch of validated records and returns how many it stored.
+
+    Returns:
+    dict: The parser's report plus `imported`.
+    """
+    parser = NdjsonImport(model, batch_size)
+    imported = 0
+    for chunk in chunks:
+        for batch in parser.feed(chunk):
+            imported += apply(batch)
+    for batch in parser.close():
+        imported += apply(batch)
+    return {'imported': imported, **parser.report()}
+
+
+def _missing_as_none(value):
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def _steps(value):
+    # The CSV stores steps as the text of a Python list
+    if isinstance(value, str):
+        try:
+            value = ast.literal_eval(value) if value.startswith('[') else [value]
+        except (ValueError, SyntaxError):
+            value = [value]
+    return [str(step) for step in value or []]
+
+
+def recipe_records(snapshot, chunk_size=BULK_BATCH_SIZE):
+    """
+    Every recipe of a snapshot as a `Recipe`-shaped dict, in label order,
+    reading `chunk_size` rows at a time (the snapshot's `df` is not built).
+    """
+    fields = list(Recipe.schema()['properties'])
+    labels = snapshot.labels()
+    for start in range(0, len(labels), chunk_size):
+        rows = snapshot.rows(labels[start:start + chunk_size].tolist())
+        for row in rows.to_dict(orient='records'):
+            record = {field: _missing_as_none(row.get(field)) for field in fields}
+            record['steps'] = _steps(record['steps'])
+            yield record
+
+
+def user_records(repository, page_size=BULK_BATCH_SIZE):
+    """Every user of a repository, ordered by name, a page at a time."""
+    cursor = None
+    while True:
+        users, cursor = repository.page(page_size, cursor)
+        yield from users
+        if cursor is None:
+            return
+
+
+def ndjson_lines(records):
+    """Encode records as NDJSON lines."""
+    for record in records:
+        yield json.dumps(record, default=str, ensure_ascii=False) + '\n'
+
+
+def _read_chunks(f, size=1 << 16):
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+if __name__ == "__main__":
+    import argparse
+    import contextlib
+    import sys
+    import warnings
+
+    from config import USERS_BACKEND, USERS_DATASET_PATH, USERS_DB_PATH
+    from food_databases.management import RecipesStorage
+    from user_databases.management import create_user_repository
+
+    parser = argparse.ArgumentParser(description="Bulk import or export recipes and users as NDJSON.")
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('kind', choices=['recipes', 'users'])
+    parser.add_argument('path', help='NDJSON file, or "-" for stdin/stdout.')
+    parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE)
+    args = parser.parse_args()
+    # `.dict()` (as in main.py) is deprecated in pydantic 2; don't warn once per record
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    if args.kind == 'recipes':
+        # Keep stdout for the export
+        with contextlib.redirect_stdout(sys.stderr):
+            storage = RecipesStorage()
+        model = Recipe
+    else:
+        storage = create_user_repository(USERS_BACKEND, User.schema()['properties'].keys(), USERS_DATASET_PATH, USERS_DB_PATH)
+        model, apply = User, storage.create_many
+
+    if args.action == 'import':
+        if args.kind == 'recipes':
+            recipe_import = storage.begin_import()
+            apply = recipe_import.add
+        source = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+        try:
+            with source:
+                report = run_import(_read_chunks(source), model, apply, args.batch_size)
+        finally:
+            if args.kind == 'recipes':
+                # Index the imported recipes and fold them into the CSV
+                recipe_import.finish()
+                storage.compact()
+        print(json.dumps(report, indent=2), file=sys.stderr)
+    else:
+        records = recipe_records(storage.snapshot, args.batch_size) if args.kind == 'recipes' else user_records(storage, args.batch_size)
+        target = sys.stdout if args.path == '-' else open(args.path, 'w', encoding='utf-8')
+        with target:
+            target.writelines(ndjson_lines(records))
@@ -1,2 +1,39 @@
 USERS_DATASET_PATH = 'app/users.csv'
-MAX_RECEPIES_AT_REQUEST = 33
\ No newline at end of file
+# User store backend: 'sqlite' (indexed, imports USERS_DATASET_PATH once) or 'csv' (the original file)
+USERS_BACKEND = 'sqlite'
+USERS_DB_PATH = 'app/users.db'
+# Users kept in the SQLite store's in-process read cache (least recently used are evicted)
+USERS_CACHE_SIZE = 10000
+# Precomputed meal plans (python -m user_databases.meal_plans, or POST /admin/meal_plans/precompute)
+MEAL_PLANS_DB_PATH = 'app/meal_plans.db'
+MEAL_PLAN_PRECOMPUTE_WORKERS = 8
+MAX_RECEPIES_AT_REQUEST = 33
+# Records per batch of the NDJSON bulk import/export (see bulk.py)
+BULK_BATCH_SIZE = 1000
+# Users whose ranked candidate recipes are kept between requests (see food_databases/candidates.py)
+CANDIDATE_CACHE_SIZE = 10000
+PERSONALIZED_RECEPIES_AT_REQUEST = 3
+# Max concurrent Gemini requests per model instance (async endpoints)
+GEMINI_MAX_CONCURRENCY = 8
+# Token budget of each user profile or recipe rendered into a Gemini prompt (see llm/prompting.py)
+GEMINI_PROMPT_TOKENS = 512
+# Gemini call resilience (see llm/resilience.py), shared by both models
+GEMINI_TIMEOUT = 30.0  # seconds per request, retries included
+GEMINI_RETRIES = 3  # attempts
+GEMINI_BACKOFF_BASE = 0.5  # seconds, doubled per retry, full jitter
+GEMINI_BACKOFF_MAX = 8.0  # seconds
+GEMINI_RATE_LIMIT = 10.0  # requests per second; 0 disables
+GEMINI_RATE_BURST = 20
+GEMINI_BREAKER_FAILURES = 5  # consecutive failures that open the circuit
+GEMINI_BREAKER_RESET = 30.0  # seconds before a probe call
+GEMINI_HEDGE = False  # send a second call when the first is slower than the recent p95
+GEMINI_HEDGE_QUANTILE = 0.95
+# Gemini response cache (memory LRU + SQLite on disk)
+GEMINI_CACHE_PATH = 'app/gemini_cache.db'
+GEMINI_CACHE_MEMORY_SIZE = 1024
+GEMINI_CACHE_TTL = 7 * 24 * 3600  # seconds
+GEMINI_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Per-request sampling profiler: send `X-Profile: 1` (or ?profile=1) to profile one request
+PROFILING_ENABLED = False
+PROFILING_INTERVAL = 0.005  # seconds between samples
+PROFILES_DIR = 'app/profiles'
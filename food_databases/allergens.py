@@ -0,0 +1,233 @@
+import copy
+from collections import deque
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from .config import ALLERGIC_DATA_PATH
+from .index import ingredient_names
+from .scoring import food_tokens
+
+# Words that only say what kind of reaction a term is about
+_REACTION_WORDS = {'allergy', 'allergie', 'allergic', 'intolerance', 'intolerant', 'syndrome', 'sensitivity'}
+
+
+def _phrase(text):
+    return ' '.join(food_tokens(text))
+
+
+class TokenAutomaton:
+    """
+    Aho-Corasick automaton over word tokens.
+
+    Patterns are token sequences (e.g. ('black', 'eyed', 'bean')), so matches
+    always fall on word boundaries, and one pass over a text's tokens reports
+    every pattern it contains.
+    """
+
+    def __init__(self, patterns):
+        # patterns: {token tuple: pattern id}
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+
+        for tokens, pattern_id in patterns.items():
+            state = 0
+            for token in tokens:
+                if token not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][token] = len(self.goto) - 1
+                state = self.goto[state][token]
+            self.output[state].add(pattern_id)
+
+        # Breadth-first fill of the failure links
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(token, 0)
+                self.output[child] |= self.output[self.fail[child]]
+
+    def scan(self, tokens):
+        """Ids of the patterns found in a sequence of tokens."""
+        found = set()
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for token in tokens:
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+class AllergenTable:
+    """
+    Expands allergy terms into concrete foods through allergic-products.csv.
+
+    Every Class, Type, Group, Food and Allergy value is a key (Allergy values
+    also without words like "allergy"/"intolerance", and split on "/"), so
+    "Nut Allergy", "stone fruit" or "Apples" all resolve to the foods of the
+    table they cover. Each food is one bit of the per-recipe masks.
+    """
+
+    def __init__(self, path=ALLERGIC_DATA_PATH):
+        df = pd.read_csv(path).fillna('')
+        self.foods = sorted({_phrase(food) for food in df['Food'] if _phrase(food)})
+        self.bits = {food: bit for bit, food in enumerate(self.foods)}
+        self.words = max(1, (len(self.foods) + 63) // 64)
+
+        self.foods_by_key = {}
+        for _, row in df.iterrows():
+            food = _phrase(row['Food'])
+            if not food:
+                continue
+            keys = {_phrase(row[column]) for column in ('Class', 'Type', 'Group', 'Food')}
+            for allergy in str(row['Allergy']).split('/'):
+                keys.add(_phrase(allergy))
+                keys.add(' '.join(token for token in food_tokens(allergy) if token not in _REACTION_WORDS))
+            for key in keys - {''}:
+                self.foods_by_key.setdefault(key, set()).add(food)
+
+        self.automaton = TokenAutomaton({tuple(food.split()): self.bits[food] for food in self.foods})
+
+    def expand(self, term):
+        """The foods of the table an allergy term covers (empty if it names none)."""
+        key = _phrase(term)
+        foods = self.foods_by_key.get(key)
+        if foods is None:
+            foods = self.foods_by_key.get(' '.join(token for token in key.split() if token not in _REACTION_WORDS), set())
+        return foods
+
+    def mask(self, bits):
+        """Pack bit numbers into a uint64 word array."""
+        words = np.zeros(self.words, dtype=np.uint64)
+        for bit in bits:
+            words[bit // 64] |= np.uint64(1 << (bit % 64))
+        return words
+
+    @lru_cache(maxsize=4096)
+    def resolve(self, terms):
+        """
+        Mask of the foods a frozenset of allergy terms expands to, or None if
+        none of the terms is known to the table. Cached per set of terms.
+        """
+        bits = {self.bits[food] for term in terms for food in self.expand(term)}
+        return self.mask(bits) if bits else None
+
+
+class AllergenMasks:
+    """
+    Which allergen-table foods each recipe mentions, anywhere in its name,
+    ingredient names or steps, as a uint64 bitmask row per label. Excluding
+    recipes for a user's allergies is then a vectorized AND over the
+    candidates' rows.
+
+    Shared masks are never modified: `with_changes` returns new masks that
+    keep the array and look the changed rows up in `overrides` first.
+    """
+
+    def __init__(self, table=None):
+        self.table = table if table is not None else AllergenTable()
+        self.masks = np.zeros((0, self.table.words), dtype=np.uint64)
+        # label -> mask of the changed rows (zero for deleted ones), also as
+        # sorted label / mask arrays for vectorized lookups
+        self.overrides = {}
+        self._override_labels = np.zeros(0, dtype=np.int64)
+        self._override_masks = np.zeros((0, self.table.words), dtype=np.uint64)
+
+    @classmethod
+    def from_frame(cls, df, table=None):
+        """Masks for every recipe of a DataFrame keyed by row label."""
+        masks = cls(table)
+        if len(df):
+            masks._reserve(int(df.index.max()))
+        for label, name, ingredients, steps in zip(df.index, df['name'], df['ingredients'], df['steps']):
+            masks.add(label, {'name': name, 'ingredients': ingredients, 'steps': steps})
+        return masks
+
+    def to_arrays(self):
+        """The mask rows, the overrides merged in (see `from_arrays`)."""
+        return {'masks': self.compacted().masks}
+
+    @classmethod
+    def from_arrays(cls, arrays, table=None):
+        """The masks `to_arrays` returned."""
+        masks = cls(table)
+        masks.masks = arrays['masks']
+        return masks
+
+    def _reserve(self, label):
+        size = len(self.masks)
+        if label < size:
+            return
+        grown = np.zeros((max(label + 1, size * 2, 64), self.table.words), dtype=np.uint64)
+        grown[:size] = self.masks
+        self.masks = grown
+
+    def scan(self, recipe):
+        """The mask of the foods a recipe mentions in its name, ingredient names or steps."""
+        text = ' '.join([
+            str(recipe.get('name') or ''),
+            ' '.join(ingredient_names(recipe.get('ingredients')) or []),
+            str(recipe.get('steps') or ''),
+        ])
+        return self.table.mask(self.table.automaton.scan(food_tokens(text)))
+
+    def add(self, label, recipe):
+        """Scan a recipe's text once and store its mask under its label."""
+        self._reserve(label)
+        self.masks[label] = self.scan(recipe)
+
+    def remove(self, label):
+        if label < len(self.masks):
+            self.masks[label] = 0
+
+    def with_changes(self, changes):
+        """
+        New masks with rows replaced, leaving these untouched.
+
+        Parameters:
+        changes (dict): Row label -> recipe dict, or None for a deleted row.
+        """
+        overrides = dict(self.overrides)
+        for label, recipe in changes.items():
+            overrides[label] = self.scan(recipe) if recipe is not None else self.table.mask(())
+
+        masks = copy.copy(self)
+        masks.overrides = overrides
+        masks._override_labels = np.array(sorted(overrides), dtype=np.int64)
+        masks._override_masks = np.array([overrides[label] for label in masks._override_labels.tolist()], dtype=np.uint64).reshape(-1, self.table.words)
+        return masks
+
+    def compacted(self):
+        """The same masks as a plain array without overrides (a full copy)."""
+        if not self.overrides:
+            return self
+        masks = type(self)(self.table)
+        masks.masks = self.masks.copy()
+        masks._reserve(int(self._override_labels[-1]))
+        masks.masks[self._override_labels] = self._override_masks
+        return masks
+
+    def mentions(self, labels, mask):
+        """Boolean array: which of the labels mention any food of the mask."""
+        labels = np.asarray(labels, dtype=np.int64)
+        if not self.overrides:
+            return (self.masks[labels] & mask).any(axis=1)
+
+        rows = np.zeros((len(labels), self.table.words), dtype=np.uint64)
+        inside = labels < len(self.masks)
+        rows[inside] = self.masks[labels[inside]]
+        positions = np.minimum(np.searchsorted(self._override_labels, labels), len(self._override_labels) - 1)
+        changed = self._override_labels[positions] == labels
+        rows[changed] = self._override_masks[positions[changed]]
+        return (rows & mask).any(axis=1)
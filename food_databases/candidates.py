@@ -0,0 +1,193 @@
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+from .config import FILTER_MIN_SIMILARITY
+from .index import ingredient_names
+from .relevance import document_terms, query_terms
+from .scoring import food_tokens
+from .search import GENERIC_TOKENS, trigrams
+
+
+def watched_tokens(terms):
+    """
+    The tokens a recipe's ingredients must (fuzzily) contain to match any of
+    the positive `terms` of `RecipesStorage.filter`, or None when any recipe
+    could match (no terms, or a term without tokens).
+    """
+    tokens = set()
+    for term in terms:
+        term_tokens = food_tokens(term)
+        if not term_tokens:
+            return None
+        # The tokens `SearchIndex.rows_matching` requires; an exact name match has them too
+        tokens.update([token for token in term_tokens if token not in GENERIC_TOKENS] or term_tokens)
+    return tokens or None
+
+
+class CandidateCache:
+    """
+    A materialized view of each user's ranked candidate recipes, as row
+    labels, so repeated requests skip filtering.
+
+    An entry is kept until something that could change it happens: the user
+    record changes (`invalidate`, or a new `version` of it), or a recipe
+    change touches it. The storage reports every change (see
+    `RecipesStorage.subscribe`), and an entry is dropped when a changed
+    recipe was one of its candidates, or when the old or new row has an
+    ingredient token similar to one of the user's positive products (it may
+    enter or leave the ranking) or a term of the user's relevance profile
+    (its BM25 document frequency changes). Entries that could take any
+    recipe (users without positive products, or lists topped up with
+    recipes that merely avoid the allergies) are dropped on every added or
+    updated recipe. A reload drops every entry.
+    """
+
+    def __init__(self, storage, size=10000):
+        self.storage = storage
+        self.size = size
+        self._lock = threading.Lock()
+        # name -> (version, labels)
+        self._entries = OrderedDict()
+        # label -> names of the entries listing it
+        self._shown = defaultdict(set)
+        # token -> names of the entries watching it, and trigram -> watched tokens
+        self._watchers = defaultdict(set)
+        self._trigrams = defaultdict(set)
+        # name -> watched tokens, and the names any new recipe invalidates
+        self._watching = {}
+        self._broad = set()
+        # BM25 term -> names of the entries ranked by a profile with it, and name -> terms
+        self._term_watchers = defaultdict(set)
+        self._terms = {}
+        # The last snapshot version the cache was told about
+        self._seen = storage.version
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        storage.subscribe(self.recipes_changed)
+
+    def get(self, name, version, positive_terms, compute, profile=None):
+        """
+        The candidate recipes of a user, computed on a miss.
+
+        Parameters:
+        name (str): The user name.
+        version (str): Hash of the user record (see `profile_version`).
+        positive_terms (list): The user's positive products, as passed to `filter`.
+        compute (callable): Returns (DataFrame of the ranked recipes, whether it was topped up).
+        profile (str): The relevance profile the recipes are ranked by, if any.
+
+        Returns:
+        DataFrame: The candidate recipes, best first.
+        """
+        snapshot = self.storage.snapshot
+        with self._lock:
+            entry = self._entries.get(name)
+            # Entries are only current for the versions the cache has been told about
+            if entry is not None and entry[0] == version and self._seen == snapshot.version:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return snapshot.rows(entry[1])
+            self.misses += 1
+
+        recipes, topped_up = compute()
+        with self._lock:
+            # Only keep a result computed from a version with no change since
+            if self._seen == snapshot.version and self.storage.version == snapshot.version:
+                self._drop(name)
+                tokens = None if topped_up else watched_tokens(positive_terms)
+                self._put(name, version, list(recipes.index), tokens, set(query_terms(profile)))
+        return recipes
+
+    def invalidate(self, name):
+        """Drop a user's entry, e.g. after the user record changed."""
+        with self._lock:
+            self._drop(name)
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._entries):
+                self._drop(name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _put(self, name, version, labels, tokens, terms):
+        # Under self._lock
+        self._entries[name] = (version, labels)
+        for label in labels:
+            self._shown[label].add(name)
+        self._terms[name] = terms
+        for term in terms:
+            self._term_watchers[term].add(name)
+        if tokens is None:
+            self._broad.add(name)
+        else:
+            self._watching[name] = tokens
+            for token in tokens:
+                if not self._watchers[token]:
+                    for trigram in trigrams(token):
+                        self._trigrams[trigram].add(token)
+                self._watchers[token].add(name)
+        while len(self._entries) > self.size:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, name):
+        # Under self._lock
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return
+        for label in entry[1]:
+            self._shown[label].discard(name)
+            if not self._shown[label]:
+                del self._shown[label]
+        self._broad.discard(name)
+        for term in self._terms.pop(name, ()):
+            self._term_watchers[term].discard(name)
+            if not self._term_watchers[term]:
+                del self._term_watchers[term]
+        for token in self._watching.pop(name, ()):
+            self._watchers[token].discard(name)
+            if not self._watchers[token]:
+                del self._watchers[token]
+                for trigram in trigrams(token):
+                    self._trigrams[trigram].discard(token)
+                    if not self._trigrams[trigram]:
+                        del self._trigrams[trigram]
+
+    def _watchers_of(self, recipe):
+        # Names watching a token similar to one of the recipe's ingredient
+        # tokens, or one of the recipe's BM25 terms
+        names = set()
+        if self._term_watchers:
+            for term in document_terms(recipe):
+                names |= self._term_watchers.get(term, set())
+        for ingredient in ingredient_names(recipe.get('ingredients')) or []:
+            for token in food_tokens(ingredient):
+                grams = trigrams(token)
+                shared = Counter()
+                for trigram in grams:
+                    shared.update(self._trigrams.get(trigram, ()))
+                for candidate, count in shared.items():
+                    if 2 * count / (len(grams) + len(trigrams(candidate))) >= FILTER_MIN_SIMILARITY:
+                        names |= self._watchers[candidate]
+        return names
+
+    def recipes_changed(self, previous, snapshot, changes):
+        """Drop the entries a recipe change may affect (a `RecipesStorage.subscribe` listener)."""
+        with self._lock:
+            self._seen = snapshot.version
+            if changes is None:
+                stale = set(self._entries)
+            else:
+                stale = set()
+                for label, row in changes.items():
+                    stale |= self._shown.get(label, set())
+                    if row is not None:
+                        stale |= self._broad | self._watchers_of(row)
+                    old = previous.get(label)
+                    if old is not None:
+                        stale |= self._watchers_of(old)
+            for name in stale:
+                self._drop(name)
+            self.invalidations += len(stale)
@@ -1,4 +1,17 @@
 RES_DATA_PATH = 'food_databases/recepies.csv'
+# Columnar cache compiled from RES_DATA_PATH (see food_databases/cache.py)
+RES_CACHE_PATH = 'food_databases/recepies.arrow'
+# Indexes built from RES_DATA_PATH, saved so a restart doesn't rebuild them (see RecipesSnapshot.save)
+RES_INDEX_PATH = 'food_databases/recepies.indexes.npz'
+# Write-ahead journal of recipe mutations, folded into RES_DATA_PATH by compaction
+RES_JOURNAL_PATH = 'food_databases/recepies.journal'
+JOURNAL_COMPACT_THRESHOLD = 1000  # journal records
+# Rows a bulk import keeps in memory before a compaction writes them to RES_DATA_PATH
+IMPORT_FLUSH_ROWS = 20000
 
-DIABETES_DATA_PATH = 'food-databases/diabetes-food-scoring.csv'
-ALLERGIC_DATA_PATH = 'food-databases/allergic-products.csv'
+DIABETES_DATA_PATH = 'food_databases/diabetes-food-scoring.csv'
+ALLERGIC_DATA_PATH = 'food_databases/allergic-products.csv'
+
+# Trigram similarity (0-1) a token needs to count as a fuzzy match
+SEARCH_MIN_SIMILARITY = 0.5  # /recipes/search
+FILTER_MIN_SIMILARITY = 0.8  # positive/negative products of `filter`
@@ -0,0 +1,266 @@
+import copy
+import itertools
+
+import numpy as np
+
+
+def ingredient_names(ingredients):
+    """
+    Return the lowercased ingredient names of a recipe, or None when the
+    ingredients cell is malformed (not a list of dicts with a string "name").
+
+    Parameters:
+    ingredients (list): The parsed ingredients of a recipe.
+    """
+    try:
+        return [item["name"].lower() for item in ingredients]
+    except (TypeError, KeyError, AttributeError):
+        return None
+
+
+def union(arrays):
+    """Sorted union of label arrays, through a bitmap over the label range."""
+    arrays = [array for array in arrays if len(array)]
+    if not arrays:
+        return np.zeros(0, dtype=np.int64)
+    seen = np.zeros(max(int(array.max()) for array in arrays) + 1, dtype=bool)
+    for array in arrays:
+        seen[array] = True
+    return np.flatnonzero(seen).astype(np.int64, copy=False)
+
+
+def sparse_columns(names, columns, labels):
+    """
+    Compressed sparse columns of (column, label) entries, e.g. one entry per
+    ingredient of every recipe.
+
+    Parameters:
+    names (list): The name of each column, e.g. ingredient names.
+    columns (ndarray): Column of each entry.
+    labels (ndarray): Row label of each entry.
+
+    Returns:
+    tuple: (name -> column, indptr, labels, counts): the distinct labels of
+    column `c` are `labels[indptr[c]:indptr[c + 1]]`, sorted, with the number
+    of entries of each in `counts`. Columns without entries are dropped.
+    """
+    order = np.lexsort((labels, columns))
+    columns, labels = columns[order], labels[order]
+    first = np.ones(len(labels), dtype=bool)
+    first[1:] = (columns[1:] != columns[:-1]) | (labels[1:] != labels[:-1])
+    starts = np.flatnonzero(first)
+    counts = np.diff(np.append(starts, len(labels)))
+    used, columns = np.unique(columns[starts], return_inverse=True)
+    indptr = np.zeros(len(used) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns, minlength=len(used)), out=indptr[1:])
+    vocabulary = {names[column]: position for position, column in enumerate(used.tolist())}
+    return vocabulary, indptr, labels[starts].astype(np.int64), counts.astype(np.int64)
+
+
+class IngredientIndex:
+    """
+    Inverted index from normalized (lowercased) ingredient names to the rows
+    that contain them.
+
+    Like `RelevanceIndex`, the postings are kept in compressed sparse column
+    form as NumPy arrays (see `sparse_columns`), with the number of times the
+    ingredient appears in each recipe in `counts`, so positive scoring keeps
+    counting duplicates the same way the old per-row scan did. Lookups
+    return sorted label arrays, so ranking intersects them vectorized. Rows
+    whose ingredients cannot be parsed are kept in `malformed` and are never
+    returned by the storage filter.
+
+    An index is never modified once it is shared: `with_changes` keeps the
+    changed rows in a small overlay (label -> ingredient names, and name ->
+    label -> count), hiding the base entries of the `shadowed` labels, and
+    `compacted` merges it into new arrays.
+    """
+
+    def __init__(self, vocabulary, indptr, postings, counts, rows, malformed):
+        # name -> column, in column order; the rows with name `n` are
+        # postings[indptr[c]:indptr[c + 1]] for c = vocabulary[n]
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.postings = postings
+        self.counts = counts
+        # Sorted labels of the well-formed and of the malformed base rows
+        self.rows = rows
+        self.malformed = malformed
+        # Changed rows: label -> names (None when malformed), and name -> label -> count
+        self.overlay = {}
+        self._overlay_postings = {}
+        self.shadowed = frozenset()
+        self._shadowed_array = np.zeros(0, dtype=np.int64)
+        # Lookups of this version, memoized
+        self._arrays = {}
+        self._labels = None
+
+    @classmethod
+    def from_series(cls, ingredients):
+        """
+        Build an index from a Series of parsed ingredients keyed by row label.
+        """
+        vocabulary = {}
+        columns, labels, rows, malformed = [], [], [], []
+        for label, ings in ingredients.items():
+            names = ingredient_names(ings)
+            if names is None:
+                malformed.append(label)
+                continue
+            rows.append(label)
+            columns.extend(vocabulary.setdefault(name, len(vocabulary)) for name in names)
+            labels.extend(itertools.repeat(label, len(names)))
+        return cls(
+            *sparse_columns(list(vocabulary), np.asarray(columns, dtype=np.int64), np.asarray(labels, dtype=np.int64)),
+            np.sort(np.asarray(rows, dtype=np.int64)),
+            np.sort(np.asarray(malformed, dtype=np.int64)),
+        )
+
+    def to_arrays(self):
+        """The index as named arrays, the overlay merged in (see `from_arrays`)."""
+        index = self.compacted()
+        return {
+            'names': np.array(list(index.vocabulary), dtype=str),
+            'indptr': index.indptr,
+            'postings': index.postings,
+            'counts': index.counts,
+            'rows': index.rows,
+            'malformed': index.malformed,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """The index `to_arrays` returned."""
+        vocabulary = {name: column for column, name in enumerate(arrays['names'].tolist())}
+        return cls(vocabulary, arrays['indptr'], arrays['postings'], arrays['counts'], arrays['rows'], arrays['malformed'])
+
+    def __len__(self):
+        size = len(self.rows) + len(self.malformed)
+        if self.shadowed:
+            hidden = np.count_nonzero(np.isin(self._shadowed_array, self.rows, assume_unique=True))
+            hidden += np.count_nonzero(np.isin(self._shadowed_array, self.malformed, assume_unique=True))
+            size += len(self.overlay) - hidden
+        return size
+
+    def with_changes(self, changes):
+        """
+        A new index with rows replaced, leaving this one untouched.
+
+        Parameters:
+        changes (dict): Row label -> recipe dict, or None for a deleted row.
+        """
+        overlay = dict(self.overlay)
+        postings = dict(self._overlay_postings)
+        copied = set()
+
+        def posting(name):
+            # Copy a name's overlay postings the first time this change touches it
+            if name not in copied:
+                postings[name] = dict(postings.get(name, {}))
+                copied.add(name)
+            return postings[name]
+
+        for label, recipe in changes.items():
+            for name in set(overlay.pop(label, None) or ()):
+                posting(name).pop(label, None)
+            if recipe is not None:
+                overlay[label] = names = ingredient_names(recipe.get('ingredients'))
+                for name in names or ():
+                    posting(name)[label] = posting(name).get(label, 0) + 1
+        for name in copied:
+            if not postings[name]:
+                del postings[name]
+
+        index = copy.copy(self)
+        index.overlay = overlay
+        index._overlay_postings = postings
+        index.shadowed = self.shadowed | changes.keys()
+        index._shadowed_array = np.array(sorted(index.shadowed), dtype=np.int64)
+        index._arrays = {}
+        index._labels = None
+        return index
+
+    def compacted(self):
+        """The same rows without overlay, as new arrays."""
+        if not self.shadowed:
+            return self
+        columns = np.repeat(np.arange(len(self.vocabulary), dtype=np.int64), np.diff(self.indptr))
+        keep = ~np.isin(self.postings, self._shadowed_array)
+        columns = np.repeat(columns[keep], self.counts[keep])
+        labels = np.repeat(self.postings[keep], self.counts[keep])
+
+        vocabulary = dict(self.vocabulary)
+        extra = [(vocabulary.setdefault(name, len(vocabulary)), label)
+                 for label, names in self.overlay.items() for name in names or ()]
+        if extra:
+            extra_columns, extra_labels = map(np.asarray, zip(*extra))
+            columns = np.concatenate([columns, extra_columns.astype(np.int64)])
+            labels = np.concatenate([labels, extra_labels.astype(np.int64)])
+
+        def merged(base, overlay_labels):
+            base = base[~np.isin(base, self._shadowed_array, assume_unique=True)]
+            return np.union1d(base, np.asarray(overlay_labels, dtype=np.int64))
+
+        return IngredientIndex(
+            *sparse_columns(list(vocabulary), columns, labels),
+            merged(self.rows, [label for label, names in self.overlay.items() if names is not None]),
+            merged(self.malformed, [label for label, names in self.overlay.items() if names is None]),
+        )
+
+    def labels(self):
+        """All well-formed row labels, as a sorted int64 array."""
+        if self._labels is None:
+            labels = self.rows
+            if self.shadowed:
+                labels = labels[~np.isin(labels, self._shadowed_array, assume_unique=True)]
+                labels = np.union1d(labels, np.array([label for label, names in self.overlay.items() if names is not None], dtype=np.int64))
+            self._labels = labels
+        return self._labels
+
+    def postings_array(self, name):
+        """
+        (labels, counts) of the rows containing an exact ingredient name, as
+        int64 arrays sorted by label.
+        """
+        arrays = self._arrays.get(name)
+        if arrays is None:
+            column = self.vocabulary.get(name)
+            if column is None:
+                labels = counts = np.zeros(0, dtype=np.int64)
+            else:
+                labels = self.postings[self.indptr[column]:self.indptr[column + 1]]
+                counts = self.counts[self.indptr[column]:self.indptr[column + 1]]
+            if self.shadowed:
+                keep = ~np.isin(labels, self._shadowed_array, assume_unique=True)
+                overlay = self._overlay_postings.get(name, {})
+                labels = np.concatenate([labels[keep], np.fromiter(overlay.keys(), dtype=np.int64, count=len(overlay))])
+                counts = np.concatenate([counts[keep], np.fromiter(overlay.values(), dtype=np.int64, count=len(overlay))])
+                order = np.argsort(labels, kind='stable')
+                labels, counts = labels[order], counts[order]
+            arrays = self._arrays[name] = labels, counts
+        return arrays
+
+    def rows_with_any(self, names):
+        """Labels of the rows containing at least one of the given names, as a sorted array."""
+        return union(self.postings_array(name)[0] for name in set(names))
+
+    def scores(self, names, labels):
+        """
+        Count, per row, how many of its ingredients are one of `names`.
+
+        Parameters:
+        names (iterable): Exact ingredient names to count.
+        labels (ndarray): Sorted labels of the rows to count for.
+
+        Returns:
+        ndarray: The count of each label (0 for rows without any of the names).
+        """
+        counts = np.zeros(len(labels), dtype=np.int64)
+        for name in set(names):
+            rows, n = self.postings_array(name)
+            positions = np.searchsorted(labels, rows)
+            found = positions < len(labels)
+            found[found] = labels[positions[found]] == rows[found]
+            # Labels are unique within a posting list, so no position repeats
+            counts[positions[found]] += n[found]
+        return counts
@@ -0,0 +1,140 @@
+import glob
+import json
+import os
+import time
+
+
+def _fsync_directory(path):
+    # Make a rename/unlink in `path`'s directory durable
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class RecipeJournal:
+    """
+    Append-only write-ahead log of recipe mutations.
+
+    Every mutation is one JSON line, fsynced before the storage applies it in
+    memory:
+
+        {"op": "add", "recipe": {...}}
+        {"op": "update", "name": "...", "fields": {...}}
+        {"op": "delete", "name": "..."}
+
+    Compaction folds the log into the CSV snapshot. `rotate` moves the live
+    log aside as a segment; once the new snapshot is written next to the CSV,
+    `seal` stamps each segment with the snapshot's fingerprint and the
+    snapshot is renamed into place. A segment whose stamp matches the current
+    CSV was already folded in and is dropped on recovery; any other segment
+    (compaction crashed before the rename) is replayed.
+
+    Assumes a single writing process per journal.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._file = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def segments(self):
+        """Rotated segments waiting for compaction, oldest first."""
+        return sorted(glob.glob(f'{glob.escape(self.path)}.*.segment'))
+
+    def append(self, record):
+        """Durably append one mutation record."""
+        self.append_many([record])
+
+    def append_many(self, records):
+        """Durably append a batch of mutation records, with one fsync."""
+        self._file.write(''.join(json.dumps(record, default=str) + '\n' for record in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records += len(records)
+
+    def rotate(self):
+        """
+        Seal the live log as a segment and start a new one.
+
+        Returns:
+        list: Every segment waiting for compaction, including the new one.
+        """
+        if self.records:
+            self._file.close()
+            os.replace(self.path, f'{self.path}.{time.time_ns()}.segment')
+            _fsync_directory(self.path)
+            self._open()
+            self.records = 0
+        return self.segments()
+
+    @staticmethod
+    def seal(segment, fingerprint):
+        """Record that `segment` is contained in the snapshot with this fingerprint."""
+        with open(segment, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'op': 'compacted', 'fingerprint': fingerprint}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def discard(segments):
+        for segment in segments:
+            os.remove(segment)
+        if segments:
+            _fsync_directory(segments[0])
+
+    @staticmethod
+    def _read(path):
+        """
+        Read the complete records of a log file. A torn last line (crash in
+        the middle of a write) is cut off so later appends stay parseable.
+        """
+        records = []
+        good_offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                good_offset += len(line)
+            size = f.seek(0, os.SEEK_END)
+
+        if good_offset < size:
+            with open(path, 'r+b') as f:
+                f.truncate(good_offset)
+                os.fsync(f.fileno())
+        return records
+
+    def recover(self, fingerprint):
+        """
+        Yield the mutations to replay on top of the snapshot with this
+        fingerprint, in order: unfolded segments first, then the live log.
+        """
+        for segment in self.segments():
+            records = self._read(segment)
+            if records and records[-1].get('op') == 'compacted' and records[-1].get('fingerprint') == fingerprint:
+                self.discard([segment])
+                continue
+            for record in records:
+                if record.get('op') != 'compacted':
+                    yield record
+
+        self._file.close()
+        records = self._read(self.path)
+        self._open()
+        self.records = len(records)
+        yield from records
@@ -1,116 +1,554 @@
 import pandas as pd
+import numpy as np
 import ast
+import base64
+import itertools
+import json
+import os
+import threading
 from .config import (
     RES_DATA_PATH, 
+    RES_CACHE_PATH,
+    RES_INDEX_PATH,
+    RES_JOURNAL_PATH,
+    JOURNAL_COMPACT_THRESHOLD,
+    IMPORT_FLUSH_ROWS,
     DIABETES_DATA_PATH, 
-    ALLERGIC_DATA_PATH  # Fixed typo: ALLARGIC_DATA_PATH
+    ALLERGIC_DATA_PATH,  # Fixed typo: ALLARGIC_DATA_PATH
+    SEARCH_MIN_SIMILARITY,
+    FILTER_MIN_SIMILARITY,
 )
+from .cache import load_recipes, build_cache, read_cache, source_fingerprint
+from .journal import RecipeJournal
+from .snapshot import RecipesSnapshot, indexes_fingerprint, new_row
+
+
+def encode_cursor(key):
+    """Opaque pagination cursor for a (rank, label) ranking key."""
+    return base64.urlsafe_b64encode(json.dumps([float(key[0]), int(key[1])]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of `encode_cursor`; raises ValueError on a malformed cursor."""
+    try:
+        rank, label = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(rank), int(label)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def best_first(rank, chunk=64):
+    """
+    Yield the positions of `rank` from the highest rank to the lowest, ties
+    in position order, as arrays of growing size: each one is selected with
+    a partition of what is left, so taking the first few never sorts the rest.
+    """
+    left = np.arange(len(rank))
+    while len(left):
+        if len(left) > chunk:
+            values = rank[left]
+            threshold = np.partition(values, len(values) - chunk)[len(values) - chunk]
+            taken = values > threshold
+            # Of the positions tied with the threshold, the first ones fill the chunk
+            taken[np.flatnonzero(values == threshold)[:chunk - np.count_nonzero(taken)]] = True
+            batch, left = left[taken], left[~taken]
+        else:
+            batch, left = left, left[:0]
+        yield batch[np.lexsort((batch, -rank[batch]))]
+        chunk *= 4
 
 
 class RecipesStorage:
-    def __init__(self):
-        # Load the dataframe from RES_DATA_PATH
+    """
+    Recipes and their indexes, as a current `RecipesSnapshot`.
+
+    Readers take the current snapshot once per call and work on it without
+    locking, so a concurrent change never shows half-applied. Writers are
+    serialized: each change is journaled, then the next snapshot is built and
+    swapped in with one attribute assignment.
+    """
+
+    def __init__(self, path=RES_DATA_PATH, cache_path=RES_CACHE_PATH, journal_path=RES_JOURNAL_PATH, compact_threshold=JOURNAL_COMPACT_THRESHOLD,
+                 index_path=RES_INDEX_PATH):
+        # Load the dataframe from the columnar cache of `path`, rebuilding it if the CSV changed
         # Columns: name, review, rating, meta, ingredients, steps, cooks_note, editors_note, nutrition_facts, url
-        self.df = pd.read_csv(RES_DATA_PATH)
-        self.df = self.df.dropna() 
-        # Convert the string to a list of dictionaries
-        self.df['ingredients'] = self.df['ingredients'].apply(lambda ing: [eval(i.replace(']', '').replace('[', '')) for i in ing.split('\n')])
-        self.df['ingredients'] = self.df['ingredients'].apply(lambda i: [i for i in i[0]]) 
-        print(self.df['ingredients'][0])
+        # `ingredients` is already parsed into a list of dictionaries
+        self.path = path
+        self.cache_path = cache_path
+        self.index_path = index_path
+        self.compact_threshold = compact_threshold
+        base = load_recipes(path, cache_path)
+        print(base['ingredients'][0])
+
+        # Serializes writers; readers never take it
+        self._lock = threading.RLock()
+        # Serializes compactions and reloads
+        self._compaction_lock = threading.Lock()
+        self._compaction = None
+        # Called after every swap, see `subscribe`
+        self._listeners = []
+        # Held by the bulk import in progress, if any, from `begin_import` to
+        # `RecipeImport.finish`: reloads and other imports wait for it
+        self._import_lock = threading.Lock()
+        self._importing = None
+        # Replay the mutations that were not compacted into the CSV yet
+        self.journal = RecipeJournal(journal_path)
+        self._snapshot = self._indexed(base).apply(list(self.journal.recover(source_fingerprint(path))))
+
+    @property
+    def snapshot(self):
+        """The current version of the recipes; it never changes once taken."""
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    @property
+    def df(self):
+        """All recipes as one DataFrame (materialized on first access after a change)."""
+        return self._snapshot.df
+
+    # The indexes of the current snapshot
+    @property
+    def index(self):
+        return self._snapshot.index
+
+    @property
+    def scores(self):
+        return self._snapshot.scores
+
+    @property
+    def allergens(self):
+        return self._snapshot.allergens
+
+    @property
+    def search_index(self):
+        return self._snapshot.search_index
+
+    @property
+    def relevance(self):
+        return self._snapshot.relevance
 
     def save(self):
-        """Save the current DataFrame to the CSV file."""
-        self.df.to_csv(RES_DATA_PATH, index=False)
+        """Save the current DataFrame to the CSV file (folds the journal into it)."""
+        self.compact()
+
+    def _ranked(self, snapshot, positive_products, negative_products, after=None, conditions=(), max_glycemic_load=None, max_sodium=None, profile=None):
+        """
+        Yield (rank, label) for the matching recipes of a snapshot, best
+        first, lazily: the ranking is vectorized over the label arrays of the
+        indexes, and rows are only looked at a chunk at a time, when they are
+        about to be returned.
 
-    def filter(self, positive_products, negative_products):
+        The rank is the count of positive products in the recipe, minus a
+        health penalty below 1 when `conditions` (see `health_conditions`)
+        are given, so health only reorders recipes with the same count. With
+        a `profile`, its BM25 relevance (scaled to [0, 1] over the candidates)
+        also reorders them: both then take half of the room between counts.
+
+        Parameters:
+        after (tuple): A (rank, label) key; only rows ranked after it are yielded.
+        conditions (iterable): Health profiles to rank for, e.g. {'diabetes'}.
+        max_glycemic_load (float): Drop recipes with a higher estimated glycemic load.
+        max_sodium (float): Drop recipes with more estimated sodium.
+        profile (str): Free text describing the user, e.g. preferences, diet and condition.
+        """
+        # Ingredient checks are vectorized over the sorted label arrays of the
+        # inverted index; only the substring checks against `steps` and `name`
+        # still look at the rows. Each product matches its exact ingredient
+        # name and, fuzzily, any ingredient containing its tokens ("chicken"
+        # -> "chicken breast").
+        negative_names = [neg_prod.lower() for neg_prod in negative_products]
+        excluded = [snapshot.index.rows_with_any(negative_names)]
+        excluded += [snapshot.search_index.rows_matching(neg_prod, FILTER_MIN_SIMILARITY) for neg_prod in negative_names]
+        labels = snapshot.index.labels()
+        labels = labels[~np.isin(labels, np.concatenate(excluded))]
+
+        fuzzy_matches = []
+        if len(positive_products):
+            positive_rows = []
+            for pos_prod in positive_products:
+                exact = snapshot.index.rows_with_any([pos_prod.lower()])
+                fuzzy = snapshot.search_index.rows_matching(pos_prod, FILTER_MIN_SIMILARITY)
+                fuzzy_matches.append(np.setdiff1d(fuzzy, exact, assume_unique=True))
+                positive_rows += [exact, fuzzy]
+            labels = labels[np.isin(labels, np.concatenate(positive_rows))]
+
+        # Negative products that are allergies or food families (e.g. "Nut
+        # Allergy") also exclude every food they expand to, anywhere in the recipe
+        allergen_mask = snapshot.allergens.table.resolve(frozenset(negative_names))
+        if allergen_mask is not None:
+            labels = labels[~snapshot.allergens.mentions(labels, allergen_mask)]
+        if max_glycemic_load is not None or max_sodium is not None:
+            labels = labels[snapshot.scores.within(labels, max_glycemic_load, max_sodium)]
+
+        # Rank by the count of positive products in each recipe; `labels` is
+        # sorted, so ties keep label order
+        rank = snapshot.index.scores(positive_products, labels).astype(float)
+        # A product only matched fuzzily counts once
+        for rows in fuzzy_matches:
+            rank[np.isin(labels, rows, assume_unique=True)] += 1
+        penalty = snapshot.scores.penalty(labels, conditions)
+        if profile:
+            rank += 0.5 * snapshot.relevance.relevance(profile, labels) - 0.5 * penalty
+        else:
+            rank -= penalty
+
+        if after is not None:
+            keep = (rank < after[0]) | ((rank == after[0]) & (labels > after[1]))
+            rank, labels = rank[keep], labels[keep]
+
+        for batch in best_first(rank):
+            batch_labels = labels[batch].tolist()
+            if negative_names:
+                texts = zip(snapshot.values(batch_labels, 'steps'), snapshot.values(batch_labels, 'name'))
+            else:
+                texts = itertools.repeat(('', ''))
+            for position, label, (steps, name) in zip(batch.tolist(), batch_labels, texts):
+                try:
+                    mentioned = any(neg_prod in steps or neg_prod in name for neg_prod in negative_names)
+                except TypeError:
+                    mentioned = True
+                if not mentioned:
+                    yield float(rank[position]), label
+
+    def filter(self, positive_products, negative_products, **health):
         # Filter rows based on the ingredients column to include only recipes that
         # do not contain any negative products, sorted by the presence of positive products
+        # `health` takes the conditions/threshold/profile keywords of `_ranked`
+        snapshot = self.snapshot
+        labels = [label for _, label in self._ranked(snapshot, positive_products, negative_products, **health)]
+        return snapshot.rows(labels)
 
-        def contains_positive_products(ingredients):
-            # Check if any ingredient matches any positive product
-            try: 
-                ingredient_names = [item["name"].lower() for item in ingredients]
-                return any(pos_prod.lower() in ingredient_names for pos_prod in positive_products)
-                
-            except: 
-                print("POSITIVE: ", ingredients)
-                return False
-
-        
-        def contains_negative_products(i):
-            # Check if any ingredient matches any negative product
-            try: 
-                ingredients = i['ingredients']
+    def top_k(self, positive_products, negative_products, k, cursor=None, **health):
+        """
+        The first `k` recipes `filter` would return, without ranking the rest.
 
-                ingredient_names = [item["name"].lower() for item in ingredients]
+        Parameters:
+        k (int): Number of recipes to return.
+        cursor (str): `next_cursor` of the previous page, to continue after it.
+        health: The conditions/threshold/profile keywords of `_ranked`.
 
-                ing = any(neg_prod.lower() in ingredient_names for neg_prod in negative_products)
-                steps = any(neg_prod.lower() in i['steps'] for neg_prod in negative_products)
-                name = any(neg_prod.lower() in i['name'] for neg_prod in negative_products)
+        Returns:
+        tuple: (DataFrame of at most k recipes, cursor of the next page or None).
+        """
+        snapshot = self.snapshot
+        after = decode_cursor(cursor) if cursor else None
+        page = list(itertools.islice(self._ranked(snapshot, positive_products, negative_products, after, **health), k + 1))
+        next_cursor = encode_cursor(page[k - 1]) if len(page) > k and k > 0 else None
+        return snapshot.rows([label for _, label in page[:k]]), next_cursor
 
-                return any([ing, steps, name])
-            except: 
-                print("NEGATIVE: ", ingredients)
-                return True
-        
-        # Extract the ingredients column, filter, and sort
-        filtered_df = self.df[~self.df.apply(contains_negative_products, axis=1)]
-        if len(positive_products): 
-            filtered_df = filtered_df[filtered_df['ingredients'].apply(contains_positive_products)]
+    def search(self, query, k=10, min_similarity=SEARCH_MIN_SIMILARITY):
+        """
+        Fuzzy search over recipe names and ingredient names.
 
+        Parameters:
+        query (str): Free text, e.g. "chiken curry".
+        k (int): Number of recipes to return.
+        min_similarity (float): Trigram similarity a token needs to match.
 
-        def calculate_score(ingredients): 
-            try: 
-                return sum(1 for ingredient in ingredients if ingredient["name"].lower() in positive_products)
-            except Exception as e: 
-                print(e)
-                print(ingredients)
-                return 0 
+        Returns:
+        DataFrame: At most k recipes, best first, with their `score`.
+        """
+        snapshot = self.snapshot
+        hits = snapshot.search_index.search(query, k, min_similarity)
+        recipes = snapshot.rows([label for label, _ in hits])
+        recipes.insert(0, 'score', [score for _, score in hits])
+        return recipes
 
-        # Sort by the count of positive products in each recipe
-        filtered_df = filtered_df.assign(
-            positive_count=filtered_df['ingredients'].apply(
-                lambda ingredients: calculate_score(ingredients)
-            )
-        ).sort_values(by='positive_count', ascending=False)
+    def subscribe(self, listener):
+        """
+        Call `listener(previous, snapshot, changes)` after every new snapshot
+        is swapped in, in order, with the writer lock held (so it must be
+        quick). `changes` maps the changed row labels to their new rows (None
+        for a deleted row); it is empty when only the layout changed (a
+        compaction) and None when every row may have changed (a reload).
+        """
+        self._listeners.append(listener)
 
-        # Drop the helper column used for sorting
-        filtered_df = filtered_df.drop(columns=['positive_count'])
+    def _swap(self, snapshot, changes):
+        # Under self._lock
+        previous, self._snapshot = self._snapshot, snapshot
+        for listener in self._listeners:
+            listener(previous, snapshot, changes)
 
-        return filtered_df
+    def _write(self, *records):
+        # Write-ahead: the records are durable before they are applied
+        with self._lock:
+            self.journal.append_many(records)
+            snapshot = self._snapshot.apply(records)
+            self._swap(snapshot, snapshot.changes_since(self._snapshot))
+            if self.journal.records >= self.compact_threshold:
+                self.compact(wait=False)
 
     def add(self, recipe):
         """
-        Add a new recipe to the DataFrame and save changes to CSV.
+        Add a new recipe. The change is journaled and applied in memory; the
+        CSV is rewritten by a later compaction.
         
         Parameters:
         recipe (dict): A dictionary containing the recipe information, with keys matching DataFrame columns.
         """
-        new_recipe = pd.DataFrame([recipe])  # Convert the recipe dict to a DataFrame
-        self.df = pd.concat([self.df, new_recipe], ignore_index=True)  # Append to the main DataFrame
-        self.save()  # Save changes to CSV
+        self._write({'op': 'add', 'recipe': dict(recipe)})
+
+    def begin_import(self):
+        """
+        Start a bulk import of new recipes (see `RecipeImport`). Reloads and
+        other imports wait until it is finished; compactions write the rows
+        imported so far to the CSV.
+        """
+        # Released by `RecipeImport.finish`, which may run in another thread
+        self._import_lock.acquire()
+        with self._lock:
+            self._importing = RecipeImport(self)
+            return self._importing
+
+    def _write_named(self, record):
+        # Changes by name must see the imported recipes with that name, as
+        # replaying the journal would: wait for the import to finish
+        while True:
+            with self._lock:
+                importing = self._importing
+                if importing is None or record['name'] not in importing.names:
+                    if not self._snapshot.labels_named(record['name']):
+                        return False
+                    self._write(record)
+                    return True
+            with self._import_lock:
+                pass
 
     def update(self, recipe_name, updated_info):
         """
-        Update an existing recipe based on the recipe name and save changes to CSV.
+        Update an existing recipe based on the recipe name.
         
         Parameters:
         recipe_name (str): The name of the recipe to update.
         updated_info (dict): A dictionary containing the updated information for the recipe.
+
+        Returns:
+        bool: Whether a recipe with that name was found.
         """
-        # Locate the recipe by name and update its details
-        self.df.loc[self.df['name'] == recipe_name, updated_info.keys()] = updated_info.values()
-        self.save()  # Save changes to CSV
+        return self._write_named({'op': 'update', 'name': recipe_name, 'fields': dict(updated_info)})
 
     def delete(self, recipe_name):
         """
-        Delete a recipe from the DataFrame based on the recipe name and save changes to CSV.
+        Delete a recipe based on the recipe name.
         
         Parameters:
         recipe_name (str): The name of the recipe to delete.
+
+        Returns:
+        bool: Whether a recipe with that name was found.
+        """
+        return self._write_named({'op': 'delete', 'name': recipe_name})
+
+    def compact(self, wait=True):
+        """
+        Fold the journal into the CSV snapshot.
+
+        The overlay of changed rows is folded into new base indexes in a
+        background thread, which then swaps the result in (with the changes
+        made meanwhile on top) and writes it to disk. With `wait` the call
+        returns once that is done; without it, it returns right away and
+        does nothing if a compaction is already running.
+        """
+        if not self._compaction_lock.acquire(blocking=wait):
+            return
+        try:
+            if self._compaction is not None and self._compaction.is_alive():
+                if not wait:
+                    return
+                self._compaction.join()
+            with self._lock:
+                snapshot = self._snapshot
+                segments = self.journal.rotate()
+                # The imported rows these segments hold, which the snapshot doesn't
+                importing = self._importing
+                staged = importing._take() if importing is not None else []
+            compaction = self._compaction = threading.Thread(target=self._compact, args=(snapshot, segments, importing, staged), daemon=True)
+            compaction.start()
+        finally:
+            self._compaction_lock.release()
+
+        if wait:
+            compaction.join()
+
+    def _indexed(self, base, tables=None):
+        # The indexes saved for this CSV, or built (and saved) when they are missing or stale
+        fingerprint = indexes_fingerprint(self.path)
+        snapshot = RecipesSnapshot.load(base, self.index_path, fingerprint, tables=tables)
+        if snapshot is None:
+            snapshot = RecipesSnapshot.build(base, tables=tables)
+            snapshot.save(self.index_path, fingerprint)
+        return snapshot
+
+    def _compact(self, snapshot, segments, importing=None, staged=()):
+        compacted = snapshot.compacted()
+        with self._lock:
+            self._swap(self._snapshot.rebase(compacted, snapshot), {})
+        if importing is None:
+            self._write_snapshot(compacted, segments)
+            return
+        # The rows of the import in progress go after the others (see `RecipeImport`)
+        self._write_snapshot(compacted, segments, importing._rows(staged))
+        importing._flushed(staged, len(compacted.base))
+
+    def reload(self):
+        """
+        Load the recipes from disk again (e.g. after a new CSV was deployed)
+        and swap them in, with the journal replayed on top. Requests keep
+        being served from the previous version while the new one is built,
+        and changes made meanwhile are replayed from the journal.
+
+        Returns:
+        int: The version of the new snapshot.
+        """
+        # The CSV holds the rows of an import in progress, which aren't visible yet
+        with self._import_lock, self._compaction_lock:
+            # A running compaction is still writing the CSV
+            if self._compaction is not None:
+                self._compaction.join()
+            base = load_recipes(self.path, self.cache_path)
+            snapshot = self._indexed(base, tables=self._snapshot)
+            with self._lock:
+                records = list(self.journal.recover(source_fingerprint(self.path)))
+                snapshot.version = self._snapshot.version + 1
+                self._swap(snapshot.apply(records), None)
+                return self._snapshot.version
+
+    def _write_snapshot(self, snapshot, segments, imported=None):
+        tmp_path = f'{self.path}.compacting'
+        snapshot.base.to_csv(tmp_path, index=False)
+        if imported is not None:
+            imported.reindex(columns=snapshot.base.columns).to_csv(tmp_path, mode='a', header=False, index=False)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+
+        # Stamp the segments before the rename: whichever way a crash lands,
+        # recovery knows whether they are already part of the CSV
+        fingerprint = source_fingerprint(tmp_path)
+        for segment in segments:
+            RecipeJournal.seal(segment, fingerprint)
+        os.replace(tmp_path, self.path)
+        RecipeJournal.discard(segments)
+
+        # Refresh the columnar cache and the saved indexes so the next start
+        # neither parses the CSV nor indexes it
+        build_cache(self.path, self.cache_path)
+        if imported is None:
+            snapshot.save(self.index_path, indexes_fingerprint(self.path))
+
+
+class RecipeImport:
+    """
+    A bulk import of new recipes into a `RecipesStorage` (`begin_import`).
+
+    Each batch is journaled with one flush and takes its row labels right
+    away, so the journal replays it in the order it was written. Its rows
+    are only staged, though: adding them to the overlay would cost as much
+    as the overlay for every batch. Every `IMPORT_FLUSH_ROWS` staged rows
+    the import runs a compaction, which writes the staged rows after the
+    other recipes of the CSV, drops them from memory and discards the
+    journal segments holding them. `finish` reads the imported rows back
+    from the columnar cache and indexes them once, with the rest of the
+    recipes, into a new base; they all become visible then. Changes by name
+    to a recipe being imported wait for `finish`.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.names = set()
+        self.count = 0
+        self.finished = False
+        # Batches journaled but not written to the CSV yet, and their row count
+        self._frames = []
+        self._staged = 0
+        # Row labels of the imported rows at the end of the CSV, in CSV
+        # order, and the CSV row the first of them is in
+        self._labels = []
+        self._start = 0
+
+    def add(self, recipes):
+        """
+        Journal a batch of recipes.
+
+        Returns:
+        int: The number of recipes added.
+        """
+        if self.finished:
+            raise RuntimeError("The import is finished.")
+        if not recipes:
+            return 0
+        records = [{'op': 'add', 'recipe': dict(recipe)} for recipe in recipes]
+        rows = pd.DataFrame([new_row(record['recipe']) for record in records])
+        storage = self.storage
+        with storage._lock:
+            # Names first: see `RecipesStorage._write_named`
+            self.names.update(rows['name'])
+            storage.journal.append_many(records)
+            snapshot = storage._snapshot
+            rows.index = range(snapshot.next_label, snapshot.next_label + len(records))
+            storage._swap(snapshot.reserved(len(records)), {})
+            # With the journal records, so a compaction takes both or neither
+            self._frames.append(rows)
+            self._staged += len(records)
+            staged = self._staged
+        self.count += len(records)
+        if staged >= IMPORT_FLUSH_ROWS:
+            storage.compact()
+        return len(records)
+
+    def _take(self):
+        # The staged batches, for the compaction about to write them (under the storage lock)
+        frames, self._frames, self._staged = self._frames, [], 0
+        return frames
+
+    def _rows(self, staged=()):
+        # Every imported row: those at the end of the CSV, then the staged ones
+        frames = list(staged)
+        if self._labels:
+            labels = np.concatenate(self._labels)
+            written = read_cache(self.storage.cache_path, self.storage.path, last=len(labels))
+            # The cache is keyed by CSV row, and skips the rows it can't use
+            written = written[written.index >= self._start]
+            frames.insert(0, written.set_axis(labels[written.index - self._start]))
+        return pd.concat(frames) if frames else None
+
+    def _flushed(self, staged, start):
+        # The staged batches are in the CSV now, after `start` other rows
+        self._labels.extend(np.asarray(frame.index, dtype=np.int64) for frame in staged)
+        self._start = start
+
+    def finish(self):
+        """
+        Index the imported recipes and swap them in. Must be called once the
+        import is done or abandoned, as the journal already holds its batches.
         """
-        self.df = self.df[self.df['name'] != recipe_name]  # Filter out the recipe
-        self.save()  # Save changes to CSV
+        if self.finished:
+            return
+        storage = self.storage
+        try:
+            if self._frames:
+                # Write the rest too, so every row is read back from the cache
+                storage.compact()
+            with storage._compaction_lock:
+                # A compaction started meanwhile rewrites the CSV
+                if storage._compaction is not None:
+                    storage._compaction.join()
+                rows = self._rows(self._take())
+                if rows is not None:
+                    since = storage._snapshot
+                    merged = since.merged(rows)
+                    with storage._lock:
+                        # Every row may have changed, as far as listeners know
+                        storage._swap(storage._snapshot.rebase(merged, since), None)
+                # Before a compaction can start: it would write the imported rows twice
+                storage._importing = None
+        finally:
+            storage._importing = None
+            self.finished = True
+            storage._import_lock.release()
 
 
 # Run example
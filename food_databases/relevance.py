@@ -0,0 +1,262 @@
+import copy
+import math
+from collections import Counter
+
+import numpy as np
+
+from .index import ingredient_names
+from .scoring import food_tokens
+
+# Weight of one occurrence of a term per field (BM25F-style)
+FIELD_WEIGHTS = {'name': 3.0, 'ingredients': 2.0, 'steps': 1.0}
+# BM25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+# Words too common in recipes and profiles to say anything about relevance
+STOP_WORDS = frozenset('''
+a about after all also an and any are as at be before but by can cup do for from have if in into is it
+its like more no not of off on or other out over some than that the then these this to up very was well
+when while with without you your i me my eat food foods prefer love dish meal minute hour place add stir
+cook until pan bowl heat serve set use make mix large small medium
+'''.split())
+
+
+def document_terms(recipe):
+    """Weighted term frequencies of a recipe's name, ingredient names and steps."""
+    texts = {
+        'name': recipe.get('name') or '',
+        'ingredients': ' '.join(ingredient_names(recipe.get('ingredients')) or []),
+        'steps': recipe.get('steps') or '',
+    }
+    frequencies = Counter()
+    for field, text in texts.items():
+        for token in food_tokens(text):
+            if token not in STOP_WORDS:
+                frequencies[token] += FIELD_WEIGHTS[field]
+    return frequencies
+
+
+def query_terms(text):
+    """Term counts of a free-text query, e.g. a user's preferences and diet."""
+    return Counter(token for token in food_tokens(text or '') if token not in STOP_WORDS)
+
+
+def bm25_weights(frequencies, lengths, average_length):
+    """Saturated, length-normalized BM25 term weights (without the IDF)."""
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    norm = K1 * (1 - B + B * np.asarray(lengths, dtype=np.float64) / max(average_length, 1e-9))
+    return (frequencies * (K1 + 1) / (frequencies + norm)).astype(np.float32)
+
+
+class RelevanceIndex:
+    """
+    BM25 relevance of recipes to free text, e.g. a user profile.
+
+    The recipe x term matrix of BM25 term weights is kept in compressed
+    sparse column form as NumPy arrays: the recipes containing term `t` are
+    `labels[indptr[t]:indptr[t + 1]]`, with their weights in `weights`.
+    Scoring a query against the whole corpus is one sparse matrix-vector
+    product, a scatter-add of the IDF-weighted column of each query term.
+
+    The corpus statistics (the average document length and the number of
+    documents the IDF is computed against) are fixed when the matrix is
+    built, so a change only computes the weights of its own rows and only
+    moves the scores of the terms it contains. Like the other
+    indexes, a shared index is never modified: `with_changes` keeps changed
+    rows in a small overlay (label -> term -> weight) and `compacted` merges
+    it into new arrays.
+    """
+
+    def __init__(self, vocabulary, indptr, labels, weights, average_length, rows, corpus_size=None):
+        # term -> column
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.labels = labels
+        self.weights = weights
+        self.average_length = average_length
+        # Sorted labels of every base row, with terms or not
+        self.rows = rows
+        self.count = len(rows)
+        self.corpus_size = self.count if corpus_size is None else corpus_size
+        self._size = int(rows[-1]) + 1 if len(rows) else 0
+        # Changed rows: label -> term -> weight, and term -> label -> weight
+        self.overlay = {}
+        self._overlay_postings = {}
+        self.shadowed = frozenset()
+        self._shadowed_array = np.zeros(0, dtype=np.int64)
+        self._columns = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        """Build the matrix for every recipe of a DataFrame keyed by row label."""
+        df = df.sort_index()
+        vocabulary = {}
+        columns, frequencies, terms_per_row, lengths = [], [], [], []
+        for name, ingredients, steps in zip(df['name'], df['ingredients'], df['steps']):
+            terms = document_terms({'name': name, 'ingredients': ingredients, 'steps': steps})
+            columns.extend(vocabulary.setdefault(term, len(vocabulary)) for term in terms)
+            frequencies.extend(terms.values())
+            terms_per_row.append(len(terms))
+            lengths.append(sum(terms.values()))
+
+        rows = np.asarray(df.index, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        labels = np.repeat(rows, terms_per_row)
+        average_length = sum(lengths) / len(df) if len(df) else 1.0
+        weights = bm25_weights(frequencies, np.repeat(lengths, terms_per_row), average_length)
+        # Rows were added in label order, so a stable sort keeps each column sorted by label
+        order = np.argsort(columns, kind='stable')
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(columns, minlength=len(vocabulary)), out=indptr[1:])
+        return cls(vocabulary, indptr, labels[order], weights[order], average_length, rows)
+
+    def to_arrays(self):
+        """The matrix as named arrays, the overlay merged in (see `from_arrays`)."""
+        index = self.compacted()
+        return {
+            'terms': np.array(list(index.vocabulary), dtype=str),
+            'indptr': index.indptr,
+            'labels': index.labels,
+            'weights': index.weights,
+            'rows': index.rows,
+            'average_length': np.float64(index.average_length),
+            'corpus_size': np.int64(index.corpus_size),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """The matrix `to_arrays` returned."""
+        vocabulary = {term: column for column, term in enumerate(arrays['terms'].tolist())}
+        return cls(vocabulary, arrays['indptr'], arrays['labels'], arrays['weights'], float(arrays['average_length']),
+                   arrays['rows'], int(arrays['corpus_size']))
+
+    def __len__(self):
+        return self.count
+
+    def document_weights(self, recipe):
+        """term -> BM25 weight of one recipe, against the fixed average length."""
+        terms = document_terms(recipe)
+        if not terms:
+            return {}
+        weights = bm25_weights(list(terms.values()), sum(terms.values()), self.average_length)
+        return dict(zip(terms, weights.tolist()))
+
+    def with_changes(self, changes):
+        """
+        A new index with rows replaced, leaving this one untouched.
+
+        Parameters:
+        changes (dict): Row label -> recipe dict, or None for a deleted row.
+        """
+        overlay = dict(self.overlay)
+        postings = dict(self._overlay_postings)
+        copied = set()
+
+        def posting(term):
+            # Copy a term's overlay postings the first time this change touches it
+            if term not in copied:
+                postings[term] = dict(postings.get(term, {}))
+                copied.add(term)
+            return postings[term]
+
+        for label, recipe in changes.items():
+            for term in overlay.pop(label, {}):
+                posting(term).pop(label, None)
+            if recipe is not None:
+                overlay[label] = self.document_weights(recipe)
+                for term, weight in overlay[label].items():
+                    posting(term)[label] = weight
+        for term in copied:
+            if not postings[term]:
+                del postings[term]
+
+        index = copy.copy(self)
+        index.overlay = overlay
+        index._overlay_postings = postings
+        index.shadowed = self.shadowed | changes.keys()
+        index._shadowed_array = np.array(sorted(index.shadowed), dtype=np.int64)
+        index._columns = {}
+        hidden = np.count_nonzero(np.isin(index._shadowed_array, self.rows, assume_unique=True))
+        index.count = len(self.rows) - hidden + len(overlay)
+        index._size = max(self._size, max(overlay, default=-1) + 1)
+        return index
+
+    def column(self, term):
+        """(labels, weights) of the recipes containing a term, overlay included."""
+        cached = self._columns.get(term)
+        if cached is not None:
+            return cached
+        position = self.vocabulary.get(term)
+        if position is None:
+            labels, weights = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        else:
+            labels = self.labels[self.indptr[position]:self.indptr[position + 1]]
+            weights = self.weights[self.indptr[position]:self.indptr[position + 1]]
+        if len(self._shadowed_array) and len(labels):
+            keep = ~np.isin(labels, self._shadowed_array, assume_unique=True)
+            labels, weights = labels[keep], weights[keep]
+        overlay = self._overlay_postings.get(term)
+        if overlay:
+            labels = np.concatenate([labels, np.fromiter(overlay.keys(), dtype=np.int64, count=len(overlay))])
+            weights = np.concatenate([weights, np.fromiter(overlay.values(), dtype=np.float32, count=len(overlay))])
+        self._columns[term] = labels, weights
+        return labels, weights
+
+    def scores(self, query):
+        """
+        BM25 score of every recipe for a free-text query, as a dense float32
+        array indexed by row label (0 for recipes without any query term).
+        """
+        scores = np.zeros(self._size, dtype=np.float32)
+        for term, count in query_terms(query).items():
+            labels, weights = self.column(term)
+            if len(labels):
+                idf = math.log(1 + (self.corpus_size - len(labels) + 0.5) / (len(labels) + 0.5))
+                scores[labels] += weights * np.float32(count * idf)
+        return scores
+
+    def relevance(self, query, labels):
+        """Scores of a query for an array of labels, scaled so the best one is 1."""
+        labels = np.asarray(labels, dtype=np.int64)
+        scores = self.scores(query)
+        values = np.zeros(len(labels), dtype=np.float64)
+        inside = labels < len(scores)
+        values[inside] = scores[labels[inside]]
+        top = values.max() if len(values) else 0.0
+        return values / top if top > 0 else values
+
+    def top_k(self, query, k):
+        """The `k` most relevant recipes as (label, score) pairs, best first."""
+        scores = self.scores(query)
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.lexsort((hits, -scores[hits]))]
+        return [(int(label), float(scores[label])) for label in hits]
+
+    def compacted(self):
+        """The same matrix without overlay, as new arrays (the corpus statistics stay fixed)."""
+        if not self.overlay and not self.shadowed:
+            return self
+        columns = np.repeat(np.arange(len(self.vocabulary), dtype=np.int64), np.diff(self.indptr))
+        labels, weights = self.labels, self.weights
+        if len(self._shadowed_array):
+            keep = ~np.isin(labels, self._shadowed_array)
+            columns, labels, weights = columns[keep], labels[keep], weights[keep]
+
+        vocabulary = dict(self.vocabulary)
+        extra = [(vocabulary.setdefault(term, len(vocabulary)), label, weight)
+                 for label, terms in self.overlay.items() for term, weight in terms.items()]
+        if extra:
+            extra_columns, extra_labels, extra_weights = map(np.asarray, zip(*extra))
+            columns = np.concatenate([columns, extra_columns.astype(np.int64)])
+            labels = np.concatenate([labels, extra_labels.astype(np.int64)])
+            weights = np.concatenate([weights, extra_weights.astype(np.float32)])
+
+        order = np.lexsort((labels, columns))
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(columns, minlength=len(vocabulary)), out=indptr[1:])
+        rows = self.rows[~np.isin(self.rows, self._shadowed_array, assume_unique=True)]
+        rows = np.union1d(rows, np.fromiter(self.overlay, dtype=np.int64, count=len(self.overlay)))
+        return RelevanceIndex(vocabulary, indptr, labels[order], weights[order], self.average_length, rows, self.corpus_size)
@@ -0,0 +1,362 @@
+import copy
+import functools
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from .config import DIABETES_DATA_PATH
+from .index import ingredient_names
+
+# Per-recipe columns kept by `NutritionScores`
+SCORE_COLUMNS = (
+    'glycemic_load',
+    'sodium',
+    'fiber',
+    'diabetes_suitability',
+    'blood_pressure_suitability',
+    'matched_fraction',
+)
+
+# Staple ingredients the scoring table lacks, per 100 g, in the table's columns:
+# glycemic index, carbohydrates, sodium, fiber, suitable for diabetes, suitable for blood pressure.
+# Rows of the table take precedence over these.
+STAPLE_FOODS = {
+    'sugar': (65, 100.0, 1, 0.0, 0, 1),
+    'honey': (58, 82.0, 4, 0.2, 0, 1),
+    'flour': (85, 76.0, 2, 2.7, 0, 1),
+    'potato': (78, 17.0, 6, 2.2, 0, 1),
+    'salt': (0, 0.0, 38758, 0.0, 1, 0),
+    'soy sauce': (0, 5.0, 5493, 0.8, 1, 0),
+}
+
+# Grams per unit of an ingredient amount, to weight the per-100 g values by
+# how much of each ingredient a recipe uses. Volumes are taken as water
+# (1 ml = 1 g), counts ("large", "clove", or no unit as in "2 eggs") as a
+# typical size. A rough estimate, but a pinch of sugar no longer weighs as
+# much as a pound of rice.
+UNIT_GRAMS = {
+    'g': 1.0, 'gram': 1.0, 'kg': 1000.0, 'kilogram': 1000.0,
+    'ounce': 28.35, 'oz': 28.35, 'pound': 453.6, 'lb': 453.6,
+    'ml': 1.0, 'milliliter': 1.0, 'l': 1000.0, 'liter': 1000.0, 'fluid ounce': 29.6,
+    'cup': 240.0, 'tablespoon': 15.0, 'tbsp': 15.0, 'teaspoon': 5.0, 'tsp': 5.0,
+    'pint': 473.0, 'quart': 946.0, 'gallon': 3785.0, 'pinch': 0.36, 'dash': 0.6,
+    'clove': 5.0, 'slice': 30.0, 'stalk': 40.0, 'bunch': 100.0, 'ear': 90.0,
+    'small': 75.0, 'medium': 120.0, 'large': 180.0, '': 100.0,
+}
+# Amount assumed when the quantity or unit can't be read (the per-100 g values as they are)
+DEFAULT_GRAMS = 100.0
+
+# Glycemic load and sodium (mg) of a whole recipe that cost half the largest
+# health penalty: about a high-glycemic-load meal, and the daily sodium limit
+PENALTY_SCALES = {'glycemic_load': 80.0, 'sodium': 2300.0}
+
+_NUMBER = re.compile(r'(\d+(?:\.\d+)?)\s*[/\u2044]\s*(\d+)|(\d+(?:\.\d+)?)|([\u00bc-\u00be\u2150-\u215e])')
+_PACKAGE_WEIGHT = re.compile(r'\(\s*(\d+(?:\.\d+)?)\s*(ounce|oz|pound|lb|gram|g|kg)s?\b')
+
+# User condition keywords -> the health profile they map to
+CONDITION_KEYWORDS = {
+    'diabetes': ('diabet', 'blood sugar', 'insulin', 'prediabet'),
+    'hypertension': ('hypertension', 'blood pressure', 'heart', 'cardio', 'kidney'),
+}
+
+
+# Memoized: recipe steps repeat a small vocabulary millions of times
+@functools.lru_cache(maxsize=1 << 16)
+def _singular(token):
+    if len(token) > 4 and token.endswith('ies'):
+        return token[:-3] + 'y'
+    if len(token) > 4 and token.endswith('oes'):
+        return token[:-2]
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+
+def food_tokens(text):
+    """Lowercased, singularized word tokens; parenthesised notes are dropped."""
+    text = re.sub(r'\([^)]*\)', ' ', str(text).lower())
+    return tuple(_singular(token) for token in re.findall(r"[a-z]+", text))
+
+
+def parse_quantity(text):
+    """
+    The number an ingredient quantity starts with ("1 ½", "1/2", "⅓", "2-3"
+    reads as 2), or None when it doesn't start with one.
+    """
+    text = str(text or '').strip()
+    total, end = None, 0
+    for match in _NUMBER.finditer(text):
+        if text[end:match.start()].strip():
+            break
+        numerator, denominator, number, fraction = match.groups()
+        if numerator is not None:
+            value = float(numerator) / float(denominator) if float(denominator) else 0.0
+        elif number is not None:
+            value = float(number)
+        else:
+            value = unicodedata.numeric(fraction)
+        total = (total or 0.0) + value
+        end = match.end()
+    return total
+
+
+@functools.lru_cache(maxsize=1 << 14)
+def ingredient_grams(quantity, unit):
+    """
+    Estimated grams of an ingredient amount, e.g. ("1 ½", "cups") or ("1",
+    "(8 ounce) package"); DEFAULT_GRAMS when it can't be read.
+    """
+    amount = parse_quantity(quantity)
+    unit = str(unit or '').lower()
+    weight = _PACKAGE_WEIGHT.search(unit)
+    if weight is not None:
+        grams = float(weight.group(1)) * UNIT_GRAMS[weight.group(2)]
+    else:
+        grams = UNIT_GRAMS.get(' '.join(food_tokens(unit)))
+    if amount is None or grams is None:
+        return DEFAULT_GRAMS
+    return amount * grams
+
+
+def health_conditions(*texts):
+    """
+    The health profiles ('diabetes', 'hypertension') mentioned in free-text
+    user fields such as `condition` or `chronic_illnesses`.
+    """
+    text = ' '.join(str(t).lower() for t in texts if t)
+    return {
+        condition
+        for condition, keywords in CONDITION_KEYWORDS.items()
+        if any(keyword in text for keyword in keywords)
+    }
+
+
+class FoodScoringTable:
+    """
+    The diabetes food scoring table (values per 100 g), with duplicate foods
+    averaged and a phrase lookup from normalized food names to rows.
+    """
+
+    def __init__(self, path=DIABETES_DATA_PATH):
+        df = pd.read_csv(path)
+        df['Suitable for Diabetes'] = df['Suitable for Diabetes'].replace({'Yes': '1', 'No': '0'}).astype(float)
+        df['tokens'] = df['Food Name'].map(food_tokens)
+        df = df[df['tokens'].map(len) > 0]
+        staples = pd.DataFrame(
+            [(food_tokens(name),) + values for name, values in STAPLE_FOODS.items()],
+            columns=['tokens', 'Glycemic Index', 'Carbohydrates', 'Sodium Content', 'Fiber Content',
+                     'Suitable for Diabetes', 'Suitable for Blood Pressure'],
+        )
+        staples = staples[~staples['tokens'].isin(set(df['tokens']))]
+        df = pd.concat([df.drop(columns=['Food Name']), staples], ignore_index=True)
+        self.table = df.groupby('tokens').mean()
+
+        self.glycemic_load = (self.table['Glycemic Index'] * self.table['Carbohydrates'] / 100).to_numpy()
+        self.sodium = self.table['Sodium Content'].to_numpy(dtype=float)
+        self.fiber = self.table['Fiber Content'].to_numpy(dtype=float)
+        self.diabetes = self.table['Suitable for Diabetes'].to_numpy(dtype=float)
+        self.blood_pressure = self.table['Suitable for Blood Pressure'].to_numpy(dtype=float)
+
+        self.rows_by_phrase = {tokens: row for row, tokens in enumerate(self.table.index)}
+        self.max_phrase = max(len(tokens) for tokens in self.rows_by_phrase)
+        self._matches = {}
+
+    def match(self, ingredient_name):
+        """
+        Row of the food an ingredient name refers to, or None. The longest
+        food phrase found in the ingredient wins, so "chicken breast, diced"
+        matches "Chicken Breast" rather than a shorter food. Results are
+        memoized per ingredient name.
+        """
+        if ingredient_name in self._matches:
+            return self._matches[ingredient_name]
+
+        tokens = food_tokens(ingredient_name)
+        row = None
+        for size in range(min(self.max_phrase, len(tokens)), 0, -1):
+            for start in range(len(tokens) - size + 1):
+                row = self.rows_by_phrase.get(tokens[start:start + size])
+                if row is not None:
+                    break
+            if row is not None:
+                break
+        self._matches[ingredient_name] = row
+        return row
+
+
+class NutritionScores:
+    """
+    Per-recipe nutrient aggregates, stored as NumPy arrays indexed by row
+    label so a whole candidate set is scored with one fancy-indexing step.
+
+    - glycemic_load: sum over matched ingredients of GI * carbs / 100, the
+      per-100 g load weighted by the ingredient's grams (see `ingredient_grams`)
+    - sodium, fiber: sums over matched ingredients, weighted the same way
+    - diabetes_suitability, blood_pressure_suitability: share of ingredients
+      flagged suitable, with unmatched ingredients counted as 0.5 (unknown)
+    - matched_fraction: share of the ingredients found in the table
+
+    Labels without a recipe hold NaN.
+
+    Shared scores are never modified: `with_changes` returns new scores that
+    keep the arrays and look the changed rows up in `overrides` first.
+    """
+
+    def __init__(self, table=None):
+        self.table = table if table is not None else FoodScoringTable()
+        self.columns = {column: np.full(0, np.nan) for column in SCORE_COLUMNS}
+        # label -> values of the changed rows (NaN for deleted ones), also as
+        # sorted label / value arrays for vectorized lookups
+        self.overrides = {}
+        self._override_labels = np.zeros(0, dtype=np.int64)
+        self._override_values = {}
+
+    @classmethod
+    def from_series(cls, ingredients, table=None):
+        """Score every recipe of a Series of parsed ingredients keyed by row label."""
+        scores = cls(table)
+        if len(ingredients):
+            scores._reserve(int(max(ingredients.index)))
+        for label, ings in ingredients.items():
+            scores.add(label, ings)
+        return scores
+
+    def to_arrays(self):
+        """The score columns, the overrides merged in (see `from_arrays`)."""
+        return dict(self.compacted().columns)
+
+    @classmethod
+    def from_arrays(cls, arrays, table=None):
+        """The scores `to_arrays` returned."""
+        scores = cls(table)
+        scores.columns = {column: arrays[column] for column in SCORE_COLUMNS}
+        return scores
+
+    def _reserve(self, label):
+        size = len(self.columns['glycemic_load'])
+        if label < size:
+            return
+        new_size = max(label + 1, size * 2, 64)
+        for column, values in self.columns.items():
+            grown = np.full(new_size, np.nan)
+            grown[:size] = values
+            self.columns[column] = grown
+
+    def score(self, ingredients):
+        """The SCORE_COLUMNS values of one recipe, as a dict."""
+        names = ingredient_names(ingredients) or []
+        rows, hundreds = [], []
+        for item, row in zip(ingredients if names else (), map(self.table.match, names)):
+            if row is not None:
+                rows.append(row)
+                hundreds.append(ingredient_grams(item.get('quanity', item.get('quantity')), item.get('unit')) / 100)
+
+        table = self.table
+        unknown = 0.5 * (len(names) - len(rows))
+        return {
+            'glycemic_load': table.glycemic_load[rows] @ hundreds if rows else 0.0,
+            'sodium': table.sodium[rows] @ hundreds if rows else 0.0,
+            'fiber': table.fiber[rows] @ hundreds if rows else 0.0,
+            'diabetes_suitability': (table.diabetes[rows].sum() + unknown) / len(names) if names else 0.5,
+            'blood_pressure_suitability': (table.blood_pressure[rows].sum() + unknown) / len(names) if names else 0.5,
+            'matched_fraction': len(rows) / len(names) if names else 0.0,
+        }
+
+    def add(self, label, ingredients):
+        """Score a recipe row, replacing what was stored under its label."""
+        self._reserve(label)
+        for column, value in self.score(ingredients).items():
+            self.columns[column][label] = value
+
+    def remove(self, label):
+        if label < len(self.columns['glycemic_load']):
+            for values in self.columns.values():
+                values[label] = np.nan
+
+    def with_changes(self, changes):
+        """
+        New scores with rows replaced, leaving these untouched.
+
+        Parameters:
+        changes (dict): Row label -> recipe dict, or None for a deleted row.
+        """
+        deleted = dict.fromkeys(SCORE_COLUMNS, np.nan)
+        overrides = dict(self.overrides)
+        for label, recipe in changes.items():
+            overrides[label] = self.score(recipe.get('ingredients')) if recipe is not None else deleted
+
+        scores = copy.copy(self)
+        scores.overrides = overrides
+        scores._override_labels = np.array(sorted(overrides), dtype=np.int64)
+        scores._override_values = {
+            column: np.array([overrides[label][column] for label in scores._override_labels.tolist()], dtype=float)
+            for column in SCORE_COLUMNS
+        }
+        return scores
+
+    def compacted(self):
+        """The same scores as plain arrays without overrides (a full copy)."""
+        if not self.overrides:
+            return self
+        scores = type(self)(self.table)
+        scores.columns = {column: values.copy() for column, values in self.columns.items()}
+        scores._reserve(int(self._override_labels[-1]))
+        for label, values in self.overrides.items():
+            for column, value in values.items():
+                scores.columns[column][label] = value
+        return scores
+
+    def get(self, column, labels):
+        """Values of a column for an array of labels."""
+        if not self.overrides:
+            return self.columns[column][labels]
+
+        labels = np.asarray(labels, dtype=np.int64)
+        base = self.columns[column]
+        values = np.full(len(labels), np.nan)
+        inside = labels < len(base)
+        values[inside] = base[labels[inside]]
+        positions = np.minimum(np.searchsorted(self._override_labels, labels), len(self._override_labels) - 1)
+        changed = self._override_labels[positions] == labels
+        values[changed] = self._override_values[column][positions[changed]]
+        return values
+
+    def penalty(self, labels, conditions):
+        """
+        Health penalty in [0, 1) for each label, higher meaning less suitable
+        for the given conditions; 0 for everyone when there are none.
+        Glycemic load and sodium are put on a fixed scale (`PENALTY_SCALES`),
+        so a recipe's penalty doesn't depend on the other candidates; it
+        never outweighs a preferred ingredient.
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        penalty = np.zeros(len(labels))
+        if not len(labels) or not conditions:
+            return penalty
+
+        def scaled(column):
+            # In [0, 1): half way at the scale, approaching 1 far above it
+            values = np.maximum(np.nan_to_num(self.get(column, labels)), 0)
+            return values / (values + PENALTY_SCALES[column])
+
+        parts = []
+        if 'diabetes' in conditions:
+            parts.append(scaled('glycemic_load'))
+            parts.append(1 - np.nan_to_num(self.get('diabetes_suitability', labels), nan=0.5))
+        if 'hypertension' in conditions:
+            parts.append(scaled('sodium'))
+            parts.append(1 - np.nan_to_num(self.get('blood_pressure_suitability', labels), nan=0.5))
+        # Mean of terms in [0, 1], scaled to stay below one positive match
+        return np.mean(parts, axis=0) * 0.999
+
+    def within(self, labels, max_glycemic_load=None, max_sodium=None):
+        """Boolean mask of the labels under the given thresholds."""
+        labels = np.asarray(labels, dtype=np.int64)
+        mask = np.ones(len(labels), dtype=bool)
+        if max_glycemic_load is not None:
+            mask &= np.nan_to_num(self.get('glycemic_load', labels)) <= max_glycemic_load
+        if max_sodium is not None:
+            mask &= np.nan_to_num(self.get('sodium', labels)) <= max_sodium
+        return mask
@@ -0,0 +1,310 @@
+import copy
+import itertools
+import math
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from .index import ingredient_names, sparse_columns, union
+from .scoring import food_tokens
+
+# Weight of a token hit per field when ranking search results
+FIELD_WEIGHTS = {'name': 2.0, 'ingredient': 1.0}
+
+# Tokens that say little about which food is meant ("chicken meat")
+GENERIC_TOKENS = {'meat', 'fresh', 'food', 'product', 'dish', 'and', 'or', 'with', 'of'}
+
+
+def split_terms(text):
+    """
+    Split a free-text list of foods ("chicken meat , vegetables; rice and
+    beans") into its terms. Commas, semicolons, slashes, newlines and "and"
+    separate terms; the words of a term stay together.
+    """
+    terms = re.split(r'[,;/\n]|\band\b', str(text or ''))
+    return [term.strip() for term in terms if term.strip()]
+
+
+def trigrams(token):
+    """Character trigrams of a token, padded so short tokens still have some."""
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def recipe_tokens(name, ingredients):
+    """The distinct tokens of a recipe's name and of its ingredient names, per field."""
+    return {
+        'name': set(food_tokens(name or '')),
+        'ingredient': {token for ingredient in ingredient_names(ingredients) or [] for token in food_tokens(ingredient)},
+    }
+
+
+def dice(grams, token):
+    """Dice coefficient of a trigram set and the trigrams of a token."""
+    other = trigrams(token)
+    return 2 * len(grams & other) / (len(grams) + len(other))
+
+
+class SearchIndex:
+    """
+    Normalized-token index over recipe names and ingredient names, with a
+    trigram index over the token vocabulary for fuzzy lookups.
+
+    Fuzzy matching only looks at the vocabulary (distinct tokens, which grows
+    far slower than the number of recipes): a query token is compared to the
+    vocabulary tokens sharing trigrams with it, and the posting lists of the
+    similar ones are combined. Posting lists are kept per field in compressed
+    sparse column form (see `sparse_columns`), and ranking only touches the
+    labels of the matched postings, so a query costs nothing per recipe that
+    doesn't match it.
+
+    Like the other indexes, a shared index is never modified: `with_changes`
+    keeps the changed rows in a small overlay (label -> field -> tokens, and
+    field -> token -> labels) and `compacted` merges it into new arrays.
+    """
+
+    def __init__(self, vocabulary, indptr, postings, rows):
+        # field -> token -> column, in column order; the recipes with `token`
+        # in `field` are postings[field][indptr[field][c]:indptr[field][c + 1]]
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.postings = postings
+        # Sorted labels of every base row
+        self.rows = rows
+        self.trigram_postings = defaultdict(set)
+        for token in set().union(*vocabulary.values()):
+            for trigram in trigrams(token):
+                self.trigram_postings[trigram].add(token)
+        self._similar = {}
+        # Changed rows: label -> field -> tokens, field -> token -> set of
+        # labels, and the overlay tokens missing from the base vocabulary
+        self.overlay = {}
+        self._overlay_postings = {field: {} for field in FIELD_WEIGHTS}
+        self._overlay_tokens = ()
+        self.shadowed = frozenset()
+        self._shadowed_array = np.zeros(0, dtype=np.int64)
+        self._arrays = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        """Index every recipe of a DataFrame keyed by row label."""
+        vocabulary = {field: {} for field in FIELD_WEIGHTS}
+        columns = {field: [] for field in FIELD_WEIGHTS}
+        labels = {field: [] for field in FIELD_WEIGHTS}
+        for label, name, ingredients in zip(df.index, df['name'], df['ingredients']):
+            for field, tokens in recipe_tokens(name, ingredients).items():
+                columns[field].extend(vocabulary[field].setdefault(token, len(vocabulary[field])) for token in tokens)
+                labels[field].extend(itertools.repeat(label, len(tokens)))
+        return cls._from_entries(vocabulary, columns, labels, np.sort(np.asarray(df.index, dtype=np.int64)))
+
+    @classmethod
+    def _from_entries(cls, vocabulary, columns, labels, rows):
+        # (field, token, label) entries, as per-field columns and labels, into arrays
+        sparse = {
+            field: sparse_columns(list(vocabulary[field]), np.asarray(columns[field], dtype=np.int64), np.asarray(labels[field], dtype=np.int64))
+            for field in FIELD_WEIGHTS
+        }
+        return cls(
+            {field: sparse[field][0] for field in FIELD_WEIGHTS},
+            {field: sparse[field][1] for field in FIELD_WEIGHTS},
+            {field: sparse[field][2] for field in FIELD_WEIGHTS},
+            rows,
+        )
+
+    def to_arrays(self):
+        """The index as named arrays, the overlay merged in (see `from_arrays`)."""
+        index = self.compacted()
+        arrays = {'rows': index.rows}
+        for field in FIELD_WEIGHTS:
+            arrays[f'{field}.tokens'] = np.array(list(index.vocabulary[field]), dtype=str)
+            arrays[f'{field}.indptr'] = index.indptr[field]
+            arrays[f'{field}.postings'] = index.postings[field]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """The index `to_arrays` returned."""
+        return cls(
+            {field: {token: column for column, token in enumerate(arrays[f'{field}.tokens'].tolist())} for field in FIELD_WEIGHTS},
+            {field: arrays[f'{field}.indptr'] for field in FIELD_WEIGHTS},
+            {field: arrays[f'{field}.postings'] for field in FIELD_WEIGHTS},
+            arrays['rows'],
+        )
+
+    def __len__(self):
+        size = len(self.rows)
+        if self.shadowed:
+            size += len(self.overlay) - np.count_nonzero(np.isin(self._shadowed_array, self.rows, assume_unique=True))
+        return size
+
+    def with_changes(self, changes):
+        """
+        A new index with rows replaced, leaving this one untouched.
+
+        Parameters:
+        changes (dict): Row label -> recipe dict, or None for a deleted row.
+        """
+        overlay = dict(self.overlay)
+        postings = {field: dict(tokens) for field, tokens in self._overlay_postings.items()}
+        copied = set()
+
+        def posting(field, token):
+            # Copy a token's overlay postings the first time this change touches it
+            if (field, token) not in copied:
+                postings[field][token] = set(postings[field].get(token, ()))
+                copied.add((field, token))
+            return postings[field][token]
+
+        for label, recipe in changes.items():
+            for field, tokens in overlay.pop(label, {}).items():
+                for token in tokens:
+                    posting(field, token).discard(label)
+            if recipe is not None:
+                overlay[label] = recipe_tokens(recipe.get('name'), recipe.get('ingredients'))
+                for field, tokens in overlay[label].items():
+                    for token in tokens:
+                        posting(field, token).add(label)
+        for field, token in copied:
+            if not postings[field][token]:
+                del postings[field][token]
+
+        index = copy.copy(self)
+        index.overlay = overlay
+        index._overlay_postings = postings
+        index._overlay_tokens = sorted({
+            token for tokens in postings.values() for token in tokens
+            if not any(token in vocabulary for vocabulary in self.vocabulary.values())
+        })
+        index.shadowed = self.shadowed | changes.keys()
+        index._shadowed_array = np.array(sorted(index.shadowed), dtype=np.int64)
+        index._arrays = {}
+        return index
+
+    def compacted(self):
+        """The same rows without overlay, as new arrays."""
+        if not self.shadowed:
+            return self
+        vocabulary, columns, labels = {}, {}, {}
+        for field in FIELD_WEIGHTS:
+            field_columns = np.repeat(np.arange(len(self.vocabulary[field]), dtype=np.int64), np.diff(self.indptr[field]))
+            keep = ~np.isin(self.postings[field], self._shadowed_array)
+            vocabulary[field] = dict(self.vocabulary[field])
+            extra = [(vocabulary[field].setdefault(token, len(vocabulary[field])), label)
+                     for token, rows in self._overlay_postings[field].items() for label in rows]
+            columns[field] = np.concatenate([field_columns[keep], np.array([column for column, _ in extra], dtype=np.int64)])
+            labels[field] = np.concatenate([self.postings[field][keep], np.array([label for _, label in extra], dtype=np.int64)])
+        rows = self.rows[~np.isin(self.rows, self._shadowed_array, assume_unique=True)]
+        rows = np.union1d(rows, np.fromiter(self.overlay, dtype=np.int64, count=len(self.overlay)))
+        return self._from_entries(vocabulary, columns, labels, rows)
+
+    def similar(self, token, min_similarity):
+        """
+        Vocabulary tokens similar to `token` (Dice coefficient of their
+        trigram sets), as a list of (token, similarity), most similar first.
+        """
+        matches = self._base_similar(token, min_similarity)
+        if not self._overlay_tokens:
+            return matches
+        # The overlay adds a handful of tokens at most, compared one by one
+        grams = trigrams(token)
+        extra = [(candidate, dice(grams, candidate)) for candidate in self._overlay_tokens]
+        extra = [(candidate, similarity) for candidate, similarity in extra if similarity >= min_similarity]
+        if not extra:
+            return matches
+        return sorted(matches + extra, key=lambda match: (-match[1], match[0]))
+
+    def _base_similar(self, token, min_similarity):
+        # `similar` over the base vocabulary, memoized (never changes once shared)
+        key = (token, min_similarity)
+        matches = self._similar.get(key)
+        if matches is not None:
+            return matches
+
+        grams = trigrams(token)
+        shared = Counter()
+        for trigram in grams:
+            shared.update(self.trigram_postings.get(trigram, ()))
+        matches = []
+        for candidate, count in shared.items():
+            similarity = 2 * count / (len(grams) + len(trigrams(candidate)))
+            if similarity >= min_similarity:
+                matches.append((candidate, similarity))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        if len(self._similar) >= 10000:
+            self._similar.clear()
+        self._similar[key] = matches
+        return matches
+
+    def _postings_array(self, field, token):
+        # The labels of the recipes with `token` in `field`, without the
+        # shadowed ones and with the overlay's (memoized per index version)
+        array = self._arrays.get((field, token))
+        if array is None:
+            column = self.vocabulary[field].get(token)
+            if column is None:
+                array = np.zeros(0, dtype=np.int64)
+            else:
+                array = self.postings[field][self.indptr[field][column]:self.indptr[field][column + 1]]
+            if self.shadowed:
+                if len(array):
+                    array = array[~np.isin(array, self._shadowed_array, assume_unique=True)]
+                overlay = self._overlay_postings[field].get(token, ())
+                array = np.concatenate([array, np.fromiter(overlay, dtype=np.int64, count=len(overlay))])
+            self._arrays[(field, token)] = array
+        return array
+
+    def rows_matching(self, term, min_similarity, field='ingredient'):
+        """
+        Labels of the recipes whose `field` tokens fuzzily contain every
+        specific token of a term, e.g. "chiken breasts" -> recipes with
+        "chicken breast" among their ingredients, as a sorted array. Empty
+        for a term without specific tokens.
+        """
+        tokens = [token for token in food_tokens(term) if token not in GENERIC_TOKENS] or list(food_tokens(term))
+        rows = np.zeros(0, dtype=np.int64)
+        for position, token in enumerate(tokens):
+            matches = union(self._postings_array(field, candidate) for candidate, _ in self.similar(token, min_similarity))
+            rows = matches if position == 0 else np.intersect1d(rows, matches, assume_unique=True)
+            if not len(rows):
+                break
+        return rows
+
+    def search(self, query, k=10, min_similarity=0.5):
+        """
+        The `k` best fuzzy matches of a free-text query over recipe names and
+        ingredient names.
+
+        Every query token adds, for each similar vocabulary token, its
+        similarity times the field weight times the token's IDF to the
+        recipes containing it.
+
+        Returns:
+        list: (label, score) pairs, best first.
+        """
+        total = max(len(self), 1)
+        matched = []
+        for token in set(food_tokens(query)):
+            for candidate, similarity in self.similar(token, min_similarity):
+                for field, field_weight in FIELD_WEIGHTS.items():
+                    array = self._postings_array(field, candidate)
+                    if len(array):
+                        matched.append((array, similarity * field_weight * math.log(1 + total / len(array))))
+        if not matched or k <= 0:
+            return []
+
+        # Scores are accumulated over the matched postings only, never over
+        # the whole corpus: labels are unique within a posting list, so
+        # summing the weights per distinct label is exact
+        arrays, weights = zip(*matched)
+        labels, slots = np.unique(np.concatenate(arrays), return_inverse=True)
+        lengths = np.fromiter((len(array) for array in arrays), dtype=np.int64, count=len(arrays))
+        scores = np.bincount(slots, weights=np.repeat(np.asarray(weights, dtype=np.float64), lengths), minlength=len(labels))
+
+        best = np.arange(len(labels))
+        if len(best) > k:
+            # Everything tied with the k-th score, so ties are cut by label below
+            best = np.flatnonzero(scores >= np.partition(scores, len(scores) - k)[len(scores) - k])
+        # Best score first; ties in label order (`labels` is sorted)
+        best = best[np.lexsort((best, -scores[best]))][:k]
+        return [(int(labels[i]), float(scores[i])) for i in best]
@@ -0,0 +1,360 @@
+import threading
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from .index import IngredientIndex
+from .cache import normalize_ingredients, read_arrays, source_fingerprint, write_arrays
+from .config import ALLERGIC_DATA_PATH, DIABETES_DATA_PATH
+from .scoring import NutritionScores
+from .allergens import AllergenMasks
+from .search import SearchIndex
+from .relevance import RelevanceIndex
+
+# Marks a label the overlay doesn't mention (None means deleted)
+_UNCHANGED = object()
+
+# Bump when the arrays written by `RecipesSnapshot.save` change shape
+INDEX_FORMAT_VERSION = 2
+
+# The attributes of a snapshot holding its indexes
+_INDEXES = ('index', 'scores', 'allergens', 'search_index', 'relevance')
+
+
+def new_row(recipe):
+    """The row of an added recipe, as `apply` stores it."""
+    row = dict(recipe)
+    if row.get('ingredients') is not None:
+        row['ingredients'] = normalize_ingredients(row['ingredients'])
+    return row
+
+
+def indexes_fingerprint(path):
+    """
+    What the saved indexes of a recipes CSV depend on: the CSV and the food
+    scoring and allergen tables.
+    """
+    sources = [source_fingerprint(source) for source in (path, DIABETES_DATA_PATH, ALLERGIC_DATA_PATH)]
+    return ':'.join([str(INDEX_FORMAT_VERSION)] + sources)
+
+
+def labels_by_name(df):
+    """Row labels per recipe name, in label order."""
+    labels = defaultdict(list)
+    for label, name in df['name'].items():
+        labels[name].append(label)
+    return dict(labels)
+
+
+class RecipesSnapshot:
+    """
+    One immutable version of the recipes and their indexes.
+
+    The rows are a `base` DataFrame plus an `overlay` of the rows changed
+    since (label -> row dict, or None for a deleted row); `df` merges the two
+    lazily. The indexes follow the same scheme (see `IngredientIndex`), so a
+    change costs as much as the overlay, not the corpus.
+
+    Nothing reachable from a snapshot is modified once it is published:
+    `apply` builds the next version, and readers holding this one keep a
+    consistent view without locking.
+    """
+
+    def __init__(self, base, index, scores, allergens, search_index, relevance, base_labels_by_name, next_label,
+                 overlay=None, overlay_labels_by_name=None, version=0):
+        self.base = base
+        self.index = index
+        self.scores = scores
+        self.allergens = allergens
+        self.search_index = search_index
+        self.relevance = relevance
+        self.next_label = next_label
+        self.overlay = overlay or {}
+        self.version = version
+        self._base_labels_by_name = base_labels_by_name
+        # name -> labels of the overlay rows with that name
+        self._overlay_labels_by_name = overlay_labels_by_name or {}
+        self._df = None
+        self._df_lock = threading.Lock()
+
+    @classmethod
+    def build(cls, base, version=0, tables=None):
+        """
+        Index every recipe of a DataFrame.
+
+        Parameters:
+        tables (RecipesSnapshot): Reuse the food scoring and allergen tables of this snapshot.
+        """
+        return cls(
+            base,
+            # Inverted index over ingredient names
+            index=IngredientIndex.from_series(base['ingredients']),
+            # Nutrient aggregates per recipe for health-aware ranking
+            scores=NutritionScores.from_series(base['ingredients'], tables.scores.table if tables else None),
+            # Allergen-table foods each recipe mentions, for allergy exclusion
+            allergens=AllergenMasks.from_frame(base, tables.allergens.table if tables else None),
+            # Token/trigram index over names and ingredient names for fuzzy lookups
+            search_index=SearchIndex.from_frame(base),
+            # BM25 term matrix over names, ingredients and steps for profile relevance
+            relevance=RelevanceIndex.from_frame(base),
+            base_labels_by_name=labels_by_name(base),
+            next_label=int(base.index.max()) + 1 if len(base) else 0,
+            version=version,
+        )
+
+    def save(self, path, fingerprint):
+        """
+        Write the indexes (with the overlay merged in) to an .npz file, so a
+        restart can `load` them instead of building them again.
+
+        Parameters:
+        path (str): Where to write them, e.g. RES_INDEX_PATH.
+        fingerprint (str): `indexes_fingerprint` of the CSV holding these recipes.
+        """
+        snapshot = self.compacted()
+        # The CSV doesn't keep the row labels, which the indexes are keyed by
+        arrays = {'labels': snapshot.base.index.to_numpy(dtype=np.int64)}
+        for attribute in _INDEXES:
+            for key, array in getattr(snapshot, attribute).to_arrays().items():
+                arrays[f'{attribute}.{key}'] = array
+        write_arrays(path, arrays, fingerprint)
+
+    @classmethod
+    def load(cls, base, path, fingerprint, version=0, tables=None):
+        """
+        `build`, from the indexes `save` wrote for the same fingerprint.
+
+        Parameters:
+        base (DataFrame): The recipes read back from the CSV; their rows take
+        back the labels they had when the indexes were saved.
+        tables (RecipesSnapshot): Reuse the food scoring and allergen tables of this snapshot.
+
+        Returns:
+        RecipesSnapshot: None when nothing was saved for this fingerprint.
+        """
+        arrays = read_arrays(path, fingerprint)
+        if arrays is None or len(arrays['labels']) != len(base):
+            return None
+        base = base.set_axis(pd.Index(arrays['labels']))
+
+        def parts(attribute):
+            prefix = f'{attribute}.'
+            return {key[len(prefix):]: array for key, array in arrays.items() if key.startswith(prefix)}
+
+        return cls(
+            base,
+            index=IngredientIndex.from_arrays(parts('index')),
+            scores=NutritionScores.from_arrays(parts('scores'), tables.scores.table if tables else None),
+            allergens=AllergenMasks.from_arrays(parts('allergens'), tables.allergens.table if tables else None),
+            search_index=SearchIndex.from_arrays(parts('search_index')),
+            relevance=RelevanceIndex.from_arrays(parts('relevance')),
+            base_labels_by_name=labels_by_name(base),
+            next_label=int(base.index.max()) + 1 if len(base) else 0,
+            version=version,
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def df(self):
+        """All recipes as one DataFrame (materialized on first access)."""
+        if self._df is None:
+            with self._df_lock:
+                if self._df is None:
+                    self._df = self._materialize()
+        return self._df
+
+    def _materialize(self):
+        if not self.overlay:
+            return self.base
+        changed = [label for label in self.overlay if label in self.base.index]
+        rows = {label: row for label, row in self.overlay.items() if row is not None}
+        df = self.base.drop(index=changed)
+        if rows:
+            df = pd.concat([df, pd.DataFrame(list(rows.values()), index=list(rows.keys()))])
+        return df.sort_index()
+
+    def labels(self):
+        """Labels of every recipe, sorted, without materializing `df`."""
+        labels = self.base.index.to_numpy(dtype=np.int64)
+        if not self.overlay:
+            return labels
+        changed = np.fromiter(self.overlay, dtype=np.int64, count=len(self.overlay))
+        present = np.fromiter((label for label, row in self.overlay.items() if row is not None), dtype=np.int64)
+        return np.union1d(labels[~np.isin(labels, changed)], present)
+
+    def row(self, label):
+        """The current values of a row as a dict."""
+        if label in self.overlay:
+            return dict(self.overlay[label])
+        return self.base.loc[label].to_dict()
+
+    def get(self, label):
+        """`row`, or None when there is no such row."""
+        if label in self.overlay:
+            row = self.overlay[label]
+            return dict(row) if row is not None else None
+        return self.base.loc[label].to_dict() if label in self.base.index else None
+
+    def values(self, labels, column):
+        """The values of a column for a list of labels, looking the base rows up in one go."""
+        in_base = [label for label in labels if label not in self.overlay]
+        found = dict(zip(in_base, self.base[column].take(self.base.index.get_indexer(in_base)).tolist()))
+        return [self.overlay[label].get(column) if label in self.overlay else found[label] for label in labels]
+
+    def rows(self, labels):
+        """The rows with these labels, in this order, as a DataFrame."""
+        if not any(label in self.overlay for label in labels):
+            return self.base.loc[labels]
+        rows = [self.row(label) for label in labels]
+        columns = dict.fromkeys(self.base.columns)
+        columns.update((column, None) for row in rows for column in row)
+        return pd.DataFrame(rows, index=labels, columns=list(columns))
+
+    def labels_named(self, name):
+        """Labels of the recipes called `name`."""
+        labels = [label for label in self._base_labels_by_name.get(name, ()) if label not in self.overlay]
+        return sorted(labels + list(self._overlay_labels_by_name.get(name, ())))
+
+    def _name(self, label, overlay):
+        row = overlay.get(label, _UNCHANGED)
+        if row is _UNCHANGED:
+            return self.base.at[label, 'name'] if label in self.base.index else _UNCHANGED
+        return row.get('name') if row is not None else _UNCHANGED
+
+    def apply(self, records):
+        """
+        The next version, with journal records applied (no I/O).
+
+        Parameters:
+        records (list): Mutation records, as written to the `RecipeJournal`.
+        """
+        changes = {}
+        next_label = self.next_label
+        # What the records see: this version plus the changes of earlier records
+        overlay = dict(self.overlay)
+        names = dict(self._overlay_labels_by_name)
+
+        def labels_named(name):
+            labels = [label for label in self._base_labels_by_name.get(name, ()) if label not in overlay]
+            return sorted(labels + list(names.get(name, ())))
+
+        def put(label, row):
+            old_name = self._name(label, overlay)
+            if old_name is not _UNCHANGED and label in names.get(old_name, ()):
+                names[old_name] = tuple(other for other in names[old_name] if other != label)
+                if not names[old_name]:
+                    del names[old_name]
+            overlay[label] = changes[label] = row
+            if row is not None:
+                names[row.get('name')] = names.get(row.get('name'), ()) + (label,)
+
+        for record in records:
+            op = record['op']
+            if op == 'add':
+                put(next_label, new_row(record['recipe']))
+                next_label += 1
+
+            elif op == 'update':
+                fields = dict(record['fields'])
+                if fields.get('ingredients') is not None:
+                    fields['ingredients'] = normalize_ingredients(fields['ingredients'])
+                for label in labels_named(record['name']):
+                    row = dict(overlay[label]) if label in overlay else self.base.loc[label].to_dict()
+                    row.update(fields)
+                    put(label, row)
+
+            elif op == 'delete':
+                for label in labels_named(record['name']):
+                    put(label, None)
+
+        if not changes:
+            return self
+        return RecipesSnapshot(
+            self.base,
+            index=self.index.with_changes(changes),
+            scores=self.scores.with_changes(changes),
+            allergens=self.allergens.with_changes(changes),
+            search_index=self.search_index.with_changes(changes),
+            relevance=self.relevance.with_changes(changes),
+            base_labels_by_name=self._base_labels_by_name,
+            next_label=next_label,
+            overlay=overlay,
+            overlay_labels_by_name=names,
+            version=self.version + 1,
+        )
+
+    def compacted(self):
+        """
+        The same recipes with the overlay folded into a new base. Copies
+        every index, so compaction runs it off the request path.
+        """
+        if not self.overlay:
+            return self
+        base = self.df
+        return RecipesSnapshot(
+            base,
+            index=self.index.compacted(),
+            scores=self.scores.compacted(),
+            allergens=self.allergens.compacted(),
+            search_index=self.search_index.compacted(),
+            relevance=self.relevance.compacted(),
+            base_labels_by_name=labels_by_name(base),
+            next_label=self.next_label,
+            version=self.version,
+        )
+
+    def reserved(self, count):
+        """The next version, with `count` row labels taken by rows not added yet (see `merged`)."""
+        snapshot = RecipesSnapshot(self.base, self.index, self.scores, self.allergens, self.search_index,
+                                   self.relevance, self._base_labels_by_name, self.next_label + count,
+                                   self.overlay, self._overlay_labels_by_name, version=self.version + 1)
+        snapshot._df = self._df
+        return snapshot
+
+    def merged(self, rows):
+        """
+        These recipes plus new rows (a DataFrame keyed by labels taken with
+        `reserved`), indexed from scratch into a new base. For many rows this
+        is much cheaper than the overlay, whose cost grows with every change.
+        """
+        base = pd.concat([self.df, rows]).sort_index()
+        snapshot = RecipesSnapshot.build(base, version=self.version, tables=self)
+        snapshot.next_label = max(snapshot.next_label, self.next_label)
+        return snapshot
+
+    def changes_since(self, since):
+        """
+        The rows changed after `since`, an earlier version on the same base,
+        as label -> row (None for a deleted row).
+        """
+        return {label: row for label, row in self.overlay.items() if since.overlay.get(label, _UNCHANGED) is not row}
+
+    def rebase(self, onto, since):
+        """
+        This version's changes made after `since`, applied on top of `onto`
+        (`since.compacted()`): what a compaction swaps in once it is done.
+        """
+        changes = self.changes_since(since)
+        if not changes:
+            return RecipesSnapshot(onto.base, onto.index, onto.scores, onto.allergens, onto.search_index,
+                                   onto.relevance, onto._base_labels_by_name, self.next_label, version=self.version + 1)
+        names = {}
+        for label, row in changes.items():
+            if row is not None:
+                names[row.get('name')] = names.get(row.get('name'), ()) + (label,)
+        return RecipesSnapshot(
+            onto.base,
+            index=onto.index.with_changes(changes),
+            scores=onto.scores.with_changes(changes),
+            allergens=onto.allergens.with_changes(changes),
+            search_index=onto.search_index.with_changes(changes),
+            relevance=onto.relevance.with_changes(changes),
+            base_labels_by_name=onto._base_labels_by_name,
+            next_label=self.next_label,
+            overlay=changes,
+            overlay_labels_by_name=names,
+            version=self.version + 1,
+        )
@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def cache_key(prompt, model_name, generation_config, system_instruction=None):
+  """Hash of everything that determines the model output for a prompt."""
+  payload = json.dumps(
+      {"prompt": prompt, "model": model_name, "generation_config": generation_config, "system_instruction": system_instruction},
+      sort_keys=True,
+      default=str,
+  )
+  return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache():
+  """
+  Two-tier cache of raw model responses.
+
+  - memory: an LRU of the `memory_size` most recently used entries
+  - disk: an SQLite table shared by all workers, with a TTL and a size cap
+    (least recently used entries are evicted first)
+
+  Concurrent requests for the same key are coalesced: the first caller runs
+  the upstream call and the others wait for its result. Errors are never
+  cached, they are raised to every waiting caller, and neither are results
+  the caller's `valid` predicate rejects (e.g. an unparseable answer).
+
+  The async methods only touch the memory tier on the event loop; the
+  SQLite reads and writes run in a worker thread.
+  """
+
+  def __init__(self, path, memory_size=1024, ttl=7 * 24 * 3600, max_disk_bytes=256 * 1024 * 1024):
+    self.path = path
+    self.memory_size = memory_size
+    self.ttl = ttl
+    self.max_disk_bytes = max_disk_bytes
+
+    self._memory = OrderedDict()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._inflight = {}
+    self._ainflight = {}
+
+    self.hits_memory = 0
+    self.hits_disk = 0
+    self.misses = 0
+    self.coalesced = 0
+    # Upstream seconds the hits would otherwise have cost
+    self.saved_seconds = 0.0
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+
+    conn = self._connection()
+    with conn:
+      conn.execute(
+          "CREATE TABLE IF NOT EXISTS responses ("
+          "key TEXT PRIMARY KEY, value TEXT, latency REAL, size INTEGER, "
+          "expires_at REAL, last_access REAL)"
+      )
+      conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+    self._disk_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+  def _connection(self):
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=30)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("PRAGMA synchronous=NORMAL")
+      self._local.conn = conn
+    return conn
+
+  def stats(self):
+    hits = self.hits_memory + self.hits_disk
+    requests = hits + self.misses
+    return {
+        "hits_memory": self.hits_memory,
+        "hits_disk": self.hits_disk,
+        "misses": self.misses,
+        "coalesced": self.coalesced,
+        "hit_rate": hits / requests if requests else 0.0,
+        "saved_seconds": round(self.saved_seconds, 3),
+        "memory_entries": len(self._memory),
+        "disk_bytes": self._disk_bytes,
+    }
+
+  def get(self, key):
+    """Return the cached response for `key`, or None."""
+    value = self._get_memory(key)
+    return value if value is not None else self._get_disk(key)
+
+  async def aget(self, key):
+    """Async version of `get`: a memory miss is looked up on disk in a worker thread."""
+    value = self._get_memory(key)
+    return value if value is not None else await asyncio.to_thread(self._get_disk, key)
+
+  def _get_memory(self, key):
+    now = time.time()
+    with self._lock:
+      entry = self._memory.get(key)
+      if entry is not None:
+        value, latency, expires_at = entry
+        if expires_at > now:
+          self._memory.move_to_end(key)
+          self.hits_memory += 1
+          self.saved_seconds += latency
+          return value
+        del self._memory[key]
+    return None
+
+  def _get_disk(self, key):
+    now = time.time()
+    conn = self._connection()
+    row = conn.execute(
+        "SELECT value, latency, expires_at FROM responses WHERE key = ?", (key,)
+    ).fetchone()
+    if row is None or row[2] <= now:
+      return None
+
+    with conn:
+      conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+    value, latency, expires_at = row
+    with self._lock:
+      self.hits_disk += 1
+      self.saved_seconds += latency
+      self._remember(key, (value, latency, expires_at))
+    return value
+
+  def get_stale(self, key):
+    """
+    Return the response stored for `key` even if it expired (until eviction
+    removes it), or None. For answering when the model is unavailable.
+    """
+    row = self._connection().execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+    return row[0] if row is not None else None
+
+  def put(self, key, value, latency=0.0):
+    expires_at = self._put_memory(key, value, latency)
+    self._put_disk(key, value, latency, expires_at)
+
+  async def aput(self, key, value, latency=0.0):
+    """Async version of `put`: the disk write runs in a worker thread."""
+    expires_at = self._put_memory(key, value, latency)
+    await asyncio.to_thread(self._put_disk, key, value, latency, expires_at)
+
+  def _put_memory(self, key, value, latency):
+    expires_at = time.time() + self.ttl
+    with self._lock:
+      self._remember(key, (value, latency, expires_at))
+    return expires_at
+
+  def _put_disk(self, key, value, latency, expires_at):
+    now = time.time()
+    size = len(value.encode("utf-8"))
+    conn = self._connection()
+    with conn:
+      previous = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+      conn.execute(
+          "INSERT OR REPLACE INTO responses (key, value, latency, size, expires_at, last_access) "
+          "VALUES (?, ?, ?, ?, ?, ?)",
+          (key, value, latency, size, expires_at, now),
+      )
+    with self._lock:
+      self._disk_bytes += size - (previous[0] if previous else 0)
+    if self._disk_bytes > self.max_disk_bytes:
+      self.evict()
+
+  def _remember(self, key, entry):
+    # Caller holds self._lock
+    self._memory[key] = entry
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.memory_size:
+      self._memory.popitem(last=False)
+
+  def evict(self):
+    """Drop expired entries, then least recently used ones until under 90% of the size cap."""
+    conn = self._connection()
+    with conn:
+      conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+      total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+      target = self.max_disk_bytes * 0.9
+      if total > target:
+        freed = 0
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+          if total - freed <= target:
+            break
+          keys.append((key,))
+          freed += size
+        conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        total -= freed
+    with self._lock:
+      self._disk_bytes = total
+
+  def get_or_compute(self, key, compute, valid=None):
+    """
+    Return the cached response for `key`, or call `compute()` (once, even
+    when several threads ask for the same key at the same time) and cache it.
+
+    Parameters:
+    valid (callable): Whether a computed response may be cached; a rejected
+    one is still returned (to the waiting callers too), but asked again next time.
+    """
+    value = self.get(key)
+    if value is not None:
+      return value
+
+    with self._lock:
+      future = self._inflight.get(key)
+      leader = future is None
+      if leader:
+        future = self._inflight[key] = Future()
+        self.misses += 1
+      else:
+        self.coalesced += 1
+
+    if not leader:
+      return future.result()
+
+    try:
+      start = time.perf_counter()
+      value = compute()
+      if valid is None or valid(value):
+        self.put(key, value, time.perf_counter() - start)
+      future.set_result(value)
+      return value
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    finally:
+      with self._lock:
+        self._inflight.pop(key, None)
+
+  async def aget_or_compute(self, key, compute, valid=None):
+    """
+    Async version of `get_or_compute`; `compute` is a coroutine function.
+
+    The upstream call runs in its own task, which every caller (the first
+    one included) only waits for: a caller that is cancelled (e.g. its
+    client disconnected) leaves it running for the others, and it is only
+    cancelled once no caller is waiting for it any more.
+    """
+    value = await self.aget(key)
+    if value is not None:
+      return value
+
+    loop = asyncio.get_running_loop()
+    inflight = self._ainflight.setdefault(loop, {})
+    entry = inflight.get(key)
+    if entry is None:
+      # The disk lookup let other callers run, one of which may have just cached it
+      value = self._get_memory(key)
+      if value is not None:
+        return value
+      self.misses += 1
+      # [task, number of callers waiting for it]
+      entry = inflight[key] = [loop.create_task(self._acompute(key, compute, valid)), 0]
+      entry[0].add_done_callback(lambda _: self._forget(loop, key, entry))
+    else:
+      self.coalesced += 1
+
+    task = entry[0]
+    entry[1] += 1
+    try:
+      return await asyncio.shield(task)
+    except asyncio.CancelledError:
+      if not task.done() and entry[1] == 1:
+        # Nobody else is waiting: stop the call, and let the next caller start a new one
+        self._forget(loop, key, entry)
+        task.cancel()
+      raise
+    finally:
+      entry[1] -= 1
+
+  async def _acompute(self, key, compute, valid):
+    start = time.perf_counter()
+    value = await compute()
+    if valid is None or valid(value):
+      await self.aput(key, value, time.perf_counter() - start)
+    return value
+
+  def _forget(self, loop, key, entry):
+    # Drop a finished (or abandoned) call from the in-flight ones, unless a newer one replaced it
+    inflight = self._ainflight.get(loop, {})
+    if inflight.get(key) is entry:
+      del inflight[key]
+      if not inflight:
+        self._ainflight.pop(loop, None)
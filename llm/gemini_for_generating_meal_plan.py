@@ -1,49 +1,60 @@
 from .gemini_inference import GeminiInference
+from .prompting import PromptSection, full_text
+from .streaming import parse_json
 
 class GeminiForMealPlanGeneration(GeminiInference): 
+    # `astream` yields ("breakfast", {...}), ("lunch", {...}), ("dinner", {...})
+    stream_depth = 2
+    # Standard healthy plan served when the model is unavailable (see `GeminiInference.fallback`)
+    default_response = """<start>
+{"meal_plan": {
+    "breakfast": {"dish_name": "Oatmeal with berries and nuts", "ingredients": ["rolled oats", "milk or plant milk", "berries", "walnuts"], "portion_size": "1 bowl (about 300 g)"},
+    "lunch": {"dish_name": "Grilled chicken salad", "ingredients": ["chicken breast", "mixed greens", "tomato", "cucumber", "olive oil", "lemon juice"], "portion_size": "1 large plate (about 400 g)"},
+    "dinner": {"dish_name": "Baked salmon with vegetables and brown rice", "ingredients": ["salmon fillet", "broccoli", "carrots", "brown rice", "olive oil"], "portion_size": "1 plate (about 450 g)"}
+}}
+<end>"""
+
+    system_instruction = """
+You generate personalized meal plans from the diet and health parameters the user gives.
+The plan has "breakfast", "lunch" and "dinner", each with a specific dish name, its ingredients and a portion size.
+If possible, consider nutrient balance (carbs, protein, fats) and avoid ingredients that might conflict with the user's diet and health restrictions.
+Return the result in JSON format, strictly structured as follows:
+
+<start>
+{
+    "meal_plan": {
+        "breakfast": {"dish_name": "Example Dish", "ingredients": ["Ingredient1", "Ingredient2", ...], "portion_size": "Example portion size"},
+        "lunch": {"dish_name": "Example Dish", "ingredients": ["Ingredient1", "Ingredient2", ...], "portion_size": "Example portion size"},
+        "dinner": {"dish_name": "Example Dish", "ingredients": ["Ingredient1", "Ingredient2", ...], "portion_size": "Example portion size"}
+    }
+}
+<end>
+
+Only output the JSON within <start> and <end> tags.
+If you don't know or don't have enough information, answer with a standard and healthy meal plan.
+"""
+    # The parameters that matter for a meal plan, most important first; the name is left out
+    user_fields = [
+        ("food_allergies", "Food allergies"),
+        ("condition", "Condition"),
+        ("chronic_illnesses", "Chronic illnesses"),
+        ("specific_diet", "Diet"),
+        ("food_preferences", "Food preferences"),
+        ("medication", "Medication"),
+        ("symptoms", "Symptoms"),
+        ("gender", "Gender"),
+        ("date_of_birth", "Date of birth"),
+    ]
+
     def prompt(self, user_params): 
-        health_and_diet = '{' + '\n'.join("{k}: {v}" for k, v in user_params.items()) + "}"
-        return f"""
-        Hi, I'd like your help generating a personalized meal plan. Here are my diet and health parameters:
-        {health_and_diet}
-
-        Please create a meal plan that includes "breakfast," "lunch," and "dinner" with specific dish names, ingredients, and portion sizes for each meal. 
-        If possible, consider nutrient balance (carbs, protein, fats) and avoid ingredients that might conflict with my diet and health restrictions.
-
-        Please return the result in JSON format, strictly structured as follows:
-
-        <start>
-        {{
-            "meal_plan": {{
-                "breakfast": {{
-                    "dish_name": "Example Dish",
-                    "ingredients": ["Ingredient1", "Ingredient2", ...],
-                    "portion_size": "Example portion size"
-                }},
-                "lunch": {{
-                    "dish_name": "Example Dish",
-                    "ingredients": ["Ingredient1", "Ingredient2", ...],
-                    "portion_size": "Example portion size"
-                }},
-                "dinner": {{
-                    "dish_name": "Example Dish",
-                    "ingredients": ["Ingredient1", "Ingredient2", ...],
-                    "portion_size": "Example portion size"
-                }}
-            }}
-        }}
-        <end>
-
-        Only output the JSON within <start> and <end> tags. Thank you!
-        if you dont know or dont have enough information please just answer with standart and healthy meal plan
-        """
+        health_and_diet = PromptSection(self.user_fields, self.prompt_tokens).render(user_params)
+        prompt = f'My diet and health parameters:\n{health_and_diet}\n\nGenerate my "meal_plan".'
+        self.record_prompt_tokens(prompt, f'My diet and health parameters:\n{full_text(user_params)}\n\nGenerate my "meal_plan".')
+        return prompt
 
     
-    def extract_target_answer(self, response): 
-        """
-        Custom method to process the model's output.
-        It extracts the JSON data enclosed within <start> and <end> tags.
-        """
+    def _parse(self, response): 
+        # The JSON between the <start> and <end> tags; ValueError/SyntaxError if there is none
         start_tag = "<start>"
         end_tag = "<end>"
         
@@ -51,12 +62,28 @@ class GeminiForMealPlanGeneration(GeminiInference):
         end_index = response.find(end_tag, start_index)
         
         # Check if both tags are found
-        if start_index != -1 and end_index != -1:
-            # Extract the JSON content between tags
-            extracted_content = response[start_index + len(start_tag):end_index].strip()
-            return eval(extracted_content)
-        else:
+        if start_index == -1 or end_index == -1:
+            raise ValueError("Response tags are missing")
+        # JSON or a Python literal, never code
+        return parse_json(response[start_index + len(start_tag):end_index].strip())
+
+    def extract_target_answer(self, response): 
+        """
+        Custom method to process the model's output.
+        It extracts the JSON data enclosed within <start> and <end> tags.
+        """
+        try:
+            return self._parse(response)
+        except (ValueError, SyntaxError):
             # Handle case where tags are missing or malformed response
             print( {"error": "Response format is incorrect or tags are missing"})
-            return response
-    
+            self.record_parse_failure("single")
+            return {"error": "Response format is incorrect or tags are missing"}
+
+    def cacheable(self, response): 
+        """Only answers that parse into a meal plan are cached."""
+        try:
+            answer = self._parse(response)
+        except (ValueError, SyntaxError):
+            return False
+        return isinstance(answer, dict) and "meal_plan" in answer
@@ -1,41 +1,67 @@
 from .gemini_inference import GeminiInference
+from .prompting import PromptSection, full_text
+from .streaming import IncrementalJsonParser, parse_json
+
+import asyncio
 
 # New custom class for personalized recipes based on GeminiInference
 class GeminiForPersonalizedRecipes(GeminiInference): 
-    def prompt(self, user_params, recepy_params): 
-        positive_products = user_params.get("positive_products", "")
-        negative_products = user_params.get("negative_products", "")
-        specific_diet = user_params.get("specific_diet", "")
-        chronic_illnesses = user_params.get("chronic_illnesses", "")
+    system_instruction = """
+You rewrite recipes to be more comfortable for the user, given some important information about them.
+Make each recipe match the user's preferred products, diet and health conditions, and never use an ingredient they are allergic to.
+If relevant, consider health conditions like diabetes or heart health and make recommendations accordingly.
+Format each rewritten recipe as a JSON object:
 
+{
+    "recipe_name": "Recipe Name",
+    "ingredients": ["Ingredient1", "Ingredient2", ...],
+    "instructions": "Step-by-step cooking instructions."
+}
 
+Only output the JSON within <start> and <end> tags.
+If you don't know or don't have enough information, answer with a standard and healthy version of the recipe.
+"""
+    # Most important first: allergies are the last thing to trim
+    user_fields = [
+        ("negative_products", "Ingredients I am allergic to"),
+        ("chronic_illnesses", "Chronic illnesses or conditions"),
+        ("specific_diet", "Specific diet type"),
+        ("positive_products", "Products I prefer"),
+    ]
+    # What the rewrite needs of a recipe; review, meta, url and the editor's note are left out
+    recipe_fields = [
+        ("name", "Name"),
+        ("ingredients", "Ingredients"),
+        ("steps", "Steps"),
+        ("nutrition_facts", "Nutrition facts"),
+        ("cooks_note", "Cook's note"),
+    ]
 
-        return f"""
-        Hello, I need help creating a list of rewrite the recipe to more comfortable for me. Here is some important information about me:
-        
-        - products I prefer: {positive_products}
-        - Ingredients i have allelgic on: {negative_products}
-        - Specific diet type: {specific_diet}
-        - Chronic illnesses or conditions: {chronic_illnesses}
+    def _about_user(self, user_params): 
+        return PromptSection(self.user_fields, self.prompt_tokens).render(user_params)
 
-        The recipe params i need to be personalized for me: 
-        {recepy_params}
-        
-        Please generate a recipe suggestion that matches my preferences and health conditions. If relevant, consider health conditions like diabetes or heart health and make recommendations accordingly.
-        
-        Format the output as JSON with each recipe including:
-        
-        <start>
-        {{
-            "recipe_name": "Recipe Name",
-            "ingredients": ["Ingredient1", "Ingredient2", ...],
-            "instructions": "Step-by-step cooking instructions."
-        }}
-        <end>
+    def _recipe(self, recepy_params): 
+        return PromptSection(self.recipe_fields, self.prompt_tokens).render(recepy_params)
+
+    def prompt(self, user_params, recepy_params): 
+        template = "About me:\n{}\n\nThe recipe to personalize for me:\n{}\n\nAnswer with one JSON object."
+        prompt = template.format(self._about_user(user_params), self._recipe(recepy_params))
+        self.record_prompt_tokens(prompt, template.format(full_text(user_params), full_text(recepy_params)))
+        return prompt
+
+    def _parse(self, response): 
+        # The JSON within the <start> and <end> tags; ValueError/SyntaxError if it doesn't parse
+        start_tag = "<start>"
+        end_tag = "<end>"
         
-        Only output the JSON within <start> and <end> tags.
-        if you dont know or dont have enough information please just answer with standart and healthy meal plan
-        """
+        # Extract the JSON content between tags
+        extracted_content = response.split(start_tag)[-1]
+        extracted_content = extracted_content.split(end_tag)[0]
+
+        extracted_content  = extracted_content.split("</start>")[-1]
+        extracted_content  = extracted_content.split("</end>")[0]
+        # JSON or a Python literal, never code
+        return parse_json(extracted_content.strip())
 
     def extract_target_answer(self, response): 
         """
@@ -43,19 +69,152 @@ class GeminiForPersonalizedRecipes(GeminiInference):
         It extracts the JSON data enclosed within <start> and <end> tags.
         """
         try: 
-            start_tag = "<start>"
-            end_tag = "<end>"
-            
-            # Extract the JSON content between tags
-            extracted_content = response.split(start_tag)[-1]
-            extracted_content = extracted_content.split(end_tag)[0]
-
-            extracted_content  = extracted_content.split("</start>")[-1]
-            extracted_content  = extracted_content.split("</end>")[0]
-            return eval(extracted_content)
-        except:
+            return self._parse(response)
+        except (ValueError, SyntaxError):
             # Handle case where tags are missing or malformed response
             print( {"error": "Response format is incorrect or tags are missing"})
-            return 'error'
-    
+            self.record_parse_failure("single")
+            return {"error": "Response format is incorrect or tags are missing"}
+
+    def cacheable(self, response): 
+        """Only answers that parse into a recipe (or a list of them, for a batch) are cached."""
+        try: 
+            answer = self._parse(response)
+        except (ValueError, SyntaxError): 
+            return False
+        return isinstance(answer, (dict, list))
+
+    def batch_prompt(self, user_params, recipes): 
+        """
+        Prompt for personalizing several recipes in one request.
+
+        Parameters:
+        user_params (dict): Same keys as in `prompt`.
+        recipes (list): (recipe_id, recepy_params) pairs; the ids are echoed back by the model.
+        """
+        template = (
+            "About me:\n{}\n\nThe recipes to personalize for me, each with its id:\n{}\n\n"
+            'Answer with a JSON list with exactly one object per recipe, in the same order, each with the "id" of the recipe it rewrites.'
+        )
+        prompt = template.format(
+            self._about_user(user_params),
+            "\n\n".join(f"[recipe id: {recipe_id}]\n{self._recipe(recepy_params)}" for recipe_id, recepy_params in recipes),
+        )
+        self.record_prompt_tokens(prompt, template.format(
+            full_text(user_params),
+            "\n\n".join(f"[recipe id: {recipe_id}]\n{full_text(recepy_params)}" for recipe_id, recepy_params in recipes),
+        ))
+        return prompt
+
+    def extract_batch_answer(self, response, recipe_ids): 
+        """
+        Parse the answer to `batch_prompt`.
+
+        Returns:
+        dict: recipe id -> personalized recipe, only for the ids that came back
+        well-formed. Missing ids are left for the caller to retry one by one.
+        """
+        try: 
+            items = self._parse(response)
+        except (ValueError, SyntaxError): 
+            print({"error": "Batch response format is incorrect or tags are missing"})
+            self.record_parse_failure("batch")
+            return {}
+
+        if not isinstance(items, list): 
+            self.record_parse_failure("batch")
+            return {}
+
+        wanted = {str(recipe_id) for recipe_id in recipe_ids}
+        results = {}
+        for item in items: 
+            if isinstance(item, dict) and str(item.get("id")) in wanted: 
+                results[str(item.pop("id"))] = item
+        return results
+
+    def personalize_batch(self, user_params, recipes): 
+        """
+        Personalize several recipes with a single request, falling back to one
+        request per recipe for any recipe the batch answer didn't cover.
+
+        Returns:
+        list: One result per recipe, in the order of `recipes`.
+        """
+        recipe_ids = [str(recipe_id) for recipe_id, _ in recipes]
+        if not recipes: 
+            return []
+
+        results = self.extract_batch_answer(self.get_response(self.batch_prompt(user_params, recipes)), recipe_ids)
+        return [
+            results[recipe_id] if recipe_id in results else self(user_params, recepy_params)
+            for recipe_id, (_, recepy_params) in zip(recipe_ids, recipes)
+        ]
+
+    async def apersonalize_batch(self, user_params, recipes): 
+        """
+        Async version of `personalize_batch`. The per-recipe fallbacks run
+        concurrently, and a failed fallback is reported as {"error": ...} in
+        its own slot.
+        """
+        recipe_ids = [str(recipe_id) for recipe_id, _ in recipes]
+        if not recipes: 
+            return []
 
+        try: 
+            response = await self.aget_response(self.batch_prompt(user_params, recipes))
+            results = self.extract_batch_answer(response, recipe_ids)
+        except Exception as e: 
+            print({"error": f"Batch request failed: {e}"})
+            results = {}
+
+        missing = [
+            (recipe_id, recepy_params)
+            for recipe_id, (_, recepy_params) in zip(recipe_ids, recipes)
+            if recipe_id not in results
+        ]
+        fallbacks = await asyncio.gather(
+            *(self.acall(user_params, recepy_params) for _, recepy_params in missing),
+            return_exceptions=True,
+        )
+        for (recipe_id, _), result in zip(missing, fallbacks): 
+            results[recipe_id] = {"error": f"{type(result).__name__}: {result}"} if isinstance(result, Exception) else result
+
+        return [results[recipe_id] for recipe_id in recipe_ids]
+
+    async def astream_batch(self, user_params, recipes): 
+        """
+        Streaming version of `apersonalize_batch`: yields (recipe_id, result)
+        as soon as each recipe's JSON object is complete, then the per-recipe
+        fallbacks for the recipes the batch answer didn't cover.
+        """
+        recipe_ids = [str(recipe_id) for recipe_id, _ in recipes]
+        params_by_id = {recipe_id: recepy_params for recipe_id, (_, recepy_params) in zip(recipe_ids, recipes)}
+        if not recipes: 
+            return
+
+        # The batch answer is a list, so its items are one level deep
+        parser = IncrementalJsonParser(depth=1)
+        try: 
+            async for chunk in self.aget_response_stream(self.batch_prompt(user_params, recipes)): 
+                for _, item in parser.feed(chunk): 
+                    if isinstance(item, dict) and str(item.get("id")) in params_by_id: 
+                        recipe_id = str(item.pop("id"))
+                        params_by_id.pop(recipe_id)
+                        yield recipe_id, item
+        except Exception as e: 
+            print({"error": f"Batch request failed: {e}"})
+        for _ in range(parser.failures): 
+            self.record_parse_failure("stream")
+
+        missing = list(params_by_id.items())
+        fallbacks = [asyncio.ensure_future(self.acall(user_params, recepy_params)) for _, recepy_params in missing]
+        try: 
+            for (recipe_id, _), fallback in zip(missing, fallbacks): 
+                try: 
+                    yield recipe_id, await fallback
+                except Exception as e: 
+                    yield recipe_id, {"error": f"{type(e).__name__}: {e}"}
+        finally: 
+            # Closed early (the client went away): don't spend quota on answers nobody reads
+            for fallback in fallbacks: 
+                fallback.cancel()
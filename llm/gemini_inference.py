@@ -1,11 +1,39 @@
 import google.generativeai as genai
 from pathlib import Path
-from time import sleep
 
+from .cache import cache_key
+from .prompting import estimate_tokens
+from .resilience import Resilience, UpstreamUnavailable
+from .streaming import IncrementalJsonParser
+from monitoring.metrics import span, LLM_PROMPT_SIZE, LLM_PROMPT_TOKENS, LLM_RESPONSE_SIZE, LLM_PARSE_FAILURES, LLM_RESILIENCE_EVENTS
+
+import asyncio
 import os 
 
 class GeminiInference():
-  def __init__(self):
+  # How deep the objects `astream` emits are nested in the answer JSON
+  stream_depth = 0
+  # Raw answer served when the model is unavailable and nothing is cached
+  # (see `fallback`); None re-raises the error instead
+  default_response = None
+  # Instructions that are the same for every prompt (task, rules, answer
+  # format): set once on the model as its system instruction, so prompts
+  # only carry the user's and the recipes' data
+  system_instruction = None
+  # Token budget of each record (user profile, recipe) rendered into a prompt
+  prompt_tokens = 512
+
+  def __init__(self, max_concurrency=8, cache=None, resilience=None, prompt_tokens=None):
+    # Upper bound on in-flight async requests (see `aget_response`)
+    self.max_concurrency = max_concurrency
+    # Optional `ResponseCache`; responses are keyed on prompt + model + generation config + system instruction
+    self.cache = cache
+    # Deadlines, retries, rate limiting, circuit breaker and hedging of model calls
+    self.resilience = resilience if resilience is not None else Resilience()
+    if prompt_tokens is not None:
+      self.prompt_tokens = prompt_tokens
+    self._semaphore = None
+    self._semaphore_loop = None
 
     self.gemini_key = os.environ["GEMINI_API_KEY"]
 
@@ -35,9 +63,12 @@ class GeminiInference():
         },
     ]
 
-    self.model = genai.GenerativeModel(model_name="gemini-1.5-flash",
+    self.model_name = "gemini-1.5-flash"
+    self.generation_config = generation_config
+    self.model = genai.GenerativeModel(model_name=self.model_name,
                                   generation_config=generation_config,
-                                  safety_settings=safety_settings)
+                                  safety_settings=safety_settings,
+                                  system_instruction=self.system_instruction)
 
 
   def prompt(self, *args, **kwargs):
@@ -54,16 +85,178 @@ class GeminiInference():
     """
     return response
 
+  def cacheable(self, response):
+    """
+    Whether a raw model answer is worth caching. Override to reject answers
+    `extract_target_answer` can't parse, so they are asked for again instead
+    of being served until they expire.
+    """
+    return True
+
+  def _record_sizes(self, input_text, output_text):
+    labels = {"model": self.model_name, "task": type(self).__name__}
+    LLM_PROMPT_SIZE.observe(len(input_text), **labels)
+    LLM_RESPONSE_SIZE.observe(len(output_text), **labels)
+
+  def record_prompt_tokens(self, prompt, full_prompt):
+    """
+    Count the estimated tokens of a prompt as sent, and as it would be with
+    every field of its records in full (`full_prompt`).
+    """
+    labels = {"model": self.model_name, "task": type(self).__name__}
+    instruction = estimate_tokens(self.system_instruction or "")
+    LLM_PROMPT_TOKENS.inc(instruction + estimate_tokens(prompt), prompt="sent", **labels)
+    LLM_PROMPT_TOKENS.inc(instruction + estimate_tokens(full_prompt), prompt="full", **labels)
+
+  def _cache_key(self, input_text):
+    return cache_key(input_text, self.model_name, self.generation_config, self.system_instruction)
+
+  def record_parse_failure(self, answer):
+    """Count an answer of kind `answer` (single, batch, stream) that could not be parsed."""
+    LLM_PARSE_FAILURES.inc(task=type(self).__name__, answer=answer)
+
+  def _generate(self, input_text):
+    prompt_parts = [
+        input_text
+    ]
+    # Only actual round-trips; cache hits are timed by `llm.get_response`
+    with span("llm.generate"):
+      response = self.resilience.call(
+          lambda timeout: self.model.generate_content(prompt_parts, request_options={"timeout": timeout})
+      )
+    self._record_sizes(input_text, response.text)
+    return response.text
+
+  def fallback(self, input_text, error):
+    """
+    Answer for when the model is unavailable (circuit open, deadline hit or
+    retries exhausted): the last cached response to this prompt even if it
+    expired, else `default_response`, else the error is raised.
+    Fallbacks are never cached.
+    """
+    if self.cache is not None:
+      stale = self.cache.get_stale(self._cache_key(input_text))
+      if stale is not None:
+        LLM_RESILIENCE_EVENTS.inc(event="fallback_cached")
+        return stale
+    if self.default_response is not None:
+      LLM_RESILIENCE_EVENTS.inc(event="fallback_default")
+      return self.default_response
+    raise error
+
   def get_response(self, input_text):
+    with span("llm.get_response"):
+      try:
+        if self.cache is None:
+          return self._generate(input_text)
+        key = self._cache_key(input_text)
+        return self.cache.get_or_compute(key, lambda: self._generate(input_text), self.cacheable)
+      except UpstreamUnavailable as e:
+        return self.fallback(input_text, e)
+
+  def _concurrency_limit(self):
+    # asyncio primitives belong to one event loop, so make a new one per loop
+    loop = asyncio.get_running_loop()
+    if self._semaphore is None or self._semaphore_loop is not loop:
+      self._semaphore = asyncio.Semaphore(self.max_concurrency)
+      self._semaphore_loop = loop
+    return self._semaphore
+
+  async def _agenerate(self, input_text):
     prompt_parts = [
         input_text
     ]
-    response = self.model.generate_content(prompt_parts)
+    async with self._concurrency_limit():
+      with span("llm.generate"):
+        response = await self.resilience.acall(
+            lambda timeout: self.model.generate_content_async(prompt_parts, request_options={"timeout": timeout})
+        )
+    self._record_sizes(input_text, response.text)
     return response.text
 
+  async def aget_response(self, input_text):
+    """
+    Async version of `get_response`. At most `max_concurrency` requests are
+    sent at the same time; the rest wait for a free slot.
+    """
+    with span("llm.get_response"):
+      try:
+        if self.cache is None:
+          return await self._agenerate(input_text)
+        key = self._cache_key(input_text)
+        return await self.cache.aget_or_compute(key, lambda: self._agenerate(input_text), self.cacheable)
+      except UpstreamUnavailable as e:
+        return self.fallback(input_text, e)
+
+  async def _stream_chunks(self, prompt_parts, timeout):
+    response = await self.model.generate_content_async(prompt_parts, stream=True, request_options={"timeout": timeout})
+    async for chunk in response:
+      yield chunk.text
+
+  async def aget_response_stream(self, input_text):
+    """
+    Stream the model output as it is generated, chunk by chunk. A cached
+    response (or a `fallback` when the model is unavailable before the first
+    chunk) is yielded as a single chunk; a streamed one is cached once
+    complete.
+    """
+    key = None
+    if self.cache is not None:
+      key = self._cache_key(input_text)
+      cached = await self.cache.aget(key)
+      if cached is not None:
+        yield cached
+        return
+
+    prompt_parts = [
+        input_text
+    ]
+    chunks = []
+    try:
+      async with self._concurrency_limit():
+        with span("llm.stream"):
+          async for text in self.resilience.astream(lambda timeout: self._stream_chunks(prompt_parts, timeout)):
+            chunks.append(text)
+            yield text
+    except UpstreamUnavailable as e:
+      # Chunks already sent can't be replaced by a fallback
+      if chunks:
+        raise
+      yield self.fallback(input_text, e)
+      return
+
+    text = "".join(chunks)
+    self._record_sizes(input_text, text)
+    if key is not None and self.cacheable(text):
+      await self.cache.aput(key, text)
+
+  async def astream(self, *args, **kwargs):
+    """
+    Like `acall`, but yields (key, object) pairs for the objects nested
+    `stream_depth` deep in the answer as soon as each one is complete.
+    """
+    input_text = self.prompt(*args, **kwargs)
+    parser = IncrementalJsonParser(self.stream_depth)
+    emitted = 0
+    async for chunk in self.aget_response_stream(input_text):
+      for item in parser.feed(chunk):
+        emitted += 1
+        yield item
+    # An answer without any object at the expected depth is a failure too
+    for _ in range(parser.failures or int(not emitted)):
+      self.record_parse_failure("stream")
+
   def __call__(self, *args, **kwargs):
     input_text = self.prompt(*args, **kwargs)
 
     output_text = self.get_response(input_text)
     
+    return self.extract_target_answer(output_text)
+
+  async def acall(self, *args, **kwargs):
+    """Async version of `__call__`."""
+    input_text = self.prompt(*args, **kwargs)
+
+    output_text = await self.aget_response(input_text)
+
     return self.extract_target_answer(output_text)
\ No newline at end of file
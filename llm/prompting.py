@@ -0,0 +1,96 @@
+import ast
+import json
+import math
+
+# Rough size of a Gemini token, in characters of English text; close enough
+# to budget prompts without a `count_tokens` round trip per prompt
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+  """Estimated number of tokens of a text."""
+  return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _missing(value):
+  return value is None or (isinstance(value, float) and math.isnan(value)) or (isinstance(value, str) and not value.strip())
+
+
+def _ingredient(item):
+  # Corpus ingredients are {"name", "quanity", "unit"} ("quanity" is the corpus' spelling)
+  if not isinstance(item, dict):
+    return str(item)
+  parts = (item.get("quanity", item.get("quantity")), item.get("unit"), item.get("name"))
+  return " ".join(str(part) for part in parts if not _missing(part))
+
+
+def compact(value):
+  """
+  A field value as short plain text: lists joined with "; ", ingredients as
+  "quantity unit name", whitespace collapsed. Missing values give "".
+  """
+  if _missing(value):
+    return ""
+  # The CSV stores lists (e.g. steps) as the text of a Python list
+  if isinstance(value, str) and value.lstrip().startswith("["):
+    try:
+      value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+      pass
+  if isinstance(value, dict):
+    value = [value]
+  if isinstance(value, (list, tuple)):
+    return "; ".join(text for text in (compact(_ingredient(item)) for item in value) if text)
+  return " ".join(str(value).split())
+
+
+def truncate(text, tokens):
+  """`text` cut at a word boundary to about `tokens` tokens, with "…" if it was cut."""
+  limit = tokens * CHARS_PER_TOKEN
+  if len(text) <= limit:
+    return text
+  cut = text[:max(limit - 1, 0)]
+  if " " in cut:
+    cut = cut[:cut.rindex(" ")]
+  return cut.rstrip(" ;,.") + "…"
+
+
+def full_text(record):
+  """Every field of a record as JSON: what a prompt carried before trimming (see `PromptSection`)."""
+  return json.dumps(dict(record), default=str, ensure_ascii=False)
+
+
+class PromptSection():
+  """
+  Selected fields of a record (dict or pandas row) as compact
+  "label: value" lines, within a token budget.
+
+  Fields are listed most important first. Each field is kept whole while it
+  fits in what is left of the budget; the first one that doesn't is cut to
+  fit, and the ones after it are dropped. Missing fields take no room.
+
+  Parameters:
+  fields (list): (field, label) pairs, most important first.
+  tokens (int): Budget of the section, in estimated tokens.
+  """
+
+  def __init__(self, fields, tokens):
+    self.fields = list(fields)
+    self.tokens = tokens
+
+  def render(self, record):
+    lines = []
+    left = self.tokens
+    for field, label in self.fields:
+      value = compact(record.get(field))
+      if not value:
+        continue
+      line = f"{label}: {value}"
+      if estimate_tokens(line) > left:
+        # Worth cutting only if some of the value is left
+        if left - estimate_tokens(f"{label}: ") >= 8:
+          lines.append(f"{label}: " + truncate(value, left - estimate_tokens(f"{label}: ")))
+        break
+      lines.append(line)
+      left -= estimate_tokens(line) + 1
+    return "\n".join(lines)
@@ -0,0 +1,451 @@
+"""
+Deadlines, retries, rate limiting, circuit breaking and hedging for calls to
+the model.
+
+`Resilience.call` (sync) and `Resilience.acall` (async) run one logical
+request:
+
+1. fail fast with `CircuitOpenError` while the circuit breaker is open;
+2. wait for a token of the client-side rate limiter (or fail fast with
+   `RateLimited` if it can't be had before the deadline);
+3. send the call, and optionally a second identical "hedge" call if the first
+   one is slower than the recent p95; the first good answer wins;
+4. on a retryable error (timeouts, 429/5xx, connection errors) sleep a
+   jittered exponential backoff and go back to 2;
+
+all within one overall deadline. Giving up raises an `UpstreamUnavailable`,
+which callers can answer from a fallback (see `GeminiInference`).
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from monitoring.metrics import LLM_RESILIENCE_EVENTS
+
+try:
+  from google.api_core import exceptions as google_exceptions
+  _RETRYABLE_GOOGLE = (
+      google_exceptions.TooManyRequests,
+      google_exceptions.ResourceExhausted,
+      google_exceptions.ServiceUnavailable,
+      google_exceptions.InternalServerError,
+      google_exceptions.BadGateway,
+      google_exceptions.GatewayTimeout,
+      google_exceptions.DeadlineExceeded,
+      google_exceptions.Aborted,
+      google_exceptions.Unknown,
+  )
+except ImportError:
+  _RETRYABLE_GOOGLE = ()
+
+_RETRYABLE = _RETRYABLE_GOOGLE + (ConnectionError, TimeoutError, asyncio.TimeoutError)
+
+
+class UpstreamUnavailable(Exception):
+  """The model could not answer in time; serve a fallback if there is one."""
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+  pass
+
+
+class CircuitOpenError(UpstreamUnavailable):
+  pass
+
+
+class RateLimited(UpstreamUnavailable):
+  """The rate limiter can't admit the call before its deadline."""
+
+
+def is_retryable(error):
+  return isinstance(error, _RETRYABLE)
+
+
+class RetryPolicy():
+  """
+  Exponential backoff with full jitter: the n-th retry waits a random time
+  in [0, min(max_delay, base_delay * multiplier ** n)].
+  """
+
+  def __init__(self, attempts=3, base_delay=0.5, max_delay=8.0, multiplier=2.0):
+    self.attempts = attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.multiplier = multiplier
+
+  def delay(self, retry):
+    return random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** retry))
+
+
+class TokenBucket():
+  """
+  Client-side rate limiter: `rate` tokens per second, bursts of up to
+  `capacity`. `reserve` takes a token and says how long to wait for it, so
+  waiting happens outside the lock (with time.sleep or asyncio.sleep).
+
+  Tokens can be taken ahead of time, down to `capacity` tokens of debt (a
+  wait of up to 2 * capacity / rate). A token given up before it was used
+  (the call was cancelled while waiting) is handed back with `refund`, so
+  rejected and abandoned calls don't hold back the ones after them.
+  """
+
+  def __init__(self, rate, capacity=None):
+    self.rate = rate
+    self.capacity = capacity if capacity is not None else max(1.0, rate)
+    self._tokens = self.capacity
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def _refill(self):
+    # Under self._lock
+    now = time.monotonic()
+    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+  def reserve(self, max_wait=None):
+    """
+    Take a token, returning the seconds to wait before using it; or None,
+    taking nothing, if the wait would be longer than `max_wait` or the
+    bucket is already as far in debt as it goes.
+    """
+    if not self.rate:
+      return 0.0
+    with self._lock:
+      self._refill()
+      if self._tokens - 1 < -self.capacity:
+        return None
+      wait_for = max(0.0, (1 - self._tokens) / self.rate)
+      if max_wait is not None and wait_for > max_wait:
+        return None
+      self._tokens -= 1
+      return wait_for
+
+  def refund(self):
+    """Give back a token taken with `reserve` that was not used."""
+    if not self.rate:
+      return
+    with self._lock:
+      self._refill()
+      self._tokens = min(self.capacity, self._tokens + 1)
+
+  @property
+  def tokens(self):
+    """Tokens available now (negative when in debt)."""
+    if not self.rate:
+      return self.capacity
+    with self._lock:
+      self._refill()
+      return self._tokens
+
+
+class CircuitBreaker():
+  """
+  Opens after `failure_threshold` consecutive failures; while open every call
+  fails fast. After `reset_timeout` seconds one probe call is let through
+  (half-open): success closes the circuit, failure opens it again. A probe
+  that says nothing about the upstream (a non-retryable error, or
+  cancelled) is released with `release_probe`, and the next call probes.
+  """
+
+  def __init__(self, failure_threshold=5, reset_timeout=30.0):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.state = "closed"
+    self._failures = 0
+    self._opened_at = 0.0
+    self._probing = False
+    # Id of the current probe, so only its own caller can release it
+    self._probe = 0
+    self._lock = threading.Lock()
+
+  def allow(self):
+    """
+    Raise `CircuitOpenError` unless a call may be sent now.
+
+    Returns:
+    int: The probe id when the call is the half-open probe (to pass to
+    `release_probe` whatever its outcome), else None.
+    """
+    with self._lock:
+      if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+        self.state = "half_open"
+        self._probing = False
+      if self.state == "closed":
+        return None
+      if self.state == "half_open" and not self._probing:
+        self._probing = True
+        self._probe += 1
+        return self._probe
+    raise CircuitOpenError("Circuit breaker is open")
+
+  def release_probe(self, probe):
+    """
+    End probe `probe` without a verdict; a no-op once `record_success` or
+    `record_failure` settled it.
+    """
+    with self._lock:
+      if self.state == "half_open" and self._probing and self._probe == probe:
+        self._probing = False
+
+  def record_success(self):
+    with self._lock:
+      self.state = "closed"
+      self._failures = 0
+      self._probing = False
+
+  def record_failure(self):
+    with self._lock:
+      self._failures += 1
+      if self.state == "half_open" or self._failures >= self.failure_threshold:
+        if self.state != "open":
+          LLM_RESILIENCE_EVENTS.inc(event="circuit_opened")
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._probing = False
+
+
+class LatencyTracker():
+  """Latencies of the last `window` successful calls, for the hedging delay."""
+
+  def __init__(self, window=200):
+    self._samples = deque(maxlen=window)
+    self._lock = threading.Lock()
+
+  def add(self, seconds):
+    with self._lock:
+      self._samples.append(seconds)
+
+  def quantile(self, q, default):
+    with self._lock:
+      samples = sorted(self._samples)
+    if len(samples) < 20:
+      return default
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Resilience():
+  """
+  Parameters:
+  timeout (float): Overall deadline of one logical request, retries included.
+  retry (RetryPolicy): Retry schedule; RetryPolicy(attempts=1) disables retries.
+  rate_limiter (TokenBucket): Shared limiter, or None.
+  breaker (CircuitBreaker): Shared breaker, or None.
+  hedge (bool): Send a second call when the first is slower than `hedge_quantile` of recent calls.
+  hedge_quantile (float): Quantile of recent latencies after which to hedge.
+  hedge_delay (float): Hedging delay until enough latencies were seen.
+  """
+
+  def __init__(self, timeout=30.0, retry=None, rate_limiter=None, breaker=None,
+               hedge=False, hedge_quantile=0.95, hedge_delay=2.0, max_workers=32):
+    self.timeout = timeout
+    self.retry = retry or RetryPolicy()
+    self.rate_limiter = rate_limiter
+    self.breaker = breaker
+    self.hedge = hedge
+    self.hedge_quantile = hedge_quantile
+    self.hedge_delay = hedge_delay
+    self.latencies = LatencyTracker()
+    self._max_workers = max_workers
+    self._executor = None
+    self._executor_lock = threading.Lock()
+
+  def _pool(self):
+    # Sync calls run on worker threads so a hung call can be abandoned at its deadline
+    with self._executor_lock:
+      if self._executor is None:
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="llm-call")
+      return self._executor
+
+  def _hedge_after(self):
+    return self.latencies.quantile(self.hedge_quantile, self.hedge_delay) if self.hedge else None
+
+  def _admit(self, deadline):
+    """
+    Check the breaker, then take a rate-limiter token that can be used
+    before the deadline. Nothing is taken when either rejects the call.
+
+    Returns:
+    tuple: (seconds to wait for the token, probe id or None, see `CircuitBreaker.allow`).
+    """
+    probe = self.breaker.allow() if self.breaker is not None else None
+    wait_for = 0.0
+    if self.rate_limiter is not None:
+      wait_for = self.rate_limiter.reserve(max_wait=deadline - time.monotonic())
+      if wait_for is None:
+        self._release(probe)
+        raise RateLimited("Rate limit wait exceeds the deadline")
+    if wait_for:
+      LLM_RESILIENCE_EVENTS.inc(event="rate_limited")
+    return wait_for, probe
+
+  def _release(self, probe):
+    if probe is not None:
+      self.breaker.release_probe(probe)
+
+  async def _await_token(self, wait_for):
+    # A call cancelled while it waits never uses its token
+    try:
+      await asyncio.sleep(wait_for)
+    except BaseException:
+      if self.rate_limiter is not None:
+        self.rate_limiter.refund()
+      raise
+
+  def _succeeded(self, started):
+    self.latencies.add(time.monotonic() - started)
+    if self.breaker is not None:
+      self.breaker.record_success()
+
+  def _failed(self, error, attempt, deadline):
+    """Record a failed attempt; return the backoff before the next one, or raise."""
+    if self.breaker is not None and (is_retryable(error) or isinstance(error, DeadlineExceeded)):
+      self.breaker.record_failure()
+    if isinstance(error, DeadlineExceeded):
+      raise error
+    if not is_retryable(error):
+      raise error
+    if attempt + 1 >= self.retry.attempts:
+      raise UpstreamUnavailable(f"Gave up after {attempt + 1} attempts: {error!r}") from error
+    backoff = self.retry.delay(attempt)
+    if time.monotonic() + backoff >= deadline:
+      raise DeadlineExceeded(f"No time left to retry after {error!r}") from error
+    LLM_RESILIENCE_EVENTS.inc(event="retry")
+    return backoff
+
+  def call(self, fn, timeout=None):
+    """
+    Run `fn(remaining_seconds)` with the full policy, from a sync context.
+    `fn` receives the time left so it can pass it on as its own timeout.
+    """
+    deadline = time.monotonic() + (timeout if timeout is not None else self.timeout)
+    for attempt in range(self.retry.attempts):
+      wait_for, probe = self._admit(deadline)
+      try:
+        time.sleep(wait_for)
+        started = time.monotonic()
+        try:
+          result = self._call_once(fn, deadline)
+        except Exception as e:
+          backoff = self._failed(e, attempt, deadline)
+        else:
+          self._succeeded(started)
+          return result
+      finally:
+        # Whatever ended the attempt, it no longer holds the probe
+        self._release(probe)
+      time.sleep(backoff)
+
+  def _call_once(self, fn, deadline):
+    pool = self._pool()
+    pending = {pool.submit(fn, deadline - time.monotonic())}
+    hedge_after = self._hedge_after()
+    if hedge_after is not None and hedge_after < deadline - time.monotonic():
+      done, _ = wait(pending, timeout=hedge_after)
+      if not done:
+        LLM_RESILIENCE_EVENTS.inc(event="hedge")
+        pending.add(pool.submit(fn, deadline - time.monotonic()))
+
+    error = None
+    while pending:
+      done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+      if not done:
+        # The abandoned calls finish (or time out) on their own threads
+        raise DeadlineExceeded("Model call exceeded its deadline")
+      for future in done:
+        if future.exception() is None:
+          return future.result()
+        error = future.exception()
+    raise error
+
+  async def acall(self, make_coro, timeout=None):
+    """
+    Async version of `call`: `make_coro(remaining_seconds)` must return a new
+    coroutine for every attempt (and hedge).
+    """
+    deadline = time.monotonic() + (timeout if timeout is not None else self.timeout)
+    for attempt in range(self.retry.attempts):
+      wait_for, probe = self._admit(deadline)
+      try:
+        await self._await_token(wait_for)
+        started = time.monotonic()
+        try:
+          result = await self._acall_once(make_coro, deadline)
+        except Exception as e:
+          backoff = self._failed(e, attempt, deadline)
+        else:
+          self._succeeded(started)
+          return result
+      finally:
+        # Whatever ended the attempt (cancellation included), it no longer holds the probe
+        self._release(probe)
+      await asyncio.sleep(backoff)
+
+  async def _acall_once(self, make_coro, deadline):
+    pending = {asyncio.ensure_future(make_coro(deadline - time.monotonic()))}
+    try:
+      hedge_after = self._hedge_after()
+      if hedge_after is not None and hedge_after < deadline - time.monotonic():
+        done, _ = await asyncio.wait(pending, timeout=hedge_after)
+        if not done:
+          LLM_RESILIENCE_EVENTS.inc(event="hedge")
+          pending.add(asyncio.ensure_future(make_coro(deadline - time.monotonic())))
+
+      error = None
+      while pending:
+        done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+          raise DeadlineExceeded("Model call exceeded its deadline")
+        for task in done:
+          if task.exception() is None:
+            return task.result()
+          error = task.exception()
+      raise error
+    finally:
+      # The losing hedge (or a call past its deadline) is not needed any more
+      for task in pending:
+        task.cancel()
+
+  async def astream(self, make_stream, timeout=None):
+    """
+    Stream the chunks of `make_stream(remaining_seconds)` (an async iterator)
+    under the deadline, breaker and rate limiter. Retries only happen before
+    the first chunk, since chunks already passed on can't be taken back.
+    Streams are never hedged.
+    """
+    deadline = time.monotonic() + (timeout if timeout is not None else self.timeout)
+    for attempt in range(self.retry.attempts):
+      started_streaming = False
+      wait_for, probe = self._admit(deadline)
+      try:
+        await self._await_token(wait_for)
+        started = time.monotonic()
+        try:
+          stream = make_stream(deadline - time.monotonic()).__aiter__()
+          while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+              raise DeadlineExceeded("Model stream exceeded its deadline")
+            try:
+              chunk = await asyncio.wait_for(stream.__anext__(), remaining)
+            except StopAsyncIteration:
+              break
+            except asyncio.TimeoutError:
+              raise DeadlineExceeded("Model stream exceeded its deadline")
+            started_streaming = True
+            yield chunk
+        except Exception as e:
+          if started_streaming:
+            if self.breaker is not None and is_retryable(e):
+              self.breaker.record_failure()
+            raise
+          backoff = self._failed(e, attempt, deadline)
+        else:
+          self._succeeded(started)
+          return
+      finally:
+        # Also when the consumer stops early (GeneratorExit) or is cancelled
+        self._release(probe)
+      await asyncio.sleep(backoff)
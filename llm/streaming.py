@@ -0,0 +1,109 @@
+import ast
+import json
+import re
+
+# The key a value belongs to, e.g. `"breakfast": ` right before its `{`
+_KEY_BEFORE = re.compile(r'"((?:[^"\\]|\\.)*)"\s*:\s*$')
+
+
+def parse_json(text):
+  """json.loads, falling back to Python literals (single quotes, True/None)."""
+  try:
+    return json.loads(text)
+  except ValueError:
+    return ast.literal_eval(text)
+
+
+class IncrementalJsonParser():
+  """
+  Pulls JSON objects out of a response while it is still being generated.
+
+  Text is fed chunk by chunk; everything before `start_tag` is ignored. Every
+  time an object nested `depth` containers deep is closed, `feed` returns it
+  as a (key, object) pair, where key is its key in the enclosing object (None
+  inside a list). With depth=2 and
+
+      {"meal_plan": {"breakfast": {...}, "lunch": {...}}}
+
+  the meals come out one by one as soon as each closing brace arrives.
+  """
+
+  def __init__(self, depth, start_tag="<start>", end_tag="<end>"):
+    self.depth = depth
+    self.start_tag = start_tag
+    self.end_tag = end_tag
+
+    self._buffer = ""
+    self._started = False
+    self._done = False
+    self._pos = 0
+    self._stack = []
+    self._in_string = False
+    self._escaped = False
+    self._object_start = None
+    # Completed objects that were not valid JSON (or Python literals)
+    self.failures = 0
+
+  def feed(self, chunk):
+    """Consume a chunk of model output and return the objects it completed."""
+    if self._done:
+      return []
+    self._buffer += chunk
+
+    if not self._started:
+      start = self._buffer.find(self.start_tag)
+      if start == -1:
+        # Keep just enough to recognise a tag split across chunks
+        self._buffer = self._buffer[-len(self.start_tag):]
+        return []
+      self._buffer = self._buffer[start + len(self.start_tag):]
+      self._started = True
+
+    completed = []
+    buffer = self._buffer
+    pos = self._pos
+    while pos < len(buffer):
+      char = buffer[pos]
+      if self._in_string:
+        if self._escaped:
+          self._escaped = False
+        elif char == "\\":
+          self._escaped = True
+        elif char == '"':
+          self._in_string = False
+      elif char == '"':
+        self._in_string = True
+      elif char in "{[":
+        if char == "{" and len(self._stack) == self.depth:
+          self._object_start = pos
+        self._stack.append(char)
+      elif char in "}]":
+        if self._stack:
+          self._stack.pop()
+        if char == "}" and len(self._stack) == self.depth and self._object_start is not None:
+          completed.append(self._complete(self._object_start, pos + 1))
+          self._object_start = None
+        if not self._stack:
+          self._done = True
+          break
+      elif buffer.startswith(self.end_tag, pos) and not self._stack:
+        self._done = True
+        break
+      pos += 1
+    self._pos = pos
+
+    # Nothing before the current top-level object is needed any more
+    if self._object_start is None and len(self._stack) <= self.depth:
+      keep_from = max(0, pos - 256)
+      self._buffer = buffer[keep_from:]
+      self._pos = pos - keep_from
+    return [item for item in completed if item is not None]
+
+  def _complete(self, start, end):
+    key_match = _KEY_BEFORE.search(self._buffer[max(0, start - 256):start])
+    key = key_match.group(1) if key_match else None
+    try:
+      return key, parse_json(self._buffer[start:end])
+    except (ValueError, SyntaxError):
+      self.failures += 1
+      return None
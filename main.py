@@ -1,113 +1,207 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from typing import Optional, List
+import json
+import threading
+import time
 import pandas as pd
-import os
-
-from config import USERS_DATASET_PATH, MAX_RECEPIES_AT_REQUEST
 
+from config import (
+    USERS_DATASET_PATH,
+    USERS_BACKEND,
+    USERS_DB_PATH,
+    USERS_CACHE_SIZE,
+    MEAL_PLANS_DB_PATH,
+    MEAL_PLAN_PRECOMPUTE_WORKERS,
+    MAX_RECEPIES_AT_REQUEST,
+    CANDIDATE_CACHE_SIZE,
+    BULK_BATCH_SIZE,
+    PERSONALIZED_RECEPIES_AT_REQUEST,
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_PROMPT_TOKENS,
+    GEMINI_CACHE_PATH,
+    GEMINI_CACHE_MEMORY_SIZE,
+    GEMINI_CACHE_TTL,
+    GEMINI_CACHE_MAX_BYTES,
+    GEMINI_TIMEOUT,
+    GEMINI_RETRIES,
+    GEMINI_BACKOFF_BASE,
+    GEMINI_BACKOFF_MAX,
+    GEMINI_RATE_LIMIT,
+    GEMINI_RATE_BURST,
+    GEMINI_BREAKER_FAILURES,
+    GEMINI_BREAKER_RESET,
+    GEMINI_HEDGE,
+    GEMINI_HEDGE_QUANTILE,
+    PROFILING_ENABLED,
+    PROFILING_INTERVAL,
+    PROFILES_DIR,
+)
+
+from models import User, Recipe
+from bulk import NdjsonImport, ndjson_lines, recipe_records, user_records
 from llm.gemini_for_generating_meal_plan import GeminiForMealPlanGeneration
 from llm.gemini_for_personalized_recepies import GeminiForPersonalizedRecipes
+from llm.cache import ResponseCache
+from llm.resilience import Resilience, RetryPolicy, TokenBucket, CircuitBreaker
 
 from food_databases.management import RecipesStorage  # Importing RecipesStorage
+from food_databases.candidates import CandidateCache
+from food_databases.scoring import health_conditions
+from food_databases.search import split_terms
+from user_databases.management import create_user_repository
+from user_databases.meal_plans import MealPlanStore, precompute_meal_plans, profile_version, should_store
+from monitoring.metrics import REGISTRY, REQUEST_LATENCY, instrument
+from monitoring.profiler import SamplingProfiler
 
 app = FastAPI()
 
 # CSV file path
 CSV_FILE = USERS_DATASET_PATH
 
-# Define user model
-class User(BaseModel):
-    name: str
-    date_of_birth: str
-    gender: Optional[str] = None
-    condition: Optional[str] = None
-    food_allergies: Optional[str] = None
-    specific_diet: Optional[str] = None
-    chronic_illnesses: Optional[str] = None
-    symptoms: Optional[str] = None
-    food_preferences: Optional[str] = None
-    medication: Optional[str] = None
-
-# Define recipe model
-class Recipe(BaseModel):
-    name: str
-    review: Optional[str] = None
-    rating: Optional[float] = None
-    meta: Optional[str] = None
-    ingredients: List[str]
-    steps: List[str]
-    cooks_note: Optional[str] = None
-    editors_note: Optional[str] = None
-    nutrition_facts: Optional[str] = None
-    url: Optional[str] = None
-
 # Initialize RecipesStorage instance
 recipes_storage = RecipesStorage()
-meal_plan_generator =   GeminiForMealPlanGeneration()
-gemini_recipes = GeminiForPersonalizedRecipes()
-
-
-def initialize_csv():
-    directory = os.path.dirname(CSV_FILE)
-    if directory and not os.path.exists(directory):
-        os.makedirs(directory)
-    
-    if not os.path.exists(CSV_FILE):
-        df = pd.DataFrame(columns=User.schema()["properties"].keys())
-        df.to_csv(CSV_FILE, index=False)
-
-initialize_csv()
-
-# Helper to load users
-def load_users():
-    return pd.read_csv(CSV_FILE).dropna()
-
-# Helper to save users
-def save_users(df):
-    df.to_csv(CSV_FILE, index=False)
+# Each user's ranked candidate recipes, dropped when the user or a relevant recipe changes
+candidate_cache = CandidateCache(recipes_storage, CANDIDATE_CACHE_SIZE)
+# Shared by both models; the model name is part of the cache key
+gemini_cache = ResponseCache(
+    GEMINI_CACHE_PATH,
+    memory_size=GEMINI_CACHE_MEMORY_SIZE,
+    ttl=GEMINI_CACHE_TTL,
+    max_disk_bytes=GEMINI_CACHE_MAX_BYTES,
+)
+# One rate limit and circuit breaker for the API key both models share
+gemini_resilience = Resilience(
+    timeout=GEMINI_TIMEOUT,
+    retry=RetryPolicy(attempts=GEMINI_RETRIES, base_delay=GEMINI_BACKOFF_BASE, max_delay=GEMINI_BACKOFF_MAX),
+    rate_limiter=TokenBucket(GEMINI_RATE_LIMIT, GEMINI_RATE_BURST),
+    breaker=CircuitBreaker(GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET),
+    hedge=GEMINI_HEDGE,
+    hedge_quantile=GEMINI_HEDGE_QUANTILE,
+)
+meal_plan_generator =   GeminiForMealPlanGeneration(max_concurrency=GEMINI_MAX_CONCURRENCY, cache=gemini_cache, resilience=gemini_resilience, prompt_tokens=GEMINI_PROMPT_TOKENS)
+gemini_recipes = GeminiForPersonalizedRecipes(max_concurrency=GEMINI_MAX_CONCURRENCY, cache=gemini_cache, resilience=gemini_resilience, prompt_tokens=GEMINI_PROMPT_TOKENS)
+
+# User store (see USERS_BACKEND in config.py)
+users_storage = create_user_repository(
+    USERS_BACKEND,
+    fields=User.schema()["properties"].keys(),
+    csv_path=CSV_FILE,
+    db_path=USERS_DB_PATH,
+    cache_size=USERS_CACHE_SIZE,
+)
+# Meal plans generated ahead of time (or on first request), per profile version
+meal_plans = MealPlanStore(MEAL_PLANS_DB_PATH)
+# The precompute run started through the admin endpoint, if any
+precompute_thread = None
+precompute_lock = threading.Lock()
+
+# Per-stage latency on /metrics (stage_duration_seconds{stage="recipes.top_k"}, ...)
+instrument(recipes_storage, 'recipes', ['filter', 'top_k', 'search', 'add', 'update', 'delete', 'reload'])
+instrument(users_storage, 'users', ['get', 'list', 'page', 'create', 'update', 'delete'])
+REGISTRY.callback(
+    'cache_requests_total', 'Lookups in the in-process caches.', 'counter', ['cache', 'result'],
+    lambda: {
+        ('llm_responses', 'memory_hit'): gemini_cache.hits_memory,
+        ('llm_responses', 'disk_hit'): gemini_cache.hits_disk,
+        ('llm_responses', 'miss'): gemini_cache.misses,
+        ('llm_responses', 'coalesced'): gemini_cache.coalesced,
+        ('users', 'hit'): getattr(users_storage, 'hits', 0),
+        ('users', 'miss'): getattr(users_storage, 'misses', 0),
+        ('meal_plans', 'hit'): meal_plans.hits,
+        ('meal_plans', 'miss'): meal_plans.misses,
+        ('candidates', 'hit'): candidate_cache.hits,
+        ('candidates', 'miss'): candidate_cache.misses,
+    },
+)
+REGISTRY.callback(
+    'llm_circuit_open', 'Whether the Gemini circuit breaker is open (1), half-open (0.5) or closed (0).', 'gauge', [],
+    lambda: {(): {'open': 1, 'half_open': 0.5}.get(gemini_resilience.breaker.state, 0)},
+)
+REGISTRY.callback(
+    'llm_cache_saved_seconds_total', 'Upstream LLM time saved by response cache hits.', 'counter', [],
+    lambda: {(): gemini_cache.saved_seconds},
+)
+
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    # Streaming responses are timed until their headers are sent; their
+    # LLM stages show up in stage_duration_seconds
+    profiler = None
+    if PROFILING_ENABLED and (request.headers.get("x-profile") or request.query_params.get("profile")):
+        profiler = SamplingProfiler(PROFILING_INTERVAL).start()
+
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", "unmatched")
+        REQUEST_LATENCY.observe(time.perf_counter() - start, method=request.method, route=route_path, status=status)
+        if profiler is not None:
+            profile_path = await run_in_threadpool(profiler.save, PROFILES_DIR, f"{request.method} {route_path}")
+    if profiler is not None:
+        response.headers["X-Profile"] = profile_path
+    return response
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 # User management endpoints
 @app.post("/users/")
 def create_user(user: User):
-    df = load_users()
-    if user.name in df['name'].values:
+    if not users_storage.create(user.dict()):
         raise HTTPException(status_code=400, detail="User already exists.")
-    df = df._append(user.dict(), ignore_index=True)
-    save_users(df)
     return {"message": "User created successfully", "user": user}
 
 @app.get("/users/")
-def get_all_users():
-    df = load_users()
-    return df.to_dict(orient="records")
+def get_all_users(response: Response, limit: Optional[int] = None, cursor: Optional[str] = None):
+    # Without `limit` every user is returned; with it, the cursor of the next
+    # page (if any) is sent in the X-Next-Cursor header
+    if limit is None and cursor is None:
+        return users_storage.list()
+    try:
+        users, next_cursor = users_storage.page(max(0, MAX_RECEPIES_AT_REQUEST if limit is None else limit), cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return users
 
 @app.get("/users/{user_name}")
 def get_user(user_name: str):
-    df = load_users()
-    user = df[df['name'] == user_name]
-    if user.empty:
+    user = users_storage.get(user_name)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return user.to_dict(orient="records")[0]
+    return user
 
 @app.put("/users/{user_name}")
 def update_user(user_name: str, user: User):
-    df = load_users()
-    user_index = df.index[df['name'] == user_name].tolist()
-    if not user_index:
+    try:
+        updated = users_storage.update(user_name, user.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not updated:
         raise HTTPException(status_code=404, detail="User not found")
-    df.loc[user_index[0], :] = user.dict()
-    save_users(df)
+    candidate_cache.invalidate(user_name)
+    candidate_cache.invalidate(user.name)
+    if user.name != user_name:
+        meal_plans.delete(user_name)
     return {"message": "User updated successfully", "user": user}
 
 @app.delete("/users/{user_name}")
 def delete_user(user_name: str):
-    df = load_users()
-    user_index = df.index[df['name'] == user_name].tolist()
-    if not user_index:
+    if not users_storage.delete(user_name):
         raise HTTPException(status_code=404, detail="User not found")
-    df = df.drop(user_index[0])
-    save_users(df)
+    meal_plans.delete(user_name)
+    candidate_cache.invalidate(user_name)
     return {"message": "User deleted successfully"}
 
 # Recipes management endpoints
@@ -130,66 +224,269 @@ def delete_recipe(recipe_name: str):
         raise HTTPException(status_code=404, detail="Recipe not found.")
     return {"message": "Recipe deleted successfully"}
 
-@app.post("/recipes/filter/")
-def filter_recipes(positive_products: List[str], negative_products: List[str]):
+@app.post("/admin/recipes/reload")
+def reload_recipes():
+    # Rebuilds the recipes and indexes from the CSV on disk; requests keep
+    # being served from the current version until the new one is swapped in
+    version = recipes_storage.reload()
+    return {"message": "Recipes reloaded", "version": version, "recipes": len(recipes_storage.snapshot)}
+
+async def import_ndjson(request, model, apply, batch_size):
+    # The body is parsed as it arrives and stored a batch at a time
+    parser = NdjsonImport(model, batch_size)
+    imported = 0
+    async for chunk in request.stream():
+        for batch in parser.feed(chunk):
+            imported += await run_in_threadpool(apply, batch)
+    for batch in parser.close():
+        imported += await run_in_threadpool(apply, batch)
+    return {"imported": imported, **parser.report()}
+
+@app.post("/admin/recipes/import")
+async def import_recipes(request: Request, batch_size: int = BULK_BATCH_SIZE):
+    # NDJSON body, one `Recipe` per line; invalid lines are skipped and reported.
+    # The recipes are indexed once, and become visible, when the body is done.
+    recipe_import = await run_in_threadpool(recipes_storage.begin_import)
+    try:
+        return await import_ndjson(request, Recipe, recipe_import.add, batch_size)
+    finally:
+        await run_in_threadpool(recipe_import.finish)
+        # Takes the storage locks and fsyncs the journal: not on the event loop
+        await run_in_threadpool(recipes_storage.compact, False)
+
+@app.get("/admin/recipes/export")
+def export_recipes():
+    # NDJSON, one `Recipe` per line, from the current snapshot
+    return StreamingResponse(ndjson_lines(recipe_records(recipes_storage.snapshot)), media_type="application/x-ndjson")
+
+@app.post("/admin/users/import")
+async def import_users(request: Request, batch_size: int = BULK_BATCH_SIZE):
+    # NDJSON body, one `User` per line; users that already exist are skipped
+    return await import_ndjson(request, User, users_storage.create_many, batch_size)
+
+@app.get("/admin/users/export")
+def export_users():
+    return StreamingResponse(ndjson_lines(user_records(users_storage)), media_type="application/x-ndjson")
+
+@app.get("/llm/cache")
+def llm_cache_stats():
+    return gemini_cache.stats()
+
+def without_nan(df):
+    """Missing values as None, so recipes added without optional fields serialize to JSON."""
+    return df.astype(object).where(df.notna(), None)
 
-    filtered_recipes = recipes_storage.filter(positive_products, negative_products)
-    return {'filtered_recepies': filtered_recipes.head(MAX_RECEPIES_AT_REQUEST).to_dict()}
+@app.post("/recipes/filter/")
+def filter_recipes(
+    positive_products: List[str],
+    negative_products: List[str],
+    limit: int = MAX_RECEPIES_AT_REQUEST,
+    cursor: Optional[str] = None,
+    conditions: List[str] = Query(default=[]),
+    max_glycemic_load: Optional[float] = None,
+    max_sodium: Optional[float] = None,
+    relevant_to: Optional[str] = None,
+):
+    # Only the requested page is ranked; pass `next_cursor` back to get the next one.
+    # `conditions` (e.g. diabetes, hypertension) reorders equally good matches by health,
+    # `relevant_to` (free text, e.g. "spicy vegetarian") by BM25 relevance.
+    limit = max(0, min(limit, MAX_RECEPIES_AT_REQUEST))
+    try:
+        filtered_recipes, next_cursor = recipes_storage.top_k(
+            positive_products, negative_products, limit, cursor,
+            conditions=health_conditions(*conditions),
+            max_glycemic_load=max_glycemic_load,
+            max_sodium=max_sodium,
+            profile=relevant_to,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {'filtered_recepies': without_nan(filtered_recipes).to_dict(), 'next_cursor': next_cursor}
+
+@app.get("/recipes/search")
+def search_recipes(q: str, limit: int = 10):
+    # Fuzzy, ranked matches of `q` against recipe and ingredient names
+    limit = max(0, min(limit, MAX_RECEPIES_AT_REQUEST))
+    found_recipes = recipes_storage.search(q, limit)
+    return {'recepies': without_nan(found_recipes).to_dict(orient='records')}
 
 # Endpoint to generate a meal plan for a user by name
 
 @app.get("/users/{user_name}/meal_plan")
-def generate_meal_plan(user_name: str):
-    df = load_users()
-    user_row = df[df['name'] == user_name]
+async def generate_meal_plan(user_name: str):
+    # User parameters as a dictionary
+    user_params = await run_in_threadpool(users_storage.get, user_name)
     
-    if user_row.empty:
+    if user_params is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Extract user parameters into a dictionary
-    user_params = user_row.iloc[0].to_dict()
+    # A plan precomputed (or generated earlier) from this version of the profile
+    meal_plan = await run_in_threadpool(meal_plans.get, user_name, profile_version(user_params))
+    if meal_plan is not None:
+        return {"user_name": user_name, "meal_plan": meal_plan}
     
     # Generate the meal plan using the GeminiForMealPlanGeneration class
-    meal_plan = meal_plan_generator(user_params=user_params)
+    meal_plan = await meal_plan_generator.acall(user_params=user_params)
     
     if "error" in meal_plan:
         raise HTTPException(status_code=500, detail="Error generating meal plan: " + meal_plan["error"])
+    if should_store(meal_plan_generator, meal_plan):
+        await run_in_threadpool(meal_plans.put, user_name, profile_version(user_params), meal_plan)
     
     return {"user_name": user_name, "meal_plan": meal_plan}
 
 
-@app.get("/users/{username}/recipes")
-def recipes_for_user(username: str):
+@app.post("/admin/meal_plans/precompute")
+def start_meal_plan_precompute(workers: int = MEAL_PLAN_PRECOMPUTE_WORKERS, fresh: bool = False, force: bool = False):
+    # Runs in the background; an interrupted run is resumed unless `fresh`
+    global precompute_thread
+    with precompute_lock:
+        if precompute_thread is not None and precompute_thread.is_alive():
+            raise HTTPException(status_code=409, detail="A meal plan precompute run is already in progress.")
+        precompute_thread = threading.Thread(
+            target=precompute_meal_plans,
+            args=(users_storage, meal_plans, meal_plan_generator),
+            kwargs={"workers": max(1, workers), "resume": not fresh, "force": force},
+            name="meal-plan-precompute",
+            daemon=True,
+        )
+        precompute_thread.start()
+    return {"message": "Meal plan precompute started"}
+
+
+@app.get("/admin/meal_plans/precompute")
+def meal_plan_precompute_status():
+    run = meal_plans.run()
+    if run is None:
+        raise HTTPException(status_code=404, detail="No meal plan precompute run yet")
+    return {**run, "running": precompute_thread is not None and precompute_thread.is_alive()}
+
+
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@app.get("/users/{user_name}/meal_plan/stream")
+async def stream_meal_plan(user_name: str):
+    """
+    Server-sent events: one `meal` event per meal as soon as it is generated
+    (all at once for a stored plan), then `done`. An `error` event is sent
+    when the answer can't be parsed into meals.
+    """
+    user_params = await run_in_threadpool(users_storage.get, user_name)
+    if user_params is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    version = profile_version(user_params)
+
+    async def events():
+        # A plan precomputed (or generated earlier) from this version of the profile, as `/meal_plan` serves it
+        stored = await run_in_threadpool(meal_plans.get, user_name, version)
+        if stored is not None:
+            for meal, plan in stored.get("meal_plan", {}).items():
+                yield sse_event("meal", {"meal": meal, **plan})
+            yield sse_event("done", {"user_name": user_name})
+            return
+
+        meals = {}
+        try:
+            async for meal, plan in meal_plan_generator.astream(user_params=user_params):
+                meals[meal] = dict(plan)
+                yield sse_event("meal", {"meal": meal, **plan})
+        except Exception as e:
+            yield sse_event("error", {"error": f"{type(e).__name__}: {e}"})
+        else:
+            if not meals:
+                yield sse_event("error", {"error": "Response format is incorrect or tags are missing"})
+            elif should_store(meal_plan_generator, {"meal_plan": meals}):
+                await run_in_threadpool(meal_plans.put, user_name, version, {"meal_plan": meals})
+        yield sse_event("done", {"user_name": user_name})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def personalization_inputs(username):
+    """User context for the recipes prompt and the candidate recipes, best first."""
     # Load user data
-    df = load_users()
-    user = df[df['name'] == username]
+    user_info = await run_in_threadpool(users_storage.get, username)
     
     # Check if user exists
-    if user.empty:
+    if user_info is None:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Extract user preferences and allergies
-    user_info = user.iloc[0].to_dict()  # Get user row as dictionary
-    positive_products = user_info.get("food_preferences", "")
-    negative_products = user_info.get("food_allergies", "")
-    specific_diet = user_info.get("specific_diet", "")
-    chronic_illnesses = user_info.get("chronic_illnesses", "")
-
-
-    filtered_recipes = recipes_storage.filter(str(positive_products).split(), str(negative_products).split())
-    filtered_recipes = pd.concat([filtered_recipes, recipes_storage.filter([], str(negative_products).split())])
+    positive_products = user_info.get("food_preferences") or ""
+    negative_products = user_info.get("food_allergies") or ""
+    specific_diet = user_info.get("specific_diet") or ""
+    chronic_illnesses = user_info.get("chronic_illnesses") or ""
+    # Health-aware ranking for users with diabetes or high blood pressure
+    conditions = health_conditions(user_info.get("condition"), chronic_illnesses)
+    # Equally good matches are ordered by how relevant they are to the whole profile
+    profile = " ".join(str(user_info.get(field) or "") for field in ("food_preferences", "specific_diet", "condition"))
+
+
+    def candidate_recipes():
+        # Only the MAX_RECEPIES_AT_REQUEST best matches are ever used; top up
+        # with recipes that merely avoid the allergies if there are too few
+        # "chicken meat , vegetables" -> ["chicken meat", "vegetables"]
+        filtered_recipes, _ = recipes_storage.top_k(split_terms(positive_products), split_terms(negative_products), MAX_RECEPIES_AT_REQUEST, conditions=conditions, profile=profile)
+        topped_up = len(filtered_recipes) < MAX_RECEPIES_AT_REQUEST
+        if topped_up:
+            filtered_recipes = pd.concat([filtered_recipes, recipes_storage.top_k([], split_terms(negative_products), MAX_RECEPIES_AT_REQUEST, conditions=conditions, profile=profile)[0]])
+            # The second filter repeats the recipes of the first one
+            filtered_recipes = filtered_recipes[~filtered_recipes.index.duplicated()].iloc[:MAX_RECEPIES_AT_REQUEST]
+        return filtered_recipes, topped_up
+
+    # Served from the candidate cache while neither the user nor a relevant recipe changed
+    filtered_recipes = await run_in_threadpool(
+        candidate_cache.get, username, profile_version(user_info), split_terms(positive_products), candidate_recipes, profile,
+    )
 
     
     # Prepare user context
     user_context = {
-        "preferred_products": positive_products,
-        "allergic_products": negative_products,
+        "positive_products": positive_products,
+        "negative_products": negative_products,
         "specific_diet": specific_diet,
         "chronic_illnesses": chronic_illnesses,
     }
-    
-    personalized_recepies = list() 
-    for i in range(3): 
-        personalized_recepies.append(gemini_recipes(user_context, filtered_recipes.iloc[i]))    
+    return user_context, filtered_recipes
+
 
-    return {"username": username, "personalized_recipes": personalized_recepies, "other_recepies": filtered_recipes.iloc[3:MAX_RECEPIES_AT_REQUEST]}
+@app.get("/users/{username}/recipes")
+async def recipes_for_user(username: str):
+    user_context, filtered_recipes = await personalization_inputs(username)
+    
+    # Personalize the top recipes in one batched request (recipes the batch
+    # answer misses are retried one by one, concurrently)
+    n_personalized = min(PERSONALIZED_RECEPIES_AT_REQUEST, len(filtered_recipes))
+    top_recipes = filtered_recipes.iloc[:n_personalized]
+    personalized_recepies = await gemini_recipes.apersonalize_batch(
+        user_context,
+        [(label, recipe) for label, recipe in top_recipes.iterrows()],
+    )
+
+    return {"username": username, "personalized_recipes": personalized_recepies, "other_recepies": without_nan(filtered_recipes.iloc[n_personalized:MAX_RECEPIES_AT_REQUEST])}
+
+
+@app.get("/users/{username}/recipes/stream")
+async def stream_recipes_for_user(username: str):
+    """
+    Server-sent events: `other_recepies` right away, then one `recipe` event
+    per personalized recipe as soon as it is generated, then `done`.
+    """
+    user_context, filtered_recipes = await personalization_inputs(username)
+    n_personalized = min(PERSONALIZED_RECEPIES_AT_REQUEST, len(filtered_recipes))
+    top_recipes = filtered_recipes.iloc[:n_personalized]
+    other_recipes = filtered_recipes.iloc[n_personalized:MAX_RECEPIES_AT_REQUEST]
+
+    async def events():
+        yield sse_event("other_recepies", json.loads(other_recipes.to_json(orient="records", default_handler=str)))
+        async for recipe_id, recipe in gemini_recipes.astream_batch(
+            user_context,
+            [(label, recipe) for label, recipe in top_recipes.iterrows()],
+        ):
+            yield sse_event("recipe", {"recipe_id": recipe_id, **recipe} if isinstance(recipe, dict) else {"recipe_id": recipe_id, "recipe": recipe})
+        yield sse_event("done", {"username": username})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,34 @@
+from pydantic import BaseModel
+from typing import Optional, List, Union
+
+# Define user model
+class User(BaseModel):
+    name: str
+    date_of_birth: str
+    gender: Optional[str] = None
+    condition: Optional[str] = None
+    food_allergies: Optional[str] = None
+    specific_diet: Optional[str] = None
+    chronic_illnesses: Optional[str] = None
+    symptoms: Optional[str] = None
+    food_preferences: Optional[str] = None
+    medication: Optional[str] = None
+
+# An ingredient as the corpus stores it ("quanity" is the corpus' spelling)
+class Ingredient(BaseModel):
+    name: str
+    quanity: Optional[str] = None
+    unit: Optional[str] = None
+
+# Define recipe model; ingredients are names or full corpus ingredients
+class Recipe(BaseModel):
+    name: str
+    review: Optional[str] = None
+    rating: Optional[float] = None
+    meta: Optional[str] = None
+    ingredients: List[Union[str, Ingredient]]
+    steps: List[str]
+    cooks_note: Optional[str] = None
+    editors_note: Optional[str] = None
+    nutrition_facts: Optional[str] = None
+    url: Optional[str] = None
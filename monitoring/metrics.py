@@ -0,0 +1,228 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Counters and histograms are kept per label set in a `Registry` and rendered
+by `Registry.render` for the `/metrics` endpoint. Values that already live
+elsewhere (e.g. the hit counts of `ResponseCache`) are read at scrape time
+through `Registry.callback`.
+
+`span(stage)` times a block (or, as `timed(stage)`, a function or coroutine)
+into `stage_duration_seconds`, so a slow request can be broken down into its
+user lookup, storage and LLM stages.
+"""
+import asyncio
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Characters
+SIZE_BUCKETS = (256, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels), ((), 0.0))
+        return sum(counts)
+
+    def render(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = self.header()
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class CallbackMetric(Metric):
+    """A counter or gauge whose values are read from `fn()` at scrape time."""
+
+    def __init__(self, name, help, kind, labelnames, fn):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self.fn = fn
+
+    def render(self):
+        # fn returns {label values tuple: value}
+        return self.header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+            for key, value in sorted(self.fn().items())
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, kind, labelnames, fn):
+        """
+        Register values computed at scrape time.
+
+        Parameters:
+        kind (str): 'counter' or 'gauge'.
+        fn (callable): Returns {tuple of label values: value}.
+        """
+        self.metrics.pop(name, None)
+        return self.register(CallbackMetric(name, help, kind, labelnames, fn))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.histogram(
+    'http_request_duration_seconds', 'HTTP request latency.', ['method', 'route', 'status'])
+STAGE_LATENCY = REGISTRY.histogram(
+    'stage_duration_seconds', 'Latency of one stage of a request (storage, users, LLM).', ['stage'])
+STAGE_ERRORS = REGISTRY.counter(
+    'stage_errors_total', 'Stages that raised an exception.', ['stage'])
+# `task` is the GeminiInference subclass, e.g. GeminiForMealPlanGeneration
+LLM_PROMPT_SIZE = REGISTRY.histogram(
+    'llm_prompt_chars', 'Size of the prompts sent to the LLM.', ['model', 'task'], SIZE_BUCKETS)
+# `prompt` is "sent" (system instruction included) or "full" (the same prompt
+# with every field of its records in full, see llm/prompting.py)
+LLM_PROMPT_TOKENS = REGISTRY.counter(
+    'llm_prompt_tokens_total', 'Estimated tokens of the prompts sent to the LLM, and of the untrimmed prompts.', ['model', 'task', 'prompt'])
+LLM_RESPONSE_SIZE = REGISTRY.histogram(
+    'llm_response_chars', 'Size of the LLM responses.', ['model', 'task'], SIZE_BUCKETS)
+LLM_PARSE_FAILURES = REGISTRY.counter(
+    'llm_parse_failures_total', 'LLM answers that could not be parsed.', ['task', 'answer'])
+# retry, hedge, rate_limited, circuit_opened, fallback_cached, fallback_default
+LLM_RESILIENCE_EVENTS = REGISTRY.counter(
+    'llm_resilience_events_total', 'Retries, hedged calls, rate-limit waits, breaker trips and fallbacks.', ['event'])
+
+
+@contextmanager
+def span(stage):
+    """Time a block into `stage_duration_seconds{stage=...}`; exceptions are counted too."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        # A cancelled request is not an error of the stage
+        if not isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+            STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed(stage):
+    """Decorator version of `span` for functions and coroutine functions."""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument(obj, prefix, methods):
+    """
+    Time the given methods of one object as stages `<prefix>.<method>`,
+    without touching its class (e.g. `instrument(users_storage, 'users', ['get'])`).
+    """
+    for method in methods:
+        setattr(obj, method, timed(f'{prefix}.{method}')(getattr(obj, method)))
+    return obj
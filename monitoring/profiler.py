@@ -0,0 +1,66 @@
+"""
+A small sampling profiler for profiling single requests in production.
+
+A background thread takes a snapshot of every other thread's Python stack
+every `interval` seconds and counts identical stacks. The result is written
+in the collapsed-stack format ("outer;inner;leaf count" per line), which
+flamegraph.pl and speedscope read directly.
+
+Sampling all threads means that work a request hands to the thread pool is
+included, but so is whatever concurrent requests are doing at the time.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and return the collapsed stacks."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.collapsed()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+    def save(self, directory, name):
+        """Stop sampling and write the collapsed stacks to `<directory>/<time>-<name>.folded`."""
+        collapsed = self.stop()
+        os.makedirs(directory, exist_ok=True)
+        safe_name = ''.join(char if char.isalnum() else '_' for char in name).strip('_')
+        path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{time.time_ns() % 10**9:09d}-{safe_name}.folded')
+        with open(path, 'w') as f:
+            f.write(collapsed)
+        return path
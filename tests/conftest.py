@@ -0,0 +1,33 @@
+"""
+A small `RecipesStorage` working on copies in a temporary directory.
+"""
+import os
+
+import pandas as pd
+import pytest
+
+from food_databases.management import RecipesStorage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def recipes_paths(tmp_path, monkeypatch):
+    """Keyword arguments of a `RecipesStorage` on the first 60 recipes of the corpus."""
+    # The food tables are read from their default, relative paths
+    monkeypatch.chdir(ROOT)
+    csv_path = str(tmp_path / 'recepies.csv')
+    pd.read_csv('food_databases/recepies.csv', nrows=60).to_csv(csv_path, index=False)
+    return {
+        'path': csv_path,
+        'cache_path': str(tmp_path / 'recepies.arrow'),
+        'journal_path': str(tmp_path / 'recepies.journal'),
+        'index_path': str(tmp_path / 'recepies.indexes.npz'),
+    }
+
+
+@pytest.fixture
+def open_storage(recipes_paths):
+    """Open a `RecipesStorage` on `recipes_paths`; opening it again is a restart."""
+    return lambda **kwargs: RecipesStorage(**recipes_paths, **kwargs)
+
@@ -0,0 +1,85 @@
+"""
+Invalidation of the candidate recipes cache (food_databases/candidates.py)
+by recipe and user changes.
+"""
+import pytest
+
+from food_databases.candidates import CandidateCache
+
+
+def recipe(storage, name, *ingredients):
+    return dict(storage.df.iloc[0].to_dict(), name=name,
+                ingredients=[{'name': ingredient, 'quanity': '1', 'unit': ''} for ingredient in ingredients])
+
+
+@pytest.fixture
+def storage(open_storage):
+    return open_storage()
+
+
+@pytest.fixture
+def cache(storage):
+    return CandidateCache(storage)
+
+
+def candidates(cache, storage, positive_terms, name='alice', version='v1'):
+    """The user's candidates, ranked as `RecipesStorage.top_k` would."""
+    def compute():
+        return storage.top_k(positive_terms, [], 1000)[0], not positive_terms
+    return cache.get(name, version, positive_terms, compute)
+
+
+def test_repeated_requests_are_hits(cache, storage):
+    first = candidates(cache, storage, ['garlic'])
+    second = candidates(cache, storage, ['garlic'])
+    assert list(second.index) == list(first.index)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_adding_a_matching_recipe_invalidates(cache, storage):
+    candidates(cache, storage, ['garlic'])
+    storage.add(recipe(storage, 'Garlic Bread', 'garlic cloves', 'bread'))
+    assert len(cache) == 0
+
+    recomputed = candidates(cache, storage, ['garlic'])
+    assert 'Garlic Bread' in set(recomputed['name'])
+    assert cache.misses == 2
+
+
+def test_adding_an_unrelated_recipe_keeps_the_entry(cache, storage):
+    first = candidates(cache, storage, ['garlic'])
+    storage.add(recipe(storage, 'Saffron Milk', 'saffron threads', 'milk'))
+    assert len(cache) == 1
+
+    second = candidates(cache, storage, ['garlic'])
+    assert list(second.index) == list(first.index)
+    assert cache.hits == 1
+
+
+def test_deleting_a_listed_recipe_invalidates(cache, storage):
+    listed = candidates(cache, storage, ['garlic'])
+    storage.delete(listed['name'].iloc[0])
+    assert len(cache) == 0
+    assert listed['name'].iloc[0] not in set(candidates(cache, storage, ['garlic'])['name'])
+
+
+def test_entries_open_to_any_recipe_are_dropped_on_every_add(cache, storage):
+    candidates(cache, storage, [])
+    storage.add(recipe(storage, 'Saffron Milk', 'saffron threads', 'milk'))
+    assert len(cache) == 0
+
+
+def test_user_changes_invalidate(cache, storage):
+    candidates(cache, storage, ['garlic'])
+    # A new version of the user record misses, an invalidated user too
+    candidates(cache, storage, ['garlic'], version='v2')
+    assert cache.misses == 2
+    cache.invalidate('alice')
+    assert len(cache) == 0
+
+
+def test_reload_drops_every_entry(cache, storage):
+    candidates(cache, storage, ['garlic'])
+    candidates(cache, storage, ['onion'], name='bob')
+    storage.reload()
+    assert len(cache) == 0
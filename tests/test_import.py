@@ -0,0 +1,136 @@
+"""
+Bulk imports of recipes (`RecipesStorage.begin_import`) interleaved with
+other writers, compactions, reloads and restarts.
+"""
+import collections
+import threading
+
+import pytest
+
+import food_databases.management as management
+
+
+def recipe(storage, name, **fields):
+    return dict(storage.df.iloc[0].to_dict(), name=name, **fields)
+
+
+def batch(storage, prefix, size=30):
+    return [recipe(storage, f'{prefix} {i}') for i in range(size)]
+
+
+def names(storage):
+    return collections.Counter(storage.df['name'])
+
+
+def imported(storage):
+    return sum(name.startswith('imported ') for name in storage.df['name'])
+
+
+def in_thread(fn, *args):
+    """Start `fn(*args)` in a thread; returns the thread and the list its result goes to."""
+    results = []
+    thread = threading.Thread(target=lambda: results.append(fn(*args)), daemon=True)
+    thread.start()
+    return thread, results
+
+
+def waits(thread):
+    """Whether `thread` is still blocked a little later."""
+    thread.join(0.3)
+    return thread.is_alive()
+
+
+@pytest.fixture
+def storage(open_storage, monkeypatch):
+    # Compact every other batch, so imports write to the CSV while they run
+    monkeypatch.setattr(management, 'IMPORT_FLUSH_ROWS', 50)
+    return open_storage()
+
+
+def test_imported_recipes_appear_on_finish(storage, open_storage):
+    expected = names(storage)
+    recipe_import = storage.begin_import()
+    for number in range(5):
+        rows = batch(storage, f'imported {number}')
+        recipe_import.add(rows)
+        expected.update(row['name'] for row in rows)
+        assert imported(storage) == 0
+    recipe_import.finish()
+
+    assert names(storage) == expected
+    assert storage.df.index.is_unique
+    restarted = open_storage()
+    assert names(restarted) == expected
+    assert list(restarted.df.index) == list(storage.df.index)
+
+
+def test_other_changes_during_an_import_are_kept(storage, open_storage):
+    expected = names(storage)
+    recipe_import = storage.begin_import()
+    for number in range(5):
+        rows = batch(storage, f'imported {number}')
+        recipe_import.add(rows)
+        expected.update(row['name'] for row in rows)
+        storage.add(recipe(storage, f'plain {number}'))
+        expected[f'plain {number}'] += 1
+        victim = storage.df['name'].iloc[10 + number]
+        assert storage.delete(victim)
+        expected[victim] -= 1
+    # Compacts while the import is in progress
+    storage.compact()
+    recipe_import.finish()
+
+    expected = +expected
+    assert names(storage) == expected
+    storage.compact()
+    assert names(open_storage()) == expected
+
+
+def test_changes_to_an_imported_name_wait_for_finish(storage):
+    recipe_import = storage.begin_import()
+    recipe_import.add(batch(storage, 'imported'))
+    update, updated = in_thread(storage.update, 'imported 3', {'steps': 'simmer'})
+    # Other names don't wait
+    assert storage.update(storage.df['name'].iloc[0], {'steps': 'boil'})
+
+    assert waits(update)
+    recipe_import.finish()
+    update.join()
+    assert updated == [True]
+    assert storage.df.loc[storage.snapshot.labels_named('imported 3'), 'steps'].tolist() == ['simmer']
+
+
+def test_reload_and_other_imports_wait_for_finish(storage):
+    recipe_import = storage.begin_import()
+    recipe_import.add(batch(storage, 'imported'))
+    reload, _ = in_thread(storage.reload)
+    second, second_import = in_thread(storage.begin_import)
+
+    assert waits(reload) and waits(second)
+    recipe_import.finish()
+    # Either may go first; the reload waits for the second import otherwise
+    second.join()
+    second_import[0].finish()
+    reload.join()
+    assert imported(storage) == 30
+
+
+def test_restart_during_an_import_replays_it(storage, open_storage):
+    before = len(storage.snapshot)
+    recipe_import = storage.begin_import()
+    for number in range(4):
+        recipe_import.add(batch(storage, f'imported {number}'))
+
+    # The process dies before `finish`: the journal holds every batch
+    restarted = open_storage()
+    assert len(restarted.snapshot) == before + 120
+    assert imported(restarted) == 120
+
+
+def test_finished_import_takes_no_more_batches(storage):
+    recipe_import = storage.begin_import()
+    recipe_import.finish()
+    with pytest.raises(RuntimeError):
+        recipe_import.add(batch(storage, 'imported'))
+    # The storage takes new imports
+    storage.begin_import().finish()
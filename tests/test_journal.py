@@ -0,0 +1,135 @@
+"""
+Crash recovery of recipe changes through the journal (food_databases/journal.py).
+
+A crash is simulated by opening a second `RecipesStorage` on the same files
+while the first one is left as it was.
+"""
+import glob
+import os
+import threading
+
+from food_databases.journal import RecipeJournal
+
+
+def recipe(storage, name, **fields):
+    return dict(storage.df.iloc[0].to_dict(), name=name, **fields)
+
+
+def names(storage):
+    return sorted(storage.df['name'])
+
+
+def write_changes(storage):
+    """Add, update and delete a recipe; returns the name deleted."""
+    deleted = storage.df['name'].iloc[5]
+    storage.add(recipe(storage, 'Journaled Soup', steps='boil'))
+    storage.update('Journaled Soup', {'steps': 'simmer'})
+    storage.delete(deleted)
+    return deleted
+
+
+def steps_of(storage, name):
+    return storage.df.loc[storage.snapshot.labels_named(name), 'steps'].tolist()
+
+
+class Crash(Exception):
+    pass
+
+
+def compact_crashing_before_csv(storage, recipes_paths, monkeypatch):
+    """Compact, with the process dying once the segments are sealed but before the new CSV is renamed into place."""
+    replace = os.replace
+
+    def replace_all_but_csv(src, dst):
+        if dst == recipes_paths['path']:
+            raise Crash()
+        replace(src, dst)
+
+    crashes = []
+    monkeypatch.setattr(os, 'replace', replace_all_but_csv)
+    # The compaction thread dies with it
+    monkeypatch.setattr(threading, 'excepthook', lambda args: crashes.append(args.exc_type))
+    storage.compact()
+    monkeypatch.undo()
+    assert crashes == [Crash]
+
+
+# --- Live journal ---
+
+def test_restart_replays_the_journal(open_storage):
+    storage = open_storage()
+    deleted = write_changes(storage)
+
+    restarted = open_storage()
+    assert names(restarted) == names(storage)
+    assert deleted not in names(restarted)
+    assert steps_of(restarted, 'Journaled Soup') == ['simmer']
+    assert list(restarted.df.index) == list(storage.df.index)
+
+
+def test_torn_last_record_is_cut_off(open_storage, recipes_paths):
+    storage = open_storage()
+    storage.add(recipe(storage, 'Journaled Soup'))
+    # Crash in the middle of writing the next record
+    with open(recipes_paths['journal_path'], 'a', encoding='utf-8') as f:
+        f.write('{"op": "add", "recipe": {"name": "Torn')
+
+    restarted = open_storage()
+    assert names(restarted) == names(storage)
+    # Later records are appended to a parseable log
+    restarted.add(recipe(restarted, 'Second Soup'))
+    assert 'Second Soup' in names(open_storage())
+
+
+def test_compaction_folds_the_journal_into_the_csv(open_storage, recipes_paths):
+    storage = open_storage()
+    write_changes(storage)
+    storage.compact()
+
+    assert os.path.getsize(recipes_paths['journal_path']) == 0
+    assert not glob.glob(f"{recipes_paths['journal_path']}.*.segment")
+    restarted = open_storage()
+    assert names(restarted) == names(storage)
+    assert steps_of(restarted, 'Journaled Soup') == ['simmer']
+
+
+# --- Compaction crashes ---
+
+def test_crash_before_the_csv_is_replaced_replays_the_segments(open_storage, recipes_paths, monkeypatch):
+    storage = open_storage()
+    deleted = write_changes(storage)
+    compact_crashing_before_csv(storage, recipes_paths, monkeypatch)
+
+    assert glob.glob(f"{recipes_paths['journal_path']}.*.segment")
+    restarted = open_storage()
+    assert names(restarted) == names(storage)
+    assert deleted not in names(restarted)
+    assert steps_of(restarted, 'Journaled Soup') == ['simmer']
+
+
+def test_crash_after_the_csv_is_replaced_drops_the_segments(open_storage, recipes_paths, monkeypatch):
+    storage = open_storage()
+    write_changes(storage)
+    # The new CSV is in place, but the sealed segments are left behind
+    monkeypatch.setattr(RecipeJournal, 'discard', staticmethod(lambda segments: None))
+    storage.compact()
+    monkeypatch.undo()
+
+    assert glob.glob(f"{recipes_paths['journal_path']}.*.segment")
+    restarted = open_storage()
+    # Replaying them again would add the recipe twice
+    assert names(restarted) == names(storage)
+    assert names(restarted).count('Journaled Soup') == 1
+    assert not glob.glob(f"{recipes_paths['journal_path']}.*.segment")
+
+
+def test_changes_during_a_crashed_compaction_survive(open_storage, recipes_paths, monkeypatch):
+    storage = open_storage()
+    write_changes(storage)
+    compact_crashing_before_csv(storage, recipes_paths, monkeypatch)
+    # Written to the live log after the rotation
+    storage.add(recipe(storage, 'Later Soup'))
+
+    restarted = open_storage()
+    assert names(restarted) == names(storage)
+    assert 'Later Soup' in names(restarted)
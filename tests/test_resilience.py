@@ -0,0 +1,325 @@
+"""
+The Gemini resilience layer (llm/resilience.py) against the local fake
+model of the benchmarks (benchmarks/fake_llm.py).
+"""
+import asyncio
+import time
+
+import pytest
+
+from benchmarks.fake_llm import FakeGenerativeModel
+from llm.resilience import (
+    CircuitBreaker, CircuitOpenError, DeadlineExceeded, RateLimited, Resilience, RetryPolicy, TokenBucket,
+    UpstreamUnavailable,
+)
+from monitoring.metrics import LLM_RESILIENCE_EVENTS
+
+FAST_RETRY = RetryPolicy(attempts=3, base_delay=0.01, max_delay=0.02)
+
+
+def call(fake):
+    """`Resilience.call` argument sending one prompt to the fake model."""
+    return lambda timeout: fake.generate_content(['prompt'], request_options={'timeout': timeout})
+
+
+def acall(fake):
+    return lambda timeout: fake.generate_content_async(['prompt'], request_options={'timeout': timeout})
+
+
+def stream(fake):
+    async def chunks(timeout):
+        response = await fake.generate_content_async(['prompt'], stream=True, request_options={'timeout': timeout})
+        async for chunk in response:
+            yield chunk.text
+    return chunks
+
+
+def events(event):
+    return LLM_RESILIENCE_EVENTS.value(event=event)
+
+
+def failing_until(fake, calls):
+    """Make the fake fail its first `calls` calls, then recover."""
+    fake.down = True
+    original = fake._plan
+
+    def plan(request_options):
+        fake.down = fake.calls < calls
+        return original(request_options)
+    fake._plan = plan
+
+
+# Retries and deadlines
+
+def test_backoff_is_jittered_and_capped():
+    policy = RetryPolicy(base_delay=0.5, max_delay=3.0, multiplier=2.0)
+    for retry, cap in [(0, 0.5), (1, 1.0), (2, 2.0), (5, 3.0)]:
+        delays = [policy.delay(retry) for _ in range(200)]
+        assert all(0 <= delay <= cap for delay in delays)
+        assert max(delays) > cap / 2
+
+
+def test_retries_transient_errors():
+    fake = FakeGenerativeModel(latency=0)
+    failing_until(fake, 2)
+    retries = events('retry')
+
+    assert Resilience(timeout=5, retry=FAST_RETRY).call(call(fake)).text.startswith('<start>')
+    assert fake.calls == 3
+    assert events('retry') - retries == 2
+
+
+def test_async_retries_transient_errors():
+    fake = FakeGenerativeModel(latency=0)
+    failing_until(fake, 1)
+
+    result = asyncio.run(Resilience(timeout=5, retry=FAST_RETRY).acall(acall(fake)))
+    assert result.text.startswith('<start>')
+    assert fake.calls == 2
+
+
+def test_gives_up_after_the_last_attempt():
+    fake = FakeGenerativeModel(latency=0, down=True)
+    with pytest.raises(UpstreamUnavailable):
+        Resilience(timeout=5, retry=FAST_RETRY).call(call(fake))
+    assert fake.calls == 3
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    fake = FakeGenerativeModel(latency=0, down=True, errors=(ValueError,))
+    with pytest.raises(ValueError):
+        Resilience(timeout=5, retry=FAST_RETRY).call(call(fake))
+    assert fake.calls == 1
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_slow_call_hits_the_deadline(mode):
+    fake = FakeGenerativeModel(latency=2.0)
+    resilience = Resilience(timeout=0.2, retry=FAST_RETRY)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        if mode == 'sync':
+            resilience.call(call(fake))
+        else:
+            asyncio.run(resilience.acall(acall(fake)))
+    assert time.monotonic() - started < 1.0
+
+
+def test_no_retry_past_the_deadline():
+    fake = FakeGenerativeModel(latency=0, down=True)
+    resilience = Resilience(timeout=0.1, retry=RetryPolicy(attempts=5, base_delay=10, max_delay=10))
+    # The backoff can't fit before the deadline, unless the jitter draws ~0
+    with pytest.raises(UpstreamUnavailable):
+        resilience.call(call(fake))
+    assert fake.calls <= 2
+
+
+# Circuit breaker
+
+def make_breaker_resilience():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    return breaker, Resilience(timeout=5, retry=RetryPolicy(attempts=1), breaker=breaker)
+
+
+def open_circuit(resilience, fake):
+    fake.down = True
+    for _ in range(2):
+        with pytest.raises(UpstreamUnavailable):
+            resilience.call(call(fake))
+    assert resilience.breaker.state == 'open'
+
+
+def test_breaker_opens_then_recovers_through_a_probe():
+    fake = FakeGenerativeModel(latency=0)
+    breaker, resilience = make_breaker_resilience()
+    open_circuit(resilience, fake)
+
+    # Open: fails fast, without calling the model
+    calls = fake.calls
+    with pytest.raises(CircuitOpenError):
+        resilience.call(call(fake))
+    assert fake.calls == calls
+
+    # Half-open after the reset timeout: one probe, which closes it
+    time.sleep(0.15)
+    fake.down = False
+    resilience.call(call(fake))
+    assert breaker.state == 'closed'
+    resilience.call(call(fake))
+
+
+def test_failed_probe_opens_the_circuit_again():
+    fake = FakeGenerativeModel(latency=0)
+    breaker, resilience = make_breaker_resilience()
+    open_circuit(resilience, fake)
+
+    time.sleep(0.15)
+    with pytest.raises(UpstreamUnavailable):
+        resilience.call(call(fake))
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        resilience.call(call(fake))
+
+    time.sleep(0.15)
+    fake.down = False
+    resilience.call(call(fake))
+    assert breaker.state == 'closed'
+
+
+def test_only_one_probe_at_a_time():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.allow() is not None
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_non_retryable_probe_is_released():
+    fake = FakeGenerativeModel(latency=0)
+    breaker, resilience = make_breaker_resilience()
+    open_circuit(resilience, fake)
+
+    time.sleep(0.15)
+    fake.errors = (ValueError,)
+    with pytest.raises(ValueError):
+        resilience.call(call(fake))
+    # Inconclusive: still half-open, and the next call may probe
+    assert breaker.state == 'half_open'
+    fake.down = False
+    resilience.call(call(fake))
+    assert breaker.state == 'closed'
+
+
+def test_cancelled_probe_is_released():
+    fake = FakeGenerativeModel(latency=5.0)
+    breaker, resilience = make_breaker_resilience()
+    open_circuit(resilience, FakeGenerativeModel(latency=0))
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(resilience.acall(acall(fake)))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    time.sleep(0.15)
+    asyncio.run(cancel_probe())
+    assert breaker.state == 'half_open'
+    fake.latency = 0
+    fake.down = False
+    asyncio.run(resilience.acall(acall(fake)))
+    assert breaker.state == 'closed'
+
+
+def test_abandoned_stream_probe_is_released():
+    fake = FakeGenerativeModel(latency=0, chunk_size=4)
+    breaker, resilience = make_breaker_resilience()
+    open_circuit(resilience, fake)
+    fake.down = False
+
+    async def first_chunk():
+        chunks = resilience.astream(stream(fake))
+        chunk = await chunks.__anext__()
+        # The consumer stops early: GeneratorExit inside the stream
+        await chunks.aclose()
+        return chunk
+
+    time.sleep(0.15)
+    assert asyncio.run(first_chunk())
+    assert breaker.state == 'half_open'
+    resilience.call(call(fake))
+    assert breaker.state == 'closed'
+
+
+# Rate limiter
+
+def test_limiter_rejects_overload_without_going_into_debt():
+    fake = FakeGenerativeModel(latency=0)
+    bucket = TokenBucket(10, capacity=2)
+    resilience = Resilience(timeout=0.05, retry=RetryPolicy(attempts=1), rate_limiter=bucket)
+
+    outcomes = []
+    for _ in range(50):
+        try:
+            resilience.call(call(fake))
+            outcomes.append('ok')
+        except RateLimited:
+            outcomes.append('rejected')
+    # The burst, then nothing more can be admitted within the 50 ms deadline
+    assert outcomes.count('ok') == 2
+    assert fake.calls == 2
+    assert bucket.tokens >= -bucket.capacity
+
+    # Rejected calls took nothing, so the bucket refills at its normal rate
+    time.sleep(0.25)
+    resilience.call(call(fake))
+
+
+def test_limiter_debt_is_bounded():
+    bucket = TokenBucket(10, capacity=3)
+    waits = [bucket.reserve() for _ in range(10)]
+    assert waits[:3] == [0.0] * 3
+    assert waits[3:6] == pytest.approx([0.1, 0.2, 0.3], abs=0.01)
+    assert waits[6:] == [None] * 4
+    assert bucket.tokens == pytest.approx(-3, abs=0.1)
+
+
+def test_limiter_refunds_cancelled_waits():
+    fake = FakeGenerativeModel(latency=0)
+    bucket = TokenBucket(10, capacity=3)
+    resilience = Resilience(timeout=5, rate_limiter=bucket)
+
+    async def cancel_waiting():
+        await resilience.acall(acall(fake))
+        waiting = [asyncio.ensure_future(resilience.acall(acall(fake))) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        # 2 waiters took the tokens left, 3 went into debt
+        assert bucket.tokens < -2.5
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+
+    asyncio.run(cancel_waiting())
+    assert fake.calls == 3
+    # Without the refunds it would still be about 3 tokens in debt
+    assert bucket.tokens > -0.5
+
+
+# Hedging
+
+def slow_first_call(fake):
+    """Make the fake's first call slow and the later ones fast."""
+    fake.slow_rate = 1.0
+    original = fake._plan
+
+    def plan(request_options):
+        plan = original(request_options)
+        fake.slow_rate = 0.0
+        return plan
+    fake._plan = plan
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_hedge_answers_a_slow_call(mode):
+    fake = FakeGenerativeModel(latency=0.01, slow_latency=2.0)
+    slow_first_call(fake)
+    resilience = Resilience(timeout=5, hedge=True, hedge_delay=0.05)
+    hedges = events('hedge')
+
+    started = time.monotonic()
+    if mode == 'sync':
+        result = resilience.call(call(fake))
+    else:
+        result = asyncio.run(resilience.acall(acall(fake)))
+    assert result.text.startswith('<start>')
+    assert time.monotonic() - started < 1.0
+    assert fake.calls == 2
+    assert events('hedge') - hedges == 1
+
+
+def test_fast_calls_are_not_hedged():
+    fake = FakeGenerativeModel(latency=0.01)
+    resilience = Resilience(timeout=5, hedge=True, hedge_delay=0.5)
+    for _ in range(3):
+        resilience.call(call(fake))
+    assert fake.calls == 3
@@ -0,0 +1,132 @@
+"""
+Coalescing and storing of model responses in the two-tier cache (llm/cache.py).
+"""
+import asyncio
+
+import pytest
+
+from llm.cache import ResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path / 'responses.db'))
+
+
+def slow_compute(calls, release, value='answer'):
+    """Coroutine function counting its calls in `calls` and answering once `release` is set."""
+    async def compute():
+        calls.append(1)
+        await release.wait()
+        return value
+    return compute
+
+
+def test_concurrent_callers_share_one_call(cache):
+    async def main():
+        calls, release = [], asyncio.Event()
+        compute = slow_compute(calls, release)
+        tasks = [asyncio.ensure_future(cache.aget_or_compute('key', compute)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*tasks), calls
+
+    results, calls = asyncio.run(main())
+    assert results == ['answer'] * 5
+    assert len(calls) == 1
+    assert cache.coalesced == 4
+    assert cache.get('key') == 'answer'
+
+
+def test_cancelled_leader_leaves_the_call_to_the_waiters(cache):
+    async def main():
+        calls, release = [], asyncio.Event()
+        compute = slow_compute(calls, release)
+        leader = asyncio.ensure_future(cache.aget_or_compute('key', compute))
+        await asyncio.sleep(0.05)
+        waiters = [asyncio.ensure_future(cache.aget_or_compute('key', compute)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        # The leader's client disconnects
+        leader.cancel()
+        await asyncio.sleep(0.05)
+        release.set()
+        return leader, await asyncio.gather(*waiters), calls
+
+    leader, results, calls = asyncio.run(main())
+    assert leader.cancelled()
+    assert results == ['answer', 'answer']
+    assert len(calls) == 1
+    assert cache.get('key') == 'answer'
+
+
+def test_call_is_cancelled_once_nobody_waits(cache):
+    async def main():
+        calls, release = [], asyncio.Event()
+        cancelled = []
+
+        async def compute():
+            calls.append(1)
+            try:
+                await release.wait()
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+            return 'answer'
+
+        callers = [asyncio.ensure_future(cache.aget_or_compute('key', compute)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.sleep(0.05)
+        # A later caller starts a new call instead of inheriting the cancelled one
+        release.set()
+        return cancelled, await cache.aget_or_compute('key', compute), calls
+
+    cancelled, result, calls = asyncio.run(main())
+    assert cancelled == [1]
+    assert result == 'answer'
+    assert len(calls) == 2
+
+
+def test_errors_reach_every_caller_and_are_not_cached(cache):
+    async def main():
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            raise RuntimeError('upstream failed')
+
+        tasks = [asyncio.ensure_future(cache.aget_or_compute('key', compute)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.get('key') is None
+
+
+def test_rejected_answers_are_returned_but_not_cached(cache):
+    valid = lambda value: value.startswith('<start>')
+
+    assert cache.get_or_compute('sync', lambda: 'garbage', valid) == 'garbage'
+    assert cache.get('sync') is None
+
+    async def compute():
+        return 'garbage'
+
+    assert asyncio.run(cache.aget_or_compute('async', compute, valid)) == 'garbage'
+    assert cache.get('async') is None
+
+    assert cache.get_or_compute('sync', lambda: '<start>{}<end>', valid) == '<start>{}<end>'
+    assert cache.get('sync') == '<start>{}<end>'
+
+
+def test_disk_tier_is_shared_between_instances(cache, tmp_path):
+    async def compute():
+        return 'answer'
+
+    asyncio.run(cache.aget_or_compute('key', compute))
+    other = ResponseCache(str(tmp_path / 'responses.db'))
+    assert asyncio.run(other.aget('key')) == 'answer'
+    assert other.hits_disk == 1
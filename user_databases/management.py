@@ -0,0 +1,371 @@
+import base64
+import csv
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+def encode_cursor(name):
+    """Opaque pagination cursor pointing after the user called `name`."""
+    return base64.urlsafe_b64encode(name.encode('utf-8')).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of `encode_cursor`; raises ValueError on a malformed cursor."""
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode('utf-8')
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+class UserRepository(ABC):
+    """
+    Storage interface behind the user endpoints.
+
+    Users are plain dicts keyed by their `name`. Implementations must be safe
+    to call from FastAPI's threadpool.
+    """
+
+    def __init__(self, fields):
+        # Column names, in order; `name` is the key
+        self.fields = list(fields)
+
+    @abstractmethod
+    def get(self, name):
+        """Return the user as a dict, or None if there is no such user."""
+
+    @abstractmethod
+    def list(self):
+        """Return every user as a list of dicts, ordered by name."""
+
+    def page(self, limit, cursor=None):
+        """
+        One page of users ordered by name.
+
+        Parameters:
+        limit (int): Maximum number of users to return.
+        cursor (str): `next_cursor` of the previous page, to continue after it.
+
+        Returns:
+        tuple: (list of users, cursor of the next page or None).
+        """
+        after = decode_cursor(cursor) if cursor else None
+        users = self._after(after, limit + 1)
+        next_cursor = encode_cursor(users[limit - 1]['name']) if len(users) > limit and limit > 0 else None
+        return users[:limit], next_cursor
+
+    @abstractmethod
+    def _after(self, name, limit):
+        """Up to `limit` users whose name sorts after `name` (all if None), ordered by name."""
+
+    @abstractmethod
+    def create(self, user):
+        """Insert a user. Returns False if a user with that name already exists."""
+
+    def create_many(self, users):
+        """
+        Insert a batch of users (the backends write it at once). Users whose
+        name is already taken, in the store or earlier in the batch, are
+        skipped.
+
+        Returns:
+        int: The number of users created.
+        """
+        return sum(1 for user in users if self.create(user))
+
+    @abstractmethod
+    def update(self, name, user):
+        """
+        Replace the user called `name` (the new record may rename it).
+        Returns False if there is no such user, raises ValueError if the new
+        name is already taken by another user.
+        """
+
+    @abstractmethod
+    def delete(self, name):
+        """Delete a user. Returns False if there is no such user."""
+
+    def _record(self, user):
+        return {field: user.get(field) for field in self.fields}
+
+
+class CsvUserRepository(UserRepository):
+    """
+    The original storage: the whole CSV is read on every call and rewritten on
+    every change. Kept for small deployments and for migrating away from it.
+    """
+
+    def __init__(self, path, fields):
+        super().__init__(fields)
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        if not os.path.exists(path):
+            self._write([])
+
+    def _read(self):
+        with open(self.path, newline='') as f:
+            return [{field: (row.get(field) or None) for field in self.fields} for row in csv.DictReader(f)]
+
+    def _write(self, users):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.fields)
+            writer.writeheader()
+            writer.writerows(users)
+        os.replace(tmp_path, self.path)
+
+    def get(self, name):
+        return next((user for user in self._read() if user['name'] == name), None)
+
+    def list(self):
+        return sorted(self._read(), key=lambda user: user['name'])
+
+    def _after(self, name, limit):
+        return [user for user in self.list() if name is None or user['name'] > name][:limit]
+
+    def create(self, user):
+        with self._lock:
+            users = self._read()
+            if any(u['name'] == user['name'] for u in users):
+                return False
+            users.append(self._record(user))
+            self._write(users)
+            return True
+
+    def create_many(self, users):
+        with self._lock:
+            existing = self._read()
+            names = {u['name'] for u in existing}
+            created = []
+            for user in users:
+                if user['name'] not in names:
+                    names.add(user['name'])
+                    created.append(self._record(user))
+            if created:
+                self._write(existing + created)
+            return len(created)
+
+    def update(self, name, user):
+        with self._lock:
+            users = self._read()
+            names = [u['name'] for u in users]
+            if name not in names:
+                return False
+            if user['name'] != name and user['name'] in names:
+                raise ValueError(f"User {user['name']!r} already exists.")
+            users[names.index(name)] = self._record(user)
+            self._write(users)
+            return True
+
+    def delete(self, name):
+        with self._lock:
+            users = self._read()
+            remaining = [u for u in users if u['name'] != name]
+            if len(remaining) == len(users):
+                return False
+            self._write(remaining)
+            return True
+
+
+class SqliteUserRepository(UserRepository):
+    """
+    Users in an SQLite table keyed by name (WAL mode), so lookups go through
+    the primary key index and every change is a single-row transaction.
+
+    Reads go through an in-process LRU cache of up to `cache_size` users.
+    Writes from this process update it directly; writes from other processes
+    (other uvicorn workers) are detected through `PRAGMA data_version`, which
+    clears the cache.
+    """
+
+    def __init__(self, path, fields, cache_size=10000):
+        super().__init__(fields)
+        self.path = path
+        self.cache_size = cache_size
+        self._local = threading.local()
+        # name -> user, least recently used first
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Bumped on every invalidation, so a read that raced with a write
+        # doesn't put the old row back into the cache
+        self._generation = 0
+        # Read-through cache statistics (exposed on /metrics)
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        columns = ', '.join(f'"{field}" TEXT' for field in self.fields if field != 'name')
+        with self._connection() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, {columns})')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _connection(self):
+        # One connection per thread; sqlite3 connections must not be shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.data_version = None
+        return conn
+
+    def _sync_cache(self, conn):
+        # data_version changes when another connection commits
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if self._local.data_version != data_version:
+            if self._local.data_version is not None:
+                with self._cache_lock:
+                    self._cache.clear()
+                    self._generation += 1
+            self._local.data_version = data_version
+
+    def _columns(self):
+        return ', '.join(f'"{field}"' for field in self.fields)
+
+    def get(self, name):
+        conn = self._connection()
+        self._sync_cache(conn)
+        with self._cache_lock:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                self.hits += 1
+                return dict(self._cache[name])
+            self.misses += 1
+            generation = self._generation
+
+        row = conn.execute(f'SELECT {self._columns()} FROM users WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        with self._cache_lock:
+            if generation == self._generation and self.cache_size > 0:
+                self._cache[name] = user
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return dict(user)
+
+    def list(self):
+        conn = self._connection()
+        return [dict(row) for row in conn.execute(f'SELECT {self._columns()} FROM users ORDER BY name')]
+
+    def _after(self, name, limit):
+        # Keyset pagination: a range scan of the primary key index, so the
+        # cost doesn't depend on how deep the page is
+        conn = self._connection()
+        if name is None:
+            rows = conn.execute(f'SELECT {self._columns()} FROM users ORDER BY name LIMIT ?', (limit,))
+        else:
+            rows = conn.execute(f'SELECT {self._columns()} FROM users WHERE name > ? ORDER BY name LIMIT ?', (name, limit))
+        return [dict(row) for row in rows]
+
+    def create(self, user):
+        record = self._record(user)
+        conn = self._connection()
+        placeholders = ', '.join('?' for _ in self.fields)
+        try:
+            with conn:
+                conn.execute(f'INSERT INTO users ({self._columns()}) VALUES ({placeholders})',
+                             [record[field] for field in self.fields])
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def create_many(self, users):
+        conn = self._connection()
+        placeholders = ', '.join('?' for _ in self.fields)
+        with conn:
+            before = conn.total_changes
+            conn.executemany(f'INSERT OR IGNORE INTO users ({self._columns()}) VALUES ({placeholders})',
+                             ([record[field] for field in self.fields] for record in map(self._record, users)))
+            return conn.total_changes - before
+
+    def update(self, name, user):
+        record = self._record(user)
+        conn = self._connection()
+        assignments = ', '.join(f'"{field}" = ?' for field in self.fields)
+        try:
+            with conn:
+                cursor = conn.execute(f'UPDATE users SET {assignments} WHERE name = ?',
+                                      [record[field] for field in self.fields] + [name])
+        except sqlite3.IntegrityError:
+            raise ValueError(f"User {record['name']!r} already exists.")
+        self._invalidate(name, record['name'])
+        return cursor.rowcount > 0
+
+    def delete(self, name):
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute('DELETE FROM users WHERE name = ?', (name,))
+        self._invalidate(name)
+        return cursor.rowcount > 0
+
+    def _invalidate(self, *names):
+        with self._cache_lock:
+            for name in names:
+                self._cache.pop(name, None)
+            self._generation += 1
+
+    def migrate_from_csv(self, csv_path):
+        """
+        One-shot import of the users of a CSV file written by the original
+        storage. Users already in the table are left alone, and once the
+        migration has run it is not repeated, so deleted users don't come back.
+
+        Returns:
+        int: The number of users imported.
+        """
+        conn = self._connection()
+        done = conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_csv'").fetchone()
+        if done is not None or not os.path.exists(csv_path):
+            return 0
+
+        source = CsvUserRepository(csv_path, self.fields)
+        placeholders = ', '.join('?' for _ in self.fields)
+        with conn:
+            cursor = conn.executemany(
+                f'INSERT OR IGNORE INTO users ({self._columns()}) VALUES ({placeholders})',
+                ([user[field] for field in self.fields] for user in source.list()),
+            )
+            conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_csv', ?)", (os.path.abspath(csv_path),))
+        return cursor.rowcount
+
+
+def create_user_repository(backend, fields, csv_path, db_path, cache_size=10000):
+    """
+    Build the user repository for the configured backend ('sqlite' or 'csv').
+    The SQLite backend imports the CSV the first time it is opened.
+    """
+    if backend == 'csv':
+        return CsvUserRepository(csv_path, fields)
+    if backend == 'sqlite':
+        repository = SqliteUserRepository(db_path, fields, cache_size)
+        repository.migrate_from_csv(csv_path)
+        return repository
+    raise ValueError(f"Unknown users backend: {backend!r}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from config import USERS_DATASET_PATH, USERS_DB_PATH
+
+    parser = argparse.ArgumentParser(description="Migrate the users CSV into the SQLite user store.")
+    parser.add_argument('--csv', default=USERS_DATASET_PATH)
+    parser.add_argument('--db', default=USERS_DB_PATH)
+    args = parser.parse_args()
+
+    with open(args.csv, newline='') as f:
+        fields = next(csv.reader(f))
+    imported = SqliteUserRepository(args.db, fields).migrate_from_csv(args.csv)
+    print(f"Imported {imported} users from {args.csv} into {args.db}")
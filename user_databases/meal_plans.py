@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from user_databases.management import encode_cursor
+
+
+def profile_version(user):
+    """Hash of a user record; a stored meal plan is current while it matches."""
+    payload = json.dumps(user, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def should_store(generator, answer):
+    """
+    Whether a parsed answer of the meal plan model is worth keeping: not an
+    error or unparsed text, and not the standard plan served while the model
+    is unavailable (which should be replaced as soon as the model is back).
+    """
+    if not (isinstance(answer, dict) and 'meal_plan' in answer and 'error' not in answer):
+        return False
+    return generator.default_response is None or answer != generator.extract_target_answer(generator.default_response)
+
+
+class MealPlanStore:
+    """
+    Generated meal plans in an SQLite table keyed by user name, each stored
+    with the `profile_version` of the user record it was generated from.
+
+    Also keeps the progress of `precompute_meal_plans` runs, so an interrupted
+    run can resume after the last user it finished.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # Lookup statistics (exposed on /metrics)
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS meal_plans ('
+                         'name TEXT PRIMARY KEY, version TEXT, plan TEXT, created_at REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS precompute_runs ('
+                         'run_id TEXT PRIMARY KEY, started_at REAL, updated_at REAL, finished_at REAL, '
+                         'last_user TEXT, generated INTEGER, skipped INTEGER, failed INTEGER)')
+
+    def _connection(self):
+        # One connection per thread; sqlite3 connections must not be shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, name, version=None):
+        """
+        The stored meal plan of a user, or None. With `version`, a plan built
+        from another version of the profile counts as missing.
+        """
+        row = self._connection().execute('SELECT version, plan FROM meal_plans WHERE name = ?', (name,)).fetchone()
+        if row is None or (version is not None and row[0] != version):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[1])
+
+    def version(self, name):
+        """The profile version the stored plan of a user was built from, or None."""
+        row = self._connection().execute('SELECT version FROM meal_plans WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, name, version, plan):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO meal_plans (name, version, plan, created_at) VALUES (?, ?, ?, ?)',
+                         (name, version, json.dumps(plan), time.time()))
+
+    def delete(self, name):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM meal_plans WHERE name = ?', (name,))
+
+    def start_run(self, resume=True):
+        """
+        Start a precompute run, or with `resume` continue the most recent
+        unfinished one. Returns the run as a dict (see `run`).
+
+        A fresh run closes the unfinished ones, so a later resume continues
+        the new run rather than one the operator chose to abandon.
+        """
+        conn = self._connection()
+        if resume:
+            row = conn.execute('SELECT run_id FROM precompute_runs WHERE finished_at IS NULL '
+                               'ORDER BY started_at DESC LIMIT 1').fetchone()
+            if row is not None:
+                return self.run(row[0])
+        run_id = uuid.uuid4().hex
+        now = time.time()
+        with conn:
+            conn.execute('UPDATE precompute_runs SET finished_at = ? WHERE finished_at IS NULL', (now,))
+            conn.execute('INSERT INTO precompute_runs VALUES (?, ?, ?, NULL, NULL, 0, 0, 0)', (run_id, now, now))
+        return self.run(run_id)
+
+    def checkpoint(self, run_id, last_user, generated, skipped, failed, finished=False):
+        """Record that every user up to and including `last_user` is done."""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE precompute_runs SET updated_at = ?, finished_at = ?, last_user = ?, '
+                         'generated = ?, skipped = ?, failed = ? WHERE run_id = ?',
+                         (now, now if finished else None, last_user, generated, skipped, failed, run_id))
+
+    def run(self, run_id=None):
+        """A precompute run (the most recent one by default) as a dict, or None."""
+        conn = self._connection()
+        columns = ['run_id', 'started_at', 'updated_at', 'finished_at', 'last_user', 'generated', 'skipped', 'failed']
+        if run_id is None:
+            row = conn.execute(f'SELECT {", ".join(columns)} FROM precompute_runs ORDER BY started_at DESC LIMIT 1').fetchone()
+        else:
+            row = conn.execute(f'SELECT {", ".join(columns)} FROM precompute_runs WHERE run_id = ?', (run_id,)).fetchone()
+        return dict(zip(columns, row)) if row is not None else None
+
+
+def generate_meal_plan(generator, store, user):
+    """
+    Generate and store the meal plan of one user (a `users_storage` record).
+    Returns the plan, or None if it was not worth storing (see `should_store`).
+    """
+    plan = generator(user_params=user)
+    if not should_store(generator, plan):
+        return None
+    store.put(user['name'], profile_version(user), plan)
+    return plan
+
+
+def _iter_users(users, after, page_size):
+    # Keyset pagination, so the whole user table is never in memory
+    cursor = encode_cursor(after) if after is not None else None
+    while True:
+        page, cursor = users.page(page_size, cursor)
+        yield from page
+        if cursor is None:
+            return
+
+
+def precompute_meal_plans(users, store, generator, workers=8, resume=True, force=False,
+                          checkpoint_interval=1.0, page_size=256, progress=None):
+    """
+    Generate a meal plan for every user whose stored plan is missing or was
+    built from an older version of their profile.
+
+    Users are processed in name order on `workers` threads. Every
+    `checkpoint_interval` seconds the last user before which every user is
+    done is saved, and a resumed run continues after it.
+
+    Parameters:
+    users (UserRepository): The user store.
+    store (MealPlanStore): Where plans and run progress are kept.
+    generator (GeminiForMealPlanGeneration): The meal plan model.
+    workers (int): Maximum number of plans generated at the same time.
+    resume (bool): Continue the last unfinished run instead of starting over.
+    force (bool): Regenerate plans that are still current.
+    progress (callable): Called with the run dict after every checkpoint.
+
+    Returns:
+    dict: The finished run (run_id, generated, skipped, failed, ...).
+    """
+    run = store.start_run(resume=resume)
+    counts = {key: run[key] for key in ('generated', 'skipped', 'failed')}
+    last_user = run['last_user']
+    # Futures in name order; the checkpoint only moves past finished ones
+    pending = deque()
+    in_flight = set()
+    last_checkpoint = time.monotonic()
+
+    def process(user):
+        if not force and store.version(user['name']) == profile_version(user):
+            return 'skipped'
+        try:
+            return 'generated' if generate_meal_plan(generator, store, user) is not None else 'failed'
+        except Exception:
+            return 'failed'
+
+    def advance():
+        nonlocal last_user
+        while pending and pending[0][1].done():
+            name, future = pending.popleft()
+            counts[future.result()] += 1
+            last_user = name
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='meal-plans') as pool:
+        for user in _iter_users(users, run['last_user'], page_size):
+            # Bound the queue, so users are read from the store as workers free up
+            while len(in_flight) >= workers * 2:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            future = pool.submit(process, user)
+            pending.append((user['name'], future))
+            in_flight.add(future)
+
+            advance()
+            if time.monotonic() - last_checkpoint >= checkpoint_interval:
+                store.checkpoint(run['run_id'], last_user, **counts)
+                last_checkpoint = time.monotonic()
+                if progress is not None:
+                    progress(store.run(run['run_id']))
+        wait(in_flight)
+        advance()
+
+    store.checkpoint(run['run_id'], last_user, finished=True, **counts)
+    return store.run(run['run_id'])
+
+
+if __name__ == "__main__":
+    import argparse
+    import csv
+
+    from config import (
+        USERS_DATASET_PATH, USERS_BACKEND, USERS_DB_PATH, MEAL_PLANS_DB_PATH, MEAL_PLAN_PRECOMPUTE_WORKERS,
+        GEMINI_CACHE_PATH, GEMINI_CACHE_MEMORY_SIZE, GEMINI_CACHE_TTL, GEMINI_CACHE_MAX_BYTES,
+        GEMINI_TIMEOUT, GEMINI_RETRIES, GEMINI_BACKOFF_BASE, GEMINI_BACKOFF_MAX, GEMINI_RATE_LIMIT,
+        GEMINI_RATE_BURST, GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET, GEMINI_HEDGE, GEMINI_HEDGE_QUANTILE,
+    )
+    from llm.cache import ResponseCache
+    from llm.gemini_for_generating_meal_plan import GeminiForMealPlanGeneration
+    from llm.resilience import Resilience, RetryPolicy, TokenBucket, CircuitBreaker
+    from user_databases.management import create_user_repository
+
+    parser = argparse.ArgumentParser(description="Precompute the meal plans of every user.")
+    parser.add_argument('--workers', type=int, default=MEAL_PLAN_PRECOMPUTE_WORKERS)
+    parser.add_argument('--fresh', action='store_true', help="Start a new run instead of resuming an interrupted one.")
+    parser.add_argument('--force', action='store_true', help="Regenerate plans that are still current.")
+    parser.add_argument('--db', default=MEAL_PLANS_DB_PATH)
+    args = parser.parse_args()
+
+    with open(USERS_DATASET_PATH, newline='') as f:
+        fields = next(csv.reader(f))
+    users = create_user_repository(USERS_BACKEND, fields=fields, csv_path=USERS_DATASET_PATH, db_path=USERS_DB_PATH)
+    generator = GeminiForMealPlanGeneration(
+        cache=ResponseCache(GEMINI_CACHE_PATH, memory_size=GEMINI_CACHE_MEMORY_SIZE, ttl=GEMINI_CACHE_TTL,
+                            max_disk_bytes=GEMINI_CACHE_MAX_BYTES),
+        resilience=Resilience(
+            timeout=GEMINI_TIMEOUT,
+            retry=RetryPolicy(attempts=GEMINI_RETRIES, base_delay=GEMINI_BACKOFF_BASE, max_delay=GEMINI_BACKOFF_MAX),
+            rate_limiter=TokenBucket(GEMINI_RATE_LIMIT, GEMINI_RATE_BURST),
+            breaker=CircuitBreaker(GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET),
+            hedge=GEMINI_HEDGE,
+            hedge_quantile=GEMINI_HEDGE_QUANTILE,
+        ),
+    )
+
+    def report(run):
+        print(f"[{run['run_id'][:8]}] generated {run['generated']}  skipped {run['skipped']}  "
+              f"failed {run['failed']}  last user {run['last_user']!r}", flush=True)
+
+    report(precompute_meal_plans(users, MealPlanStore(args.db), generator, workers=args.workers,
+                                 resume=not args.fresh, force=args.force, progress=report))